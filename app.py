@@ -6,20 +6,39 @@ import json
 import os
 from datetime import datetime, timedelta
 import anthropic
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 import plotly.express as px
 import plotly.graph_objects as go
 from folium.plugins import MarkerCluster, HeatMap
+from folium.elements import JSCSSMixin
+from folium.map import Layer
+from branca.element import Element, MacroElement
+from jinja2 import Template
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import tempfile
 import io
+import time
+import hashlib
+import uuid
+import difflib
+import re
+import sqlite3
+import unicodedata
+import base64
+import threading
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from dotenv import load_dotenv
 load_dotenv('config.env')
 
 # Try to import streamlit_folium, fallback to alternative if not available
 try:
-    from streamlit_folium import folium_static
+    from streamlit_folium import folium_static, st_folium
 except ImportError:
+    st_folium = None
     # Fallback: use st.components.v1.html for folium maps
     def folium_static(fig, width=700, height=500):
         return st.components.v1.html(fig._repr_html_(), width=width, height=height)
@@ -525,95 +544,1914 @@ def get_anthropic_client():
     return anthropic.Anthropic(api_key=api_key)
 
 # Data processing functions
-@st.cache_data
-def load_and_process_csv(uploaded_file):
-    """Load CSV and perform initial data processing"""
-    try:
-        df = pd.read_csv(uploaded_file)
-        required_columns = [
-            'flight_id', 'origin_city', 'origin_lat', 'origin_lon',
-            'dest_city', 'dest_lat', 'dest_lon', 'timestamp', 'speed_kts', 'altitude_ft'
-        ]
-        
-        missing_cols = [col for col in required_columns if col not in df.columns]
-        if missing_cols:
-            st.error(f"Missing required columns: {missing_cols}")
-            return None
+CITY_COLUMNS = ['origin_city', 'dest_city']
+COORD_COLUMNS = ['origin_lat', 'origin_lon', 'dest_lat', 'dest_lon']
+MEASURE_COLUMNS = ['speed_kts', 'altitude_ft']
+REQUIRED_COLUMNS = [
+    'flight_id', 'origin_city', 'origin_lat', 'origin_lon',
+    'dest_city', 'dest_lat', 'dest_lon', 'timestamp', 'speed_kts', 'altitude_ft'
+]
+
+# Compact column types handed straight to the CSV reader
+CSV_DTYPES = {
+    'flight_id': pd.StringDtype('pyarrow'),
+    'origin_city': 'category',
+    'dest_city': 'category',
+    **{col: 'float32' for col in COORD_COLUMNS + MEASURE_COLUMNS},
+}
+
+# Rows parsed per step of the streaming CSV ingest
+INGEST_CHUNK_ROWS = 200_000
+
+def _source_size(source) -> Optional[int]:
+    """Size in bytes of an uploaded file or path, if it can be determined"""
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    if getattr(source, 'size', None) is not None:
+        return source.size
+    if hasattr(source, 'seek') and hasattr(source, 'tell'):
+        position = source.tell()
+        size = source.seek(0, io.SEEK_END)
+        source.seek(position)
+        return size
+    return None
+
+def _iter_csv_chunks(handle, lenient: bool):
+    """Yield typed chunks of the CSV; lenient mode coerces bad numbers to NaN"""
+    if not lenient:
+        yield from pd.read_csv(handle, dtype=CSV_DTYPES, chunksize=INGEST_CHUNK_ROWS)
+        return
+    
+    dtypes = {col: dtype for col, dtype in CSV_DTYPES.items() if dtype != 'float32'}
+    for chunk in pd.read_csv(handle, dtype=dtypes, chunksize=INGEST_CHUNK_ROWS):
+        for col in COORD_COLUMNS + MEASURE_COLUMNS:
+            if col in chunk.columns:
+                chunk[col] = pd.to_numeric(chunk[col], errors='coerce').astype('float32')
+        yield chunk
+
+def _allocate_buffers(capacity: int) -> Dict[str, np.ndarray]:
+    """Preallocate one flat array per fixed-width column"""
+    buffers = {col: np.empty(capacity, dtype=np.float32) for col in COORD_COLUMNS + MEASURE_COLUMNS}
+    buffers['timestamp'] = np.empty(capacity, dtype='datetime64[ns]')
+    for col in CITY_COLUMNS:
+        buffers[col] = np.empty(capacity, dtype=np.int32)
+    return buffers
+
+def _reserve(buffers: Dict[str, np.ndarray], used: int, needed: int):
+    """Grow every buffer geometrically so it can hold `needed` rows"""
+    capacity = len(buffers['timestamp'])
+    if needed <= capacity:
+        return
+    capacity = max(needed, capacity * 2)
+    for col, old in buffers.items():
+        new = np.empty(capacity, dtype=old.dtype)
+        new[:used] = old[:used]
+        buffers[col] = new
+
+def _encode_cities(cities: pd.Series, dictionary: Dict[str, int]) -> np.ndarray:
+    """Translate a chunk's categorical codes into codes of the dataset-wide dictionary"""
+    lookup = [dictionary.setdefault(city, len(dictionary)) for city in cities.cat.categories]
+    # Missing cities keep code -1 via the trailing table entry
+    return np.array(lookup + [-1], dtype=np.int32)[cities.cat.codes.to_numpy()]
+
+def _sorted_categorical(codes: np.ndarray, dictionary: Dict[str, int]) -> pd.Categorical:
+    """Build a categorical from dataset-wide codes with alphabetically ordered categories"""
+    names = np.array(list(dictionary), dtype=object)
+    order = np.argsort(names, kind='stable')
+    remap = np.empty(len(names) + 1, dtype=np.int32)
+    remap[order] = np.arange(len(names), dtype=np.int32)
+    remap[-1] = -1
+    return pd.Categorical.from_codes(remap[codes], categories=names[order])
+
+def _ingest_chunks(handle, lenient: bool, total_bytes: Optional[int], progress) -> pd.DataFrame:
+    """Stream the CSV into column buffers chunk by chunk, dropping bad coordinates"""
+    buffers = None
+    n_rows = 0
+    dictionaries = {col: {} for col in CITY_COLUMNS}
+    other_chunks = []
+    columns = None
+    
+    for chunk in _iter_csv_chunks(handle, lenient):
+        if columns is None:
+            missing_cols = [col for col in REQUIRED_COLUMNS if col not in chunk.columns]
+            if missing_cols:
+                raise ValueError(f"Missing required columns: {missing_cols}")
+            columns = list(chunk.columns)
         
-        # Convert timestamp to datetime
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        # Remove rows with invalid coordinates
+        chunk = chunk[chunk[COORD_COLUMNS].notna().all(axis=1).to_numpy()]
+        rows = len(chunk)
         
-        # Ensure numeric columns
-        numeric_cols = ['origin_lat', 'origin_lon', 'dest_lat', 'dest_lon', 'speed_kts', 'altitude_ft']
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
+        if buffers is None:
+            # Size the buffers from the first chunk's bytes per row, with some headroom
+            consumed = handle.tell() if hasattr(handle, 'tell') else None
+            estimate = rows
+            if total_bytes and consumed:
+                estimate = int(total_bytes / consumed * rows * 1.05)
+            buffers = _allocate_buffers(max(estimate, rows, 1))
+        _reserve(buffers, n_rows, n_rows + rows)
         
-        # Remove rows with invalid coordinates
-        df = df.dropna(subset=['origin_lat', 'origin_lon', 'dest_lat', 'dest_lon'])
+        target = slice(n_rows, n_rows + rows)
+        for col in COORD_COLUMNS + MEASURE_COLUMNS:
+            buffers[col][target] = chunk[col].to_numpy()
+        timestamps = pd.to_datetime(chunk['timestamp'])
+        if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+            timestamps = timestamps.dt.tz_convert(None)
+        buffers['timestamp'][target] = timestamps.to_numpy()
+        for col in CITY_COLUMNS:
+            buffers[col][target] = _encode_cities(chunk[col], dictionaries[col])
+        other_chunks.append(chunk.drop(columns=list(buffers)))
+        n_rows += rows
         
-        return df
+        if progress is not None and total_bytes and hasattr(handle, 'tell'):
+            done = min(handle.tell() / total_bytes, 1.0)
+            progress(done, text=f"Processing CSV... {n_rows:,} flights")
+    
+    # Keep rows in time order so time windows resolve to contiguous slices;
+    # columns are reordered one at a time so only one extra copy is alive
+    order = np.argsort(buffers['timestamp'][:n_rows], kind='stable')
+    others = pd.concat(other_chunks).take(order)
+    data = {}
+    for col in list(buffers):
+        values = buffers.pop(col)[:n_rows][order]
+        if col in CITY_COLUMNS:
+            values = _sorted_categorical(values, dictionaries[col])
+        elif col in MEASURE_COLUMNS:
+            values = _compact_measure(pd.Series(values)).array
+        data[col] = values
+    
+    return pd.DataFrame(
+        {col: data[col] if col in data else others[col].array for col in columns},
+        index=others.index,
+        copy=False
+    )
+
+def _compact_measure(values: pd.Series) -> pd.Series:
+    """Store whole-number speeds/altitudes as int16, with pandas' nullable Int16 for gaps"""
+    present = values.dropna().to_numpy()
+    info = np.iinfo(np.int16)
+    if (
+        len(present) == 0 or
+        present.min() < info.min or present.max() > info.max or
+        not np.array_equal(present, np.round(present))
+    ):
+        return values
+    return values.astype('int16' if len(present) == len(values) else 'Int16')
+
+def read_flights_csv(source, progress: Optional[Callable] = None) -> pd.DataFrame:
+    """Parse a flight CSV (path or file object) into the compact, time-sorted schema"""
+    started = time.perf_counter()
+    total_bytes = _source_size(source)
+    
+    for lenient in (False, True):
+        # Open paths in binary mode so parse progress can be read from the handle
+        handle = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+        try:
+            df = _ingest_chunks(handle, lenient, total_bytes, progress)
+            break
+        except ValueError:
+            # A non-numeric value somewhere: restart with coercing reads
+            if lenient:
+                raise
+            handle.seek(0)
+        finally:
+            if handle is not source:
+                handle.close()
+    
+    _record_ingest(df, started)
+    return df
+
+def _record_ingest(df: pd.DataFrame, started: float):
+    """Attach load throughput to the frame for the sidebar summary"""
+    seconds = time.perf_counter() - started
+    df.attrs['ingest'] = {
+        'rows': len(df),
+        'seconds': seconds,
+        'rows_per_sec': len(df) / max(seconds, 1e-9),
+    }
+
+def load_and_process_csv(uploaded_file, _progress: Optional[Callable] = None):
+    """Load CSV and perform initial data processing"""
+    try:
+        # Parsed once per distinct file content, then shared by every session
+        key = f"csv-{content_hash(uploaded_file)}"
+        return share_dataset(key, lambda: read_flights_csv(uploaded_file, _progress))
     except Exception as e:
         st.error(f"Error loading CSV: {str(e)}")
         return None
 
-def apply_filters(df: pd.DataFrame, filters: Dict) -> pd.DataFrame:
-    """Apply filters to the dataframe"""
-    filtered_df = df.copy()
+# Parquet / Arrow datasets
+PARQUET_PARTITION = 'date'
+PARQUET_ROW_GROUP_ROWS = 128_000
+
+# Arrow strings come back as compact Arrow-backed pandas strings, not Python objects
+ARROW_PANDAS_TYPES = {
+    pa.string(): pd.StringDtype('pyarrow'),
+    pa.large_string(): pd.StringDtype('pyarrow'),
+}
+
+def open_parquet_dataset(path: str) -> ds.Dataset:
+    """Open a Parquet file or directory, discovering date=YYYY-MM-DD partitions"""
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+def _is_date_partitioned(dataset: ds.Dataset) -> bool:
+    """Whether the dataset's directory layout splits files by day"""
+    partitioning = dataset.partitioning
+    return partitioning is not None and PARQUET_PARTITION in partitioning.schema.names
+
+def parquet_fingerprint(path: str) -> Tuple:
+    """Identify the current contents of a Parquet dataset for cache invalidation"""
+    return tuple(
+        (name, os.path.getmtime(name), os.path.getsize(name))
+        for name in open_parquet_dataset(path).files
+    )
+
+def _naive_timestamp(value) -> pd.Timestamp:
+    """Parse a time_range bound, converting timezone-aware values to naive UTC"""
+    timestamp = pd.Timestamp(value)
+    return timestamp.tz_convert(None) if timestamp.tzinfo else timestamp
+
+def filters_to_expression(filters: Dict, date_partitioned: bool = False) -> Optional[ds.Expression]:
+    """Translate the filters dict into an Arrow predicate for partition and row-group pruning"""
+    clauses = []
+    
+    def between(column: str, low, high):
+        clauses.append(ds.field(column) >= low)
+        clauses.append(ds.field(column) <= high)
+    
+    if filters.get('time_range'):
+        start_time, end_time = (_naive_timestamp(value) for value in filters['time_range'])
+        between('timestamp', start_time, end_time)
+        if date_partitioned:
+            # Whole partitions outside the window are skipped without opening their files
+            between(PARQUET_PARTITION, start_time.strftime('%Y-%m-%d'), end_time.strftime('%Y-%m-%d'))
+    
+    if filters.get('altitude_range'):
+        between('altitude_ft', *filters['altitude_range'])
+    
+    if filters.get('speed_range'):
+        between('speed_kts', *filters['speed_range'])
+    
+    if filters.get('destinations'):
+        for name, bounds in (('mexico', MEXICO_BOUNDS), ('us', US_BOUNDS)):
+            if name in filters['destinations']:
+                between('dest_lat', bounds['south'], bounds['north'])
+                between('dest_lon', bounds['west'], bounds['east'])
+    
+    # Circles read their bounding box and are cut exactly in memory; the viewport changes
+    # with every pan, so it is never pushed down
+    for key in ('origin_bbox', 'dest_bbox', 'origin_radius', 'dest_radius'):
+        if filters.get(key):
+            south, west, north, east = spatial_shape(key, filters[key])[0]
+            endpoint = SPATIAL_FILTERS[key][0]
+            between(f'{endpoint}_lat', south, north)
+            between(f'{endpoint}_lon', west, east)
+    
+    if filters.get('origin_cities'):
+        clauses.append(ds.field('origin_city').isin(list(filters['origin_cities'])))
+    
+    if filters.get('dest_cities'):
+        clauses.append(ds.field('dest_city').isin(list(filters['dest_cities'])))
+    
+    if not clauses:
+        return None
+    expression = clauses[0]
+    for clause in clauses[1:]:
+        expression = expression & clause
+    return expression
+
+def _conform_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """Coerce a frame from any source to the compact, time-sorted in-memory schema"""
+    df['flight_id'] = df['flight_id'].astype(CSV_DTYPES['flight_id'])
+    for col in COORD_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
+    df = df.dropna(subset=COORD_COLUMNS)
+    
+    for col in MEASURE_COLUMNS:
+        if df[col].dtype not in ('int16', 'Int16'):
+            df[col] = _compact_measure(pd.to_numeric(df[col], errors='coerce').astype('float32'))
+    
+    for col in CITY_COLUMNS:
+        cities = df[col].astype('category')
+        df[col] = cities.cat.reorder_categories(sorted(cities.cat.categories))
+    
+    timestamps = pd.to_datetime(df['timestamp'])
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = timestamps.dt.tz_convert(None)
+    df['timestamp'] = timestamps.astype('datetime64[ns]')
+    
+    if not df['timestamp'].is_monotonic_increasing:
+        df = df.sort_values('timestamp', kind='stable')
+    return df
+
+def read_parquet_dataset(path: str, filters: Optional[Dict] = None) -> pd.DataFrame:
+    """Read the flights of a Parquet dataset that can match filters, pruning everything else"""
+    started = time.perf_counter()
+    dataset = open_parquet_dataset(path)
+    
+    missing_cols = [col for col in REQUIRED_COLUMNS if col not in dataset.schema.names]
+    if missing_cols:
+        raise ValueError(f"Missing required columns: {missing_cols}")
+    
+    partitioned = _is_date_partitioned(dataset)
+    columns = [
+        name for name in dataset.schema.names
+        if not (partitioned and name == PARQUET_PARTITION)
+    ]
+    table = dataset.to_table(
+        columns=columns,
+        filter=filters_to_expression(filters or {}, partitioned)
+    )
+    df = _conform_schema(table.to_pandas(types_mapper=ARROW_PANDAS_TYPES.get))
+    
+    _record_ingest(df, started)
+    return df
+
+def load_parquet_dataset(path: str, filters: Dict, fingerprint: Tuple = ()) -> Optional[pd.DataFrame]:
+    """Load a Parquet dataset with filters pushed down; fingerprint invalidates the store"""
+    try:
+        signature = repr((os.path.abspath(path), fingerprint, sorted(filters.items())))
+        key = f"parquet-{hashlib.sha256(signature.encode()).hexdigest()}"
+        return share_dataset(key, lambda: read_parquet_dataset(path, filters))
+    except Exception as e:
+        st.error(f"Error loading Parquet dataset: {str(e)}")
+        return None
+
+@st.cache_data
+def parquet_time_bounds(path: str, fingerprint: Tuple = ()) -> Optional[Tuple[pd.Timestamp, pd.Timestamp]]:
+    """Earliest and latest timestamp of a Parquet dataset, from row-group statistics"""
+    bounds = []
+    dataset = open_parquet_dataset(path)
+    for fragment in dataset.get_fragments():
+        for row_group in fragment.row_groups:
+            stats = (row_group.statistics or {}).get('timestamp')
+            if not stats or stats.get('min') is None:
+                # No statistics written: fall back to scanning the column
+                column = dataset.to_table(columns=['timestamp'])['timestamp']
+                low, high = pc.min_max(column).values()
+                return (pd.Timestamp(low.as_py()), pd.Timestamp(high.as_py())) if low.is_valid else None
+            bounds.append((stats['min'], stats['max']))
+    if not bounds:
+        return None
+    return (
+        pd.Timestamp(min(low for low, _ in bounds)),
+        pd.Timestamp(max(high for _, high in bounds))
+    )
+
+def write_parquet_dataset(df: pd.DataFrame, out_dir: str, partition_by_date: bool = True, replace: bool = False):
+    """Write processed flights as Parquet, one directory per day, sorted row groups; with replace,
+    the partitions of the days written are emptied first, otherwise the flights are added to them"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    partitioning = None
+    if partition_by_date:
+        table = table.append_column(
+            PARQUET_PARTITION, pc.strftime(table['timestamp'], format='%Y-%m-%d')
+        )
+        partitioning = ds.partitioning(pa.schema([(PARQUET_PARTITION, pa.string())]), flavor='hive')
+    
+    ds.write_dataset(
+        table, out_dir,
+        format='parquet',
+        partitioning=partitioning,
+        # Small time-sorted row groups give tight min/max statistics for pruning
+        max_rows_per_group=PARQUET_ROW_GROUP_ROWS,
+        min_rows_per_group=PARQUET_ROW_GROUP_ROWS // 2,
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'),
+        # Uniquely named files never overwrite another write's files in the same partition
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior='delete_matching' if replace else 'overwrite_or_ignore'
+    )
+
+# Shared columnar store: one memory-mapped copy per dataset for all sessions
+STORE_DIR = os.getenv('FLIGHT_STORE_DIR', os.path.join(tempfile.gettempdir(), 'drone_flight_store'))
+STORE_FORMAT_VERSION = 1
+SHARED_DATASETS = 8
+HASH_BLOCK_BYTES = 1 << 20
+# Least recently used datasets are deleted once the store grows past this size
+STORE_MAX_BYTES = int(float(os.getenv('FLIGHT_STORE_MAX_MB', '4096')) * (1 << 20))
+
+def content_hash(source) -> str:
+    """SHA-256 of an upload or file path, streamed in fixed-size blocks"""
+    digest = hashlib.sha256()
+    handle = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+    try:
+        handle.seek(0)
+        while True:
+            block = handle.read(HASH_BLOCK_BYTES)
+            if not block:
+                break
+            digest.update(block.encode() if isinstance(block, str) else block)
+    finally:
+        if handle is source:
+            handle.seek(0)
+        else:
+            handle.close()
+    return digest.hexdigest()
+
+def _store_path(key: str) -> str:
+    """Location of a dataset in the shared store"""
+    return os.path.join(STORE_DIR, f"{key}.v{STORE_FORMAT_VERSION}.arrow")
+
+def write_shared_dataset(df: pd.DataFrame, key: str):
+    """Write a processed frame as an uncompressed Arrow IPC file sessions can memory-map"""
+    os.makedirs(STORE_DIR, exist_ok=True)
+    path = _store_path(key)
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    
+    # Write to a private file and rename, so readers never see a partial dataset
+    partial = f"{path}.{uuid.uuid4().hex}.partial"
+    with pa.OSFile(partial, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(partial, path)
+
+@st.cache_resource(max_entries=SHARED_DATASETS)
+def attach_shared_dataset(key: str) -> pd.DataFrame:
+    """Memory-map a stored dataset once per process; sessions share the read-only frame"""
+    table = pa.ipc.open_file(pa.memory_map(_store_path(key), 'r')).read_all()
+    # split_blocks keeps each column on its own mapped buffer instead of consolidating copies
+    df = table.to_pandas(split_blocks=True, types_mapper=ARROW_PANDAS_TYPES.get)
+    df.attrs['dataset_key'] = key
+    return df
+
+def evict_shared_datasets(keep: str, max_bytes: int = STORE_MAX_BYTES) -> List[str]:
+    """Delete least recently used datasets until the store fits in max_bytes"""
+    entries = []
+    for entry in os.scandir(STORE_DIR):
+        if entry.name.endswith('.arrow'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            # Sessions already attached keep their mapping; the next load rebuilds
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted.append(path)
+    return evicted
+
+@st.cache_resource
+def _store_lock(key: str) -> threading.Lock:
+    """One lock per dataset key, so concurrent sessions loading the same upload build it once"""
+    return threading.Lock()
+
+def _touch(path: str) -> bool:
+    """Mark a stored dataset as just used; False if it isn't in the store"""
+    try:
+        # The modification time doubles as the last-used time for eviction
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def share_dataset(key: str, build: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    """Return the shared copy of a dataset, building and storing it on first use"""
+    path = _store_path(key)
+    if not _touch(path):
+        with _store_lock(key):
+            # Another session may have stored it while this one waited
+            if not _touch(path):
+                write_shared_dataset(build(), key)
+                evict_shared_datasets(keep=path)
+    return attach_shared_dataset(key)
+
+@st.cache_resource(max_entries=SHARED_DATASETS)
+def _shared_data_index(key: str, _df: pd.DataFrame) -> Dict:
+    """Data index of a shared dataset, built once per process"""
+    return build_data_index(_df)
+
+def get_data_index(df: pd.DataFrame) -> Dict:
+    """Data index for a loaded dataset, shared between sessions when the dataset is"""
+    key = df.attrs.get('dataset_key')
+    return _shared_data_index(key, df) if key else build_data_index(df)
+
+def build_data_index(df: pd.DataFrame) -> Dict:
+    """Precompute per-dataset lookup structures used by the filter engine"""
+    index = {
+        'time_sorted': False,
+        'bytes_per_row': df.memory_usage(deep=True).sum() / max(len(df), 1),
+    }
+    
+    timestamps = df['timestamp'].to_numpy()
+    if timestamps.dtype.kind == 'M':
+        # sort_values puts NaT last, which is also where searchsorted expects it
+        n_valid = len(timestamps) - int(np.isnat(timestamps).sum())
+        valid = timestamps[:n_valid]
+        index['time_sorted'] = (
+            not np.isnat(valid).any() and
+            bool(np.all(valid[1:] >= valid[:-1]))
+        )
+        if n_valid:
+            index['time_min'] = pd.Timestamp(valid.min())
+            index['time_max'] = pd.Timestamp(valid.max())
+    
+    # Fixed per dataset, so the map view doesn't jump when filters change
+    if len(df):
+        index['center'] = map_center(df)
+    index['kpi_cubes'] = build_kpi_cubes(df)
+    index['kpi_sketches'] = build_kpi_sketches(df)
+    
+    for endpoint in SPATIAL_ENDPOINTS:
+        index[f'{endpoint}_grid'] = build_spatial_grid(
+            _column_values(df[f'{endpoint}_lat']), _column_values(df[f'{endpoint}_lon'])
+        )
+    
+    for col in CITY_COLUMNS:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            index[f'{col}_rows'] = build_city_postings(df[col])
+            index[f'{col}_options'] = sorted(index[f'{col}_rows'])
+        else:
+            index[f'{col}_options'] = sorted(df[col].dropna().unique())
+        # For snapping the city names in chat filters
+        index[f'{col}_folded'] = fold_cities(index[f'{col}_options'])
+    
+    return index
+
+def build_city_postings(cities: pd.Series) -> Dict[str, np.ndarray]:
+    """Map each city present in a categorical column to its ascending row positions"""
+    codes = cities.cat.codes.to_numpy()
+    row_dtype = np.int32 if len(codes) < np.iinfo(np.int32).max else np.int64
+    
+    # A stable sort by code groups rows per city while keeping them in row order
+    order = np.argsort(codes, kind='stable').astype(row_dtype)
+    counts = np.bincount(codes[codes >= 0], minlength=len(cities.cat.categories))
+    offset = len(codes) - int(counts.sum())  # missing cities (code -1) sort first
+    
+    postings = {}
+    for city, count in zip(cities.cat.categories, counts):
+        if count:
+            postings[city] = order[offset:offset + count]
+        offset += count
+    return postings
+
+# Spatial grid
+# Origin and destination points are bucketed into a uniform lat/lon grid at load time. Box and
+# radius filters only visit the occupied cells they overlap: rows of cells entirely inside are
+# taken as they are, rows of edge cells are tested against their coordinates.
+SPATIAL_ENDPOINTS = ['origin', 'dest']
+# Filter keys and the flight ends they test: boxes are [south, west, north, east], circles
+# [lat, lon, km]; the viewport box keeps flights with either end inside
+SPATIAL_FILTERS = {
+    'origin_bbox': ['origin'],
+    'dest_bbox': ['dest'],
+    'viewport': ['origin', 'dest'],
+    'origin_radius': ['origin'],
+    'dest_radius': ['dest'],
+}
+BORDER_CROSSINGS = {
+    "San Ysidro (San Diego – Tijuana)": (32.5422, -117.0296),
+    "Paso del Norte (El Paso – Ciudad Juárez)": (31.7565, -106.4870),
+    "World Trade Bridge (Laredo – Nuevo Laredo)": (27.5994, -99.5335),
+    "Hidalgo (McAllen – Reynosa)": (26.0959, -98.2710),
+    "Gateway (Brownsville – Matamoros)": (25.8992, -97.4981),
+}
+GRID_CELL_DEG = 0.1
+# Cells count as inside a box or circle only with this much room to spare, which covers
+# float32 coordinates and the curvature of cell edges
+GRID_MARGIN_DEG = 1e-4
+GRID_MARGIN_KM = 0.05
+EARTH_RADIUS_KM = 6371.0088
+
+def build_spatial_grid(lat: np.ndarray, lon: np.ndarray, cell: float = GRID_CELL_DEG) -> Dict:
+    """Row positions grouped by grid cell, ascending within each cell; rows without coordinates are left out"""
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    n_cols = int(np.ceil(360 / cell)) + 1
+    keys = np.floor((lat[valid] + 90) / cell).astype(np.int64) * n_cols
+    keys += np.floor((lon[valid] + 180) / cell).astype(np.int64)
+    
+    row_dtype = np.int32 if len(lat) < np.iinfo(np.int32).max else np.int64
+    if not len(keys):
+        return {'cell': cell, 'n_cols': n_cols, 'cells': keys, 'starts': np.zeros(1, dtype=np.int64),
+                'rows': valid.astype(row_dtype)}
+    
+    # Points cluster around launch sites, so few cells are occupied; numbered densely they
+    # fit 16 bits, where the stable sort is a linear radix sort
+    cells, groups = _group_keys(keys)
+    if len(cells) <= np.iinfo(np.uint16).max + 1:
+        groups = groups.astype(np.uint16)
+    order = np.argsort(groups, kind='stable')
+    counts = np.bincount(groups, minlength=len(cells))
+    return {
+        'cell': cell,
+        'n_cols': n_cols,
+        'cells': cells,
+        'starts': np.concatenate([[0], np.cumsum(counts)]),
+        'rows': valid[order].astype(row_dtype)
+    }
+
+def _grid_cells(grid: Dict, south: float, west: float, north: float, east: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Indexes of the occupied cells overlapping a box, and each cell's (south, west, north, east) edges"""
+    cell, n_cols = grid['cell'], grid['n_cols']
+    # Cells are sorted by row of latitude first, so the box's latitude band is one contiguous run
+    first_row = int(np.floor((south - GRID_MARGIN_DEG + 90) / cell))
+    last_row = int(np.floor((north + GRID_MARGIN_DEG + 90) / cell))
+    lo, hi = np.searchsorted(grid['cells'], [first_row * n_cols, (last_row + 1) * n_cols])
+    rows, cols = np.divmod(grid['cells'][lo:hi], n_cols)
+    cell_south, cell_west = rows * cell - 90, cols * cell - 180
+    overlap = (cell_west <= east + GRID_MARGIN_DEG) & (cell_west + cell >= west - GRID_MARGIN_DEG)
+    keep = np.flatnonzero(overlap)
+    return lo + keep, (cell_south[keep], cell_west[keep], cell_south[keep] + cell, cell_west[keep] + cell)
+
+def _cell_rows(grid: Dict, cells: np.ndarray) -> np.ndarray:
+    """Row positions of a set of cells, concatenated"""
+    starts, ends = grid['starts'][cells], grid['starts'][cells + 1]
+    lengths = ends - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    return grid['rows'][offsets]
+
+def _radius_test(lat: float, lon: float, km: float):
+    """Build a predicate testing (lat, lon) pairs for great-circle distance <= km from a point"""
+    lat0, lon0 = np.radians(lat), np.radians(lon)
+    limit = np.sin(min(km / EARTH_RADIUS_KM, np.pi) / 2) ** 2
+    south, west, north, east = _radius_box(lat, lon, km)
+    in_box = _bounds_test({
+        'south': south - GRID_MARGIN_DEG, 'west': west - GRID_MARGIN_DEG,
+        'north': north + GRID_MARGIN_DEG, 'east': east + GRID_MARGIN_DEG
+    })
+    def test(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        # The trigonometry only runs on points inside the circle's bounding box
+        result = in_box(lats, lons)
+        rows = np.flatnonzero(result)
+        near_lat = np.radians(np.asarray(lats[rows], dtype=np.float64))
+        near_lon = np.radians(np.asarray(lons[rows], dtype=np.float64))
+        haversine = np.sin((near_lat - lat0) / 2) ** 2
+        haversine += np.cos(lat0) * np.cos(near_lat) * np.sin((near_lon - lon0) / 2) ** 2
+        result[rows] = haversine <= limit
+        return result
+    return test
+
+def _radius_box(lat: float, lon: float, km: float) -> Tuple[float, float, float, float]:
+    """A (south, west, north, east) box containing every point within km of a point"""
+    dlat = np.degrees(km / EARTH_RADIUS_KM)
+    north, south = min(lat + dlat, 90.0), max(lat - dlat, -90.0)
+    widest = np.cos(np.radians(max(abs(north), abs(south))))
+    dlon = 180.0 if widest <= 0 else min(np.degrees(km / (EARTH_RADIUS_KM * widest)), 180.0)
+    if lon - dlon < -180 or lon + dlon > 180:
+        # Circles across the antimeridian search every longitude
+        return south, -180.0, north, 180.0
+    return south, lon - dlon, north, lon + dlon
+
+def spatial_shape(key: str, value) -> Tuple[Tuple[float, float, float, float], Callable, Callable]:
+    """The bounding box, point predicate and cell-inside predicate of a spatial filter value"""
+    if key.endswith('_radius'):
+        lat, lon, km = value
+        test = _radius_test(lat, lon, km)
+        inner = _radius_test(lat, lon, km - GRID_MARGIN_KM)
+        def inside(south, west, north, east):
+            # A small cell is inside the circle when its four corners are
+            return inner(south, west) & inner(south, east) & inner(north, west) & inner(north, east)
+        return _radius_box(lat, lon, km), test, inside
+    
+    south, west, north, east = value
+    test = _bounds_test({'south': south, 'west': west, 'north': north, 'east': east})
+    def inside(cell_south, cell_west, cell_north, cell_east):
+        return (
+            (cell_south >= south + GRID_MARGIN_DEG) & (cell_north <= north - GRID_MARGIN_DEG) &
+            (cell_west >= west + GRID_MARGIN_DEG) & (cell_east <= east - GRID_MARGIN_DEG)
+        )
+    return (south, west, north, east), test, inside
+
+def grid_query(grid: Dict, lat: np.ndarray, lon: np.ndarray, key: str, value, limit: Optional[int] = None) -> Optional[np.ndarray]:
+    """Unsorted row positions of points matching a spatial filter, or None if more than limit rows are candidates"""
+    box, test, inside = spatial_shape(key, value)
+    cells, edges = _grid_cells(grid, *box)
+    whole = inside(*edges)
+    if limit is not None and int((grid['starts'][cells + 1] - grid['starts'][cells]).sum()) > limit:
+        return None
+    edge_rows = _cell_rows(grid, cells[~whole])
+    edge_rows = edge_rows[test(lat[edge_rows], lon[edge_rows])]
+    return np.concatenate([_cell_rows(grid, cells[whole]), edge_rows])
+
+def spatial_rows(df: pd.DataFrame, index: Dict, key: str, value, limit: Optional[int] = None) -> Optional[np.ndarray]:
+    """Sorted row positions matching one spatial filter, or None without a grid or past limit candidates per end"""
+    parts = []
+    for endpoint in SPATIAL_FILTERS[key]:
+        grid = index.get(f'{endpoint}_grid')
+        if grid is None:
+            return None
+        lat, lon = _column_values(df[f'{endpoint}_lat']), _column_values(df[f'{endpoint}_lon'])
+        rows = grid_query(grid, lat, lon, key, value, limit)
+        if rows is None:
+            return None
+        parts.append(rows)
+    # Each grid holds a row once; only the viewport's two ends can repeat one
+    rows = np.sort(np.concatenate(parts))
+    return rows if len(parts) == 1 else rows[np.append(True, rows[1:] != rows[:-1])]
+
+def time_window(df: pd.DataFrame, time_range) -> slice:
+    """Resolve a time_range to a row slice of a timestamp-sorted frame by binary search"""
+    timestamps = df['timestamp'].to_numpy()
+    start_time, end_time = time_range
+    start = np.searchsorted(timestamps, _datetime_bound(start_time, timestamps.dtype), side='left')
+    end = np.searchsorted(timestamps, _datetime_bound(end_time, timestamps.dtype), side='right')
+    return slice(int(start), int(max(start, end)))
+
+# Once this fraction of rows or fewer survive, remaining filters only look at the survivors
+SPARSE_FILTER_RATIO = 0.05
+
+def _datetime_bound(value, dtype: np.dtype) -> np.datetime64:
+    """Convert a time_range bound to a datetime64 comparable with a column of dtype"""
+    bound = pd.Timestamp(value).to_datetime64()
+    if not isinstance(dtype, np.dtype) or dtype.kind != 'M':
+        return bound
+    # Comparing in the column's own unit avoids upcasting the whole column on every call
+    cast = bound.astype(dtype)
+    return cast if cast == bound else bound
+
+def _range_test(low, high):
+    """Build a predicate testing `low <= values <= high`"""
+    def test(values: np.ndarray) -> np.ndarray:
+        result = values >= low
+        result &= values <= high
+        return result
+    return test
+
+def _bounds_test(bounds: Dict):
+    """Build a predicate testing (lat, lon) pairs against a bounding box"""
+    lat_test = _range_test(bounds['south'], bounds['north'])
+    lon_test = _range_test(bounds['west'], bounds['east'])
+    def test(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        result = lat_test(lat)
+        result &= lon_test(lon)
+        return result
+    return test
+
+def _isin_test(cities: List[str]):
+    """Build a predicate testing membership in a list of city names"""
+    def test(values) -> np.ndarray:
+        if isinstance(values, pd.Categorical):
+            # Look the integer codes up in a per-category table; code -1 hits the False tail
+            lookup = np.append(values.categories.isin(cities), False)
+            return lookup[values.codes]
+        return pd.Series(values, copy=False).isin(cities).to_numpy()
+    return test
+
+def _city_candidates(filters: Dict, index: Dict, window: slice) -> Tuple[Optional[np.ndarray], Dict]:
+    """Seed the filter from city posting lists when the selected cities are rare enough"""
+    candidates = None
+    remaining = dict(filters)
+    
+    for key, col in (('origin_cities', 'origin_city'), ('dest_cities', 'dest_city')):
+        postings = index.get(f'{col}_rows')
+        if not filters.get(key) or postings is None:
+            continue
+        
+        parts = []
+        for city in set(filters[key]):
+            rows = postings.get(city)
+            if rows is not None:
+                start, stop = np.searchsorted(rows, [window.start, window.stop])
+                parts.append(rows[start:stop])
+        
+        # Popular cities are cheaper to test with the dense code lookup
+        if sum(len(part) for part in parts) > (window.stop - window.start) * SPARSE_FILTER_RATIO:
+            continue
+        
+        rows = np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.intp)
+        candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+        del remaining[key]
+    
+    return candidates, remaining
+
+def _spatial_candidates(df: pd.DataFrame, filters: Dict, index: Dict, window: slice,
+                        candidates: Optional[np.ndarray]) -> Tuple[Optional[np.ndarray], Dict]:
+    """Narrow the candidates with the spatial grids when a box, circle or country filter is selective enough"""
+    shapes = [(key, key, filters[key]) for key in SPATIAL_FILTERS if filters.get(key)]
+    # Each destination country is a destination box
+    for name, bounds in (('mexico', MEXICO_BOUNDS), ('us', US_BOUNDS)):
+        if name in (filters.get('destinations') or []):
+            shapes.append(('destinations', 'dest_bbox', (bounds['south'], bounds['west'], bounds['north'], bounds['east'])))
+    
+    # Broad areas are cheaper to test with a column scan, like popular cities
+    limit = int((window.stop - window.start) * SPARSE_FILTER_RATIO)
+    handled = {}
+    for filter_key, key, value in shapes:
+        rows = spatial_rows(df, index, key, value, limit)
+        if rows is None:
+            handled[filter_key] = False
+            continue
+        rows = rows[np.searchsorted(rows, window.start):np.searchsorted(rows, window.stop)]
+        candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+        handled.setdefault(filter_key, True)
+    
+    # A filter only leaves the column scan when the grid answered all of it
+    return candidates, {key: value for key, value in filters.items() if not handled.get(key)}
+
+def _column_values(series: pd.Series):
+    """Return the backing array of a column without materializing Python objects"""
+    if isinstance(series.dtype, np.dtype):
+        return series.to_numpy()
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        # Nullable Int16 measurements: missing values compare False, just like NaN
+        return series.to_numpy(dtype='float32', na_value=np.nan)
+    return series.array
+
+def compile_filters(df: pd.DataFrame, filters: Dict) -> List[Tuple[List[str], Callable]]:
+    """Translate the filters dict into (columns, predicate) pairs, cheapest first"""
+    predicates = []
     
     if filters.get('time_range'):
         start_time, end_time = filters['time_range']
-        filtered_df = filtered_df[
-            (filtered_df['timestamp'] >= start_time) & 
-            (filtered_df['timestamp'] <= end_time)
-        ]
+        dtype = df['timestamp'].dtype
+        predicates.append((['timestamp'], _range_test(
+            _datetime_bound(start_time, dtype), _datetime_bound(end_time, dtype)
+        )))
     
     if filters.get('altitude_range'):
         min_alt, max_alt = filters['altitude_range']
-        filtered_df = filtered_df[
-            (filtered_df['altitude_ft'] >= min_alt) & 
-            (filtered_df['altitude_ft'] <= max_alt)
-        ]
+        predicates.append((['altitude_ft'], _range_test(min_alt, max_alt)))
     
     if filters.get('speed_range'):
         min_speed, max_speed = filters['speed_range']
-        filtered_df = filtered_df[
-            (filtered_df['speed_kts'] >= min_speed) & 
-            (filtered_df['speed_kts'] <= max_speed)
-        ]
+        predicates.append((['speed_kts'], _range_test(min_speed, max_speed)))
     
+    # Each selected country narrows the result, exactly like the chained masks did
     if filters.get('destinations'):
         if 'mexico' in filters['destinations']:
-            filtered_df = filtered_df[
-                (filtered_df['dest_lat'] >= MEXICO_BOUNDS['south']) &
-                (filtered_df['dest_lat'] <= MEXICO_BOUNDS['north']) &
-                (filtered_df['dest_lon'] >= MEXICO_BOUNDS['west']) &
-                (filtered_df['dest_lon'] <= MEXICO_BOUNDS['east'])
-            ]
+            predicates.append((['dest_lat', 'dest_lon'], _bounds_test(MEXICO_BOUNDS)))
         if 'us' in filters['destinations']:
-            filtered_df = filtered_df[
-                (filtered_df['dest_lat'] >= US_BOUNDS['south']) &
-                (filtered_df['dest_lat'] <= US_BOUNDS['north']) &
-                (filtered_df['dest_lon'] >= US_BOUNDS['west']) &
-                (filtered_df['dest_lon'] <= US_BOUNDS['east'])
-            ]
+            predicates.append((['dest_lat', 'dest_lon'], _bounds_test(US_BOUNDS)))
     
+    # Boxes and circles around flight ends; the viewport keeps flights with either end inside
+    for key, endpoints in SPATIAL_FILTERS.items():
+        if filters.get(key):
+            test = spatial_shape(key, filters[key])[1]
+            columns = [f'{endpoint}_{axis}' for endpoint in endpoints for axis in ('lat', 'lon')]
+            if len(endpoints) > 1:
+                test = lambda origin_lat, origin_lon, dest_lat, dest_lon, test=test: (
+                    test(origin_lat, origin_lon) | test(dest_lat, dest_lon)
+                )
+            predicates.append((columns, test))
+    
+    # String membership is the most expensive test, so it runs last on the fewest rows
     if filters.get('origin_cities'):
-        filtered_df = filtered_df[filtered_df['origin_city'].isin(filters['origin_cities'])]
+        predicates.append((['origin_city'], _isin_test(filters['origin_cities'])))
     
     if filters.get('dest_cities'):
-        filtered_df = filtered_df[filtered_df['dest_city'].isin(filters['dest_cities'])]
+        predicates.append((['dest_city'], _isin_test(filters['dest_cities'])))
+    
+    return predicates
+
+def filter_positions(df: pd.DataFrame, filters: Dict, index: Optional[Dict] = None) -> np.ndarray:
+    """Return the sorted row positions of df that satisfy all filters, a filters dict or a FilterPlan"""
+    if isinstance(filters, FilterPlan):
+        filters = filters.filters()
+    window = slice(0, len(df))
+    if index and index.get('time_sorted') and filters.get('time_range'):
+        # O(log n) time filtering: only rows inside the window are ever scanned
+        window = time_window(df, filters['time_range'])
+        filters = {key: value for key, value in filters.items() if key != 'time_range'}
+    
+    # Selective city and area filters become posting-list and grid lookups instead of column scans
+    positions = None
+    if index:
+        positions, filters = _city_candidates(filters, index, window)
+        positions, filters = _spatial_candidates(df, filters, index, window, positions)
+    
+    n_rows = window.stop - window.start
+    mask = np.ones(n_rows, dtype=bool) if positions is None else None
+    
+    for columns, test in compile_filters(df, filters):
+        arrays = [_column_values(df[col]) for col in columns]
+        if positions is None:
+            # Dense phase: fold the predicate into one shared mask, no frame copies
+            mask &= test(*[values[window] for values in arrays])
+            if np.count_nonzero(mask) <= n_rows * SPARSE_FILTER_RATIO:
+                positions = np.flatnonzero(mask) + window.start
+        else:
+            # Sparse phase: only gather and test the rows that are still alive
+            positions = positions[test(*[values[positions] for values in arrays])]
+    
+    if positions is None:
+        positions = np.flatnonzero(mask) + window.start
+    return positions
+
+def apply_filters(df: pd.DataFrame, filters: Dict, index: Optional[Dict] = None) -> pd.DataFrame:
+    """Apply filters to the dataframe"""
+    positions = filter_positions(df, filters, index)
+    
+    # A contiguous run of rows (e.g. a pure time window) is returned as a slice
+    if len(positions) and positions[-1] - positions[0] + 1 == len(positions):
+        selection = df.iloc[positions[0]:positions[-1] + 1]
+    else:
+        # Otherwise materialize the matching rows once instead of re-indexing per filter
+        selection = df.take(positions)
+    
+    # Selections are session-private; only the full shared frame carries its store key
+    selection.attrs.pop('dataset_key', None)
+    return selection
+
+def filter_signature(filters: Dict) -> str:
+    """Stable short hash of a filter dict or FilterPlan; equal filters hash equal across reruns and sessions"""
+    if isinstance(filters, FilterPlan):
+        filters = filters.filters()
+    canonical = json.dumps(filters, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+def selection_key(df: pd.DataFrame, filters: Dict) -> Optional[str]:
+    """Identifies the selection filters make from a loaded dataset, for caching derived results;
+    None for a frame outside the shared store, whose derived results are not cached"""
+    key = df.attrs.get('dataset_key')
+    return f"{key}:{filter_signature(filters)}" if key else None
+
+# Filter plans
+# Filters from chat answers are checked against the schema below and compiled once into a
+# FilterPlan: coerced, hashable values with city names snapped to the dataset's own spelling.
+# A plan that doesn't fit is rejected before any rows are scanned.
+PLAN_RANGES = ['altitude_range', 'speed_range']
+PLAN_CITIES = {'origin_cities': 'origin_city', 'dest_cities': 'dest_city'}
+PLAN_COUNTRIES = {
+    'mexico': 'mexico', 'mx': 'mexico',
+    'us': 'us', 'usa': 'us', 'u s': 'us', 'u s a': 'us', 'united states': 'us', 'america': 'us'
+}
+# difflib similarity needed to snap a misspelled city to a known one
+CITY_MATCH_CUTOFF = 0.8
+
+class FilterPlan(NamedTuple):
+    """Validated chat filters with coerced types; equal plans hash and sign equal"""
+    time_range: Optional[Tuple[pd.Timestamp, pd.Timestamp]] = None
+    altitude_range: Optional[Tuple[float, float]] = None
+    speed_range: Optional[Tuple[float, float]] = None
+    destinations: Tuple[str, ...] = ()
+    origin_cities: Tuple[str, ...] = ()
+    dest_cities: Tuple[str, ...] = ()
+    origin_bbox: Optional[Tuple[float, float, float, float]] = None
+    dest_bbox: Optional[Tuple[float, float, float, float]] = None
+    viewport: Optional[Tuple[float, float, float, float]] = None
+    origin_radius: Optional[Tuple[float, float, float]] = None
+    dest_radius: Optional[Tuple[float, float, float]] = None
+    
+    def filters(self) -> Dict:
+        """The plan as a filters dict, without the filters it leaves unset"""
+        return {key: list(value) for key, value in self._asdict().items() if value}
+
+def _fold_name(name: str) -> str:
+    """Case-, accent- and punctuation-insensitive form of a name"""
+    name = ''.join(c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'[^\W_]+', name.casefold()))
+
+def _plan_names(value, key: str) -> List[str]:
+    """A name list from a filter value; a single name counts as a list of one"""
+    names = [value] if isinstance(value, str) else value
+    if not isinstance(names, (list, tuple)) or not all(isinstance(name, str) for name in names):
+        raise ValueError(f"{key} must be a list of names, got {value!r}")
+    return [name for name in names if name.strip()]
+
+def _plan_pair(value, key: str) -> list:
+    """The two bounds of a range filter"""
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        raise ValueError(f"{key} must be a [low, high] pair, got {value!r}")
+    return list(value)
+
+def _plan_number(value, key: str) -> Optional[float]:
+    """A range bound as a float; numbers written as text may carry thousands separators and units"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool) and np.isfinite(value):
+        return float(value)
+    if isinstance(value, str):
+        match = re.fullmatch(r'\s*(-?\d+(?:,\d{3})*(?:\.\d+)?)\s*' + _UNIT + r'\s*', value.casefold())
+        if match:
+            return float(match.group(1).replace(',', ''))
+    raise ValueError(f"{key} bound is not a number: {value!r}")
+
+def _plan_time(value, key: str) -> Optional[pd.Timestamp]:
+    """A time_range bound as a naive UTC timestamp"""
+    if value is None or value == '':
+        return None
+    try:
+        timestamp = pd.Timestamp(value)
+    except (ValueError, TypeError):
+        raise ValueError(f"{key} bound is not a date and time: {value!r}") from None
+    if pd.isna(timestamp):
+        raise ValueError(f"{key} bound is not a date and time: {value!r}")
+    return timestamp.tz_convert(None) if timestamp.tz is not None else timestamp
+
+def _plan_area(value, key: str) -> Tuple[float, ...]:
+    """A box [south, west, north, east] or circle [lat, lon, km] on the globe"""
+    circle = key.endswith('_radius')
+    if not isinstance(value, (list, tuple)) or len(value) != (3 if circle else 4):
+        shape = "[lat, lon, km]" if circle else "[south, west, north, east]"
+        raise ValueError(f"{key} must be {shape}, got {value!r}")
+    numbers = tuple(_plan_number(number, key) for number in value)
+    if None in numbers:
+        raise ValueError(f"{key} needs every value, got {value!r}")
+    if circle:
+        (lat, lon, km), lats, lons = numbers, numbers[:1], numbers[1:2]
+        if km <= 0:
+            raise ValueError(f"{key} radius must be positive, got {km:g}")
+    else:
+        (south, west, north, east), lats, lons = numbers, numbers[0::2], numbers[1::2]
+        if south > north or west > east:
+            raise ValueError(f"{key} is empty or crosses the antimeridian: {list(numbers)}")
+    if any(abs(lat) > 90 for lat in lats) or any(abs(lon) > 180 for lon in lons):
+        raise ValueError(f"{key} is off the globe: {list(numbers)}")
+    return numbers
+
+def fold_cities(vocabulary: List[str]) -> Tuple[set, Dict[str, str]]:
+    """The known city names, and a map from the folded form of each to the name"""
+    folded = {}
+    for city in vocabulary:
+        folded.setdefault(_fold_name(city), city)
+    return set(vocabulary), folded
+
+def snap_cities(names: List[str], cities: Tuple[set, Dict[str, str]], key: str) -> Tuple[str, ...]:
+    """Known city names for names: exact, case/accent-insensitive, then the closest difflib match"""
+    known, folded = cities
+    snapped, unknown = set(), []
+    for name in names:
+        match = name if name in known else folded.get(_fold_name(name))
+        if match is None:
+            close = difflib.get_close_matches(_fold_name(name), folded, n=1, cutoff=CITY_MATCH_CUTOFF)
+            match = folded[close[0]] if close else None
+        if match is None:
+            unknown.append(name)
+        else:
+            snapped.add(match)
+    if unknown:
+        raise ValueError(f"{key} not in the dataset: {', '.join(unknown)}")
+    return tuple(sorted(snapped))
+
+def compile_filter_plan(filters: Dict, index: Dict) -> FilterPlan:
+    """Validate a chat filters block against the schema and the dataset index, raising ValueError if it doesn't fit"""
+    if not isinstance(filters, dict):
+        raise ValueError(f"filters must be an object, got {filters!r}")
+    unknown = sorted(set(filters) - set(FilterPlan._fields))
+    if unknown:
+        raise ValueError(f"Unknown filters: {', '.join(unknown)}")
+    plan = {}
+    
+    if filters.get('time_range'):
+        # An open end falls back to the dataset's own first or last flight
+        start, end = (_plan_time(value, 'time_range') for value in _plan_pair(filters['time_range'], 'time_range'))
+        start = start if start is not None else index.get('time_min')
+        end = end if end is not None else index.get('time_max')
+        if start is None or end is None:
+            raise ValueError("time_range needs a start and an end")
+        if start > end:
+            raise ValueError(f"time_range starts after it ends: {start} > {end}")
+        plan['time_range'] = (start, end)
+    
+    for key in PLAN_RANGES:
+        if filters.get(key):
+            low, high = (_plan_number(value, key) for value in _plan_pair(filters[key], key))
+            low = float(OPEN_RANGE[0]) if low is None else low
+            high = float(OPEN_RANGE[1]) if high is None else high
+            if low > high:
+                raise ValueError(f"{key} is empty: {low:g} > {high:g}")
+            plan[key] = (low, high)
+    
+    if filters.get('destinations'):
+        names = _plan_names(filters['destinations'], 'destinations')
+        countries = [PLAN_COUNTRIES.get(_fold_name(name)) for name in names]
+        if None in countries:
+            raise ValueError(f"Unknown destinations: {', '.join(n for n, c in zip(names, countries) if c is None)}")
+        plan['destinations'] = tuple(sorted(set(countries)))
+    
+    for key in SPATIAL_FILTERS:
+        if filters.get(key):
+            plan[key] = _plan_area(filters[key], key)
+    
+    for key, col in PLAN_CITIES.items():
+        if filters.get(key):
+            # Folded once per dataset by build_data_index
+            cities = index.get(f'{col}_folded') or fold_cities(index.get(f'{col}_options', []))
+            plan[key] = snap_cities(_plan_names(filters[key], key), cities, key)
+    
+    return FilterPlan(**plan)
+
+# Sampling
+# Rows drawn per selection for layers that show individual flights
+MAP_SAMPLE_ROWS = 100_000
+# Markers are sent again on every filter change, so they take a smaller stratified prefix
+MARKER_SAMPLE_ROWS = 10_000
+SAMPLE_TIME_BUCKET = 'D'
+MAP_SAMPLES = 16
+
+def _city_codes(cities: pd.Series) -> np.ndarray:
+    """Category codes of a city column, shifted so missing cities get code 0"""
+    cities = cities if isinstance(cities.dtype, pd.CategoricalDtype) else cities.astype('category')
+    return cities.cat.codes.to_numpy().astype(np.int64) + 1
+
+def _group_keys(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Distinct non-negative integer keys in ascending order, and each key's group number"""
+    if keys.max() < 4 * len(keys):
+        # Small key space: number the groups with a counting pass instead of a sort
+        present = np.bincount(keys) > 0
+        return np.flatnonzero(present), (np.cumsum(present) - 1)[keys]
+    unique, groups = np.unique(keys, return_inverse=True)
+    return unique, groups.ravel()
+
+def stratified_sample(df: pd.DataFrame, n: int = MAP_SAMPLE_ROWS, bucket: str = SAMPLE_TIME_BUCKET) -> np.ndarray:
+    """Positions of up to n rows stratified by route and time bucket, ordered so every prefix is stratified too"""
+    if df.empty:
+        return np.empty(0, dtype=np.int64)
+    
+    # Strata: origin city x destination city x time bucket
+    origin, dest = _city_codes(df['origin_city']), _city_codes(df['dest_city'])
+    timestamps = df['timestamp'].to_numpy()
+    present = ~np.isnat(timestamps)
+    buckets = timestamps.astype(f'datetime64[{bucket}]').astype(np.int64)
+    # Missing timestamps share one bucket after the last, as in _day_bands
+    buckets -= buckets[present].min() if present.any() else buckets.min()
+    buckets[~present] = buckets[present].max() + 1 if present.any() else 0
+    strata = (origin * (dest.max() + 1) + dest) * (buckets.max() + 1) + buckets
+    strata = _group_keys(strata)[1]
+    counts = np.bincount(strata)
+    
+    # Proportional quotas, but every stratum keeps at least one row so rare crossings show up
+    if len(df) > n:
+        quota = np.minimum(counts, np.maximum(1, np.round(counts * n / len(df)))).astype(np.int64)
+    else:
+        quota = counts
+    
+    # A hash of the row label, not its position, so a flight keeps its priority under any filter.
+    # Keeping rows whose hash falls under their stratum's quota share is a sort-free draw.
+    priority = pd.util.hash_array(df.index.to_numpy())
+    keep = priority / 2.0 ** 64 < (quota / counts)[strata]
+    # A small stratum can draw nothing; it gets its lowest-priority row instead
+    empty = np.bincount(strata[keep], minlength=len(counts)) == 0
+    if empty.any():
+        rows = np.flatnonzero(empty[strata])
+        first = rows[np.lexsort((priority[rows], strata[rows]))]
+        keep[first[np.r_[True, strata[first][1:] != strata[first][:-1]]]] = True
+    
+    # Rank the kept rows within their stratum by priority, packed into one 64-bit sort key
+    kept = np.flatnonzero(keep)
+    high = priority[kept] >> np.uint64(32)
+    kept = kept[np.argsort((strata[kept].astype(np.uint64) << np.uint64(32)) | high)]
+    kept_counts = np.bincount(strata[kept], minlength=len(counts))
+    starts = np.concatenate([[0], np.cumsum(kept_counts)[:-1]])
+    rank = np.arange(len(kept)) - starts[strata[kept]]
+    
+    # Interleave strata by how far through their draw each row is: the first row of every
+    # stratum comes before any stratum's second, so any prefix of the sample is stratified too
+    progress = (rank / kept_counts[strata[kept]] * 2.0 ** 32).astype(np.uint64)
+    return kept[np.argsort((progress << np.uint64(32)) | (priority[kept] >> np.uint64(32)))][:n]
+
+@st.cache_resource(max_entries=MAP_SAMPLES)
+def _shared_sample(key: str, n: int, _df: pd.DataFrame) -> np.ndarray:
+    """Sample of a selection, drawn once and reused by every layer and session"""
+    return stratified_sample(_df, n)
+
+def map_sample(df: pd.DataFrame, key: Optional[str] = None, n: int = MAP_SAMPLE_ROWS) -> np.ndarray:
+    """Stratified sample positions of a filtered frame, cached under its selection key"""
+    return _shared_sample(key, n, df) if key else stratified_sample(df, n)
+
+# Map layers
+# Coordinates are sent to the browser with ~10 m precision
+MAP_COORD_DECIMALS = 4
+
+def _json_safe(text: str) -> str:
+    """Escape JSON so it can be inlined in a <script> block"""
+    return text.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
+def _json_column(series: pd.Series) -> list:
+    """Measurement column rounded to whole numbers as a JSON-ready list, null when missing"""
+    values = pd.Series(np.round(series.to_numpy(dtype='float64', na_value=np.nan))).astype('Int64')
+    return values.astype(object).where(values.notna(), None).tolist()
+
+def _city_table(cities: pd.Series) -> Tuple[list, list]:
+    """Dictionary-encode a city column as (names, codes) with -1 for missing"""
+    cities = cities if isinstance(cities.dtype, pd.CategoricalDtype) else cities.astype('category')
+    return cities.cat.categories.tolist(), cities.cat.codes.tolist()
+
+# Shared by the layer templates: HTML-escape a popup value, 'n/a' when missing
+POPUP_ESCAPE_JS = """
+                function escape(value) {
+                    var node = document.createElement('span');
+                    node.textContent = value === null || value === undefined ? 'n/a' : value;
+                    return node.innerHTML;
+                }"""
+
+class _RenderedScript(Element):
+    """Script text emitted as-is"""
+    
+    def __init__(self, text: str):
+        super().__init__()
+        self.text = text
+    
+    def render(self, **kwargs) -> str:
+        return self.text
+
+class InlinePayloadMixin:
+    """Adds the layer script without recompiling it, since branca parses every rendered script as a Jinja template"""
+    
+    _no_script = Template("")
+    
+    def render(self, **kwargs):
+        script = self._template.module.script(self, kwargs)
+        self.get_root().script.add_child(_RenderedScript(script), name=self.get_name())
+        template, self._template = self._template, self._no_script
+        try:
+            super().render(**kwargs)
+        finally:
+            self._template = template
+
+class FlowLinesLayer(InlinePayloadMixin, Layer):
+    """All flows as one canvas multi-polyline; popups look up a shared attribute table"""
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var data = {{ this.payload }};
+                var coords = data.coords;
+                var lines = new Array(coords.length / 4);
+                for (var i = 0; i < lines.length; i++) {
+                    lines[i] = [[coords[4 * i], coords[4 * i + 1]], [coords[4 * i + 2], coords[4 * i + 3]]];
+                }
+                var layer = L.polyline(lines, Object.assign({{ this.options }}, {renderer: L.canvas()}));
+                
+                """ + POPUP_ESCAPE_JS + """
+                function city(names, code) {
+                    return escape(code < 0 ? null : names[code]);
+                }
+                
+                layer.on('click', function(e) {
+                    // The clicked flow is the segment nearest the cursor on screen
+                    var map = layer._map;
+                    var point = map.latLngToLayerPoint(e.latlng);
+                    var best = 0, bestDistance = Infinity;
+                    for (var i = 0; i < lines.length; i++) {
+                        var distance = L.LineUtil.pointToSegmentDistance(
+                            point,
+                            map.latLngToLayerPoint(lines[i][0]),
+                            map.latLngToLayerPoint(lines[i][1])
+                        );
+                        if (distance < bestDistance) {
+                            best = i;
+                            bestDistance = distance;
+                        }
+                    }
+                    L.popup().setLatLng(e.latlng).setContent(
+                        'Flight: ' + escape(data.flight_id[best]) + '<br>' +
+                        'From: ' + city(data.origin_cities, data.origin[best]) + '<br>' +
+                        'To: ' + city(data.dest_cities, data.dest[best]) + '<br>' +
+                        'Altitude: ' + escape(data.altitude[best]) + ' ft<br>' +
+                        'Speed: ' + escape(data.speed[best]) + ' kts'
+                    ).openOn(map);
+                });
+                return layer;
+            })();
+        {% endmacro %}
+    """)
+    
+    def __init__(self, df: pd.DataFrame, name: Optional[str] = None, color: str = 'red',
+                 weight: int = 2, opacity: float = 0.6, overlay: bool = True,
+                 control: bool = True, show: bool = True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'FlowLines'
+        
+        coords = np.column_stack([df[col].to_numpy(dtype='float64') for col in COORD_COLUMNS])
+        origin_cities, origin = _city_table(df['origin_city'])
+        dest_cities, dest = _city_table(df['dest_city'])
+        self.payload = _json_safe(json.dumps({
+            'coords': np.round(coords, MAP_COORD_DECIMALS).ravel().tolist(),
+            'flight_id': df['flight_id'].astype(object).where(df['flight_id'].notna(), None).tolist(),
+            'origin_cities': origin_cities,
+            'origin': origin,
+            'dest_cities': dest_cities,
+            'dest': dest,
+            'altitude': _json_column(df['altitude_ft']),
+            'speed': _json_column(df['speed_kts']),
+        }, separators=(',', ':')))
+        self.options = json.dumps({'color': color, 'weight': weight, 'opacity': opacity})
+
+# Heatmap destinations are pre-binned into ~1 km cells, coarsened so the grid stays bounded
+HEATMAP_CELL_DEG = 0.01
+HEATMAP_MAX_CELLS = 4_000_000
+
+def bin_destinations(df: pd.DataFrame, cell_deg: float = HEATMAP_CELL_DEG) -> np.ndarray:
+    """Sum altitude weight per grid cell of destinations; returns (lat, lon, weight) of non-empty cells"""
+    lat = df['dest_lat'].to_numpy(dtype='float64')
+    lon = df['dest_lon'].to_numpy(dtype='float64')
+    weight = np.nan_to_num(_column_values(df['altitude_ft']).astype('float64'))
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    if not valid.all():
+        lat, lon, weight = lat[valid], lon[valid], weight[valid]
+    if len(lat) == 0:
+        return np.empty((0, 3))
+    
+    lat0, lon0 = lat.min(), lon.min()
+    extent = (lat.max() - lat0) * (lon.max() - lon0)
+    # A few far-off points must not blow the grid up to billions of cells
+    cell_deg = max(cell_deg, np.sqrt(extent / HEATMAP_MAX_CELLS))
+    rows = ((lat - lat0) / cell_deg).astype(np.int64)
+    cols = ((lon - lon0) / cell_deg).astype(np.int64)
+    n_cols = cols.max() + 1
+    
+    # A flat bincount over cell ids is an O(n) 2-D histogram
+    sums = np.bincount(rows * n_cols + cols, weights=weight)
+    cells = np.flatnonzero(sums)
+    return np.column_stack([
+        lat0 + (cells // n_cols + 0.5) * cell_deg,
+        lon0 + (cells % n_cols + 0.5) * cell_deg,
+        sums[cells],
+    ])
+
+# Coordinate-pair routes snap both ends to a ~1 km grid
+ROUTE_SNAP_DECIMALS = 2
+
+def _mean_by_key(keys: np.ndarray, values: np.ndarray, present: np.ndarray) -> np.ndarray:
+    """Mean of values per key present, skipping NaN like groupby mean"""
+    valid = ~np.isnan(values)
+    sums = np.bincount(keys, weights=np.where(valid, values, 0.0))[present]
+    counts = np.bincount(keys, weights=valid)[present]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+def _aggregate_city_routes(df: pd.DataFrame) -> pd.DataFrame:
+    """aggregate_routes by city pair for categorical cities, via bincount over pair codes"""
+    origin, dest = _city_codes(df['origin_city']), _city_codes(df['dest_city'])
+    width = len(df['dest_city'].cat.categories) + 1
+    keys = origin * width + dest
+    flights = np.bincount(keys)
+    present = np.flatnonzero(flights)
+    
+    routes = pd.DataFrame({
+        'origin_city': pd.Categorical.from_codes(present // width - 1, dtype=df['origin_city'].dtype),
+        'dest_city': pd.Categorical.from_codes(present % width - 1, dtype=df['dest_city'].dtype),
+        'flights': flights[present],
+        'avg_altitude': _mean_by_key(keys, _column_values(df['altitude_ft']).astype('float64'), present),
+        'avg_speed': _mean_by_key(keys, _column_values(df['speed_kts']).astype('float64'), present),
+    })
+    for col in COORD_COLUMNS:
+        routes[col] = _mean_by_key(keys, df[col].to_numpy(dtype='float64'), present)
+    return routes.sort_values('flights', kind='stable', ignore_index=True)
+
+def aggregate_routes(df: pd.DataFrame, by: str = 'city', decimals: int = ROUTE_SNAP_DECIMALS) -> pd.DataFrame:
+    """One row per origin-destination route with flight count and mean position, altitude and speed"""
+    if by == 'city' and all(isinstance(df[col].dtype, pd.CategoricalDtype) for col in CITY_COLUMNS):
+        return _aggregate_city_routes(df)
+    
+    measures = {
+        'flights': ('origin_lat', 'size'),
+        'avg_altitude': ('altitude_ft', 'mean'),
+        'avg_speed': ('speed_kts', 'mean'),
+    }
+    if by == 'city':
+        # Route ends sit at the mean position of the flights between the two cities
+        keys = CITY_COLUMNS
+        measures.update({col: (col, 'mean') for col in COORD_COLUMNS})
+    elif by == 'coords':
+        keys = COORD_COLUMNS
+        df = df.assign(**{col: df[col].round(decimals) for col in COORD_COLUMNS})
+        measures.update({col: (col, 'first') for col in CITY_COLUMNS})
+    else:
+        raise ValueError(f"Unknown route grouping: {by}")
+    
+    # dropna=False keeps flights with a missing city, so every flight is in some route
+    routes = df.groupby(keys, observed=True, dropna=False, sort=False).agg(**measures).reset_index()
+    # Heaviest routes last so they draw on top
+    return routes.sort_values('flights', kind='stable', ignore_index=True)
+
+class RouteEdgesLayer(InlinePayloadMixin, Layer):
+    """One polyline per aggregated route, weighted by its flight count"""
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var data = {{ this.payload }};
+                var layer = L.featureGroup();
+                var renderer = L.canvas();
+                """ + POPUP_ESCAPE_JS + """
+                
+                data.flights.forEach(function(flights, i) {
+                    var c = data.coords.slice(4 * i, 4 * i + 4);
+                    L.polyline([[c[0], c[1]], [c[2], c[3]]], Object.assign(
+                        {{ this.options }}, {weight: data.weight[i], renderer: renderer}
+                    )).bindPopup(function() {
+                        return 'Route: ' + escape(data.origin[i]) + ' → ' + escape(data.dest[i]) + '<br>' +
+                               'Flights: ' + flights.toLocaleString() + '<br>' +
+                               'Avg Altitude: ' + escape(data.altitude[i]) + ' ft<br>' +
+                               'Avg Speed: ' + escape(data.speed[i]) + ' kts';
+                    }).addTo(layer);
+                });
+                return layer;
+            })();
+        {% endmacro %}
+    """)
+    
+    def __init__(self, routes: pd.DataFrame, name: Optional[str] = None, color: str = 'red',
+                 min_weight: float = 1.0, max_weight: float = 12.0, opacity: float = 0.6,
+                 overlay: bool = True, control: bool = True, show: bool = True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'RouteEdges'
+        
+        # Line area, not width, tracks traffic so a few busy routes don't swamp the rest
+        share = np.sqrt(routes['flights'].to_numpy() / max(routes['flights'].max(), 1))
+        coords = np.column_stack([routes[col].to_numpy(dtype='float64') for col in COORD_COLUMNS])
+        self.payload = _json_safe(json.dumps({
+            'coords': np.round(coords, MAP_COORD_DECIMALS).ravel().tolist(),
+            'flights': routes['flights'].astype(int).tolist(),
+            'weight': np.round(min_weight + (max_weight - min_weight) * share, 1).tolist(),
+            'origin': routes['origin_city'].astype(object).where(routes['origin_city'].notna(), None).tolist(),
+            'dest': routes['dest_city'].astype(object).where(routes['dest_city'].notna(), None).tolist(),
+            'altitude': _json_column(routes['avg_altitude']),
+            'speed': _json_column(routes['avg_speed']),
+        }, separators=(',', ':')))
+        self.options = json.dumps({'color': color, 'opacity': opacity})
+
+# Zoom-aware tile pyramid: per-zoom aggregates served to the browser tile by tile
+TILE_MIN_ZOOM = 3
+TILE_MAX_ZOOM = 13
+# Each tile is split into 2**TILE_BIN_BITS x 2**TILE_BIN_BITS density cells (8 px at 256 px tiles)
+TILE_BIN_BITS = 5
+TILE_PYRAMIDS = 8
+TILE_SERVER_HOST = os.getenv('TILE_SERVER_HOST', '127.0.0.1')
+TILE_SERVER_PORT = int(os.getenv('TILE_SERVER_PORT', '0'))
+# Public base URL of the tile server when the browser can't reach it at host:port
+TILE_SERVER_URL = os.getenv('TILE_SERVER_URL', '')
+
+def _mercator_cells(lat: np.ndarray, lon: np.ndarray, bits: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Integer Web Mercator cell coordinates on a 2**bits x 2**bits grid"""
+    lat = np.radians(np.clip(np.asarray(lat, dtype='float64'), -85.0511, 85.0511))
+    x = (np.asarray(lon, dtype='float64') + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0
+    size = 1 << bits
+    return (
+        np.clip((x * size).astype(np.int64), 0, size - 1),
+        np.clip((y * size).astype(np.int64), 0, size - 1),
+    )
+
+def _aggregate(keys: np.ndarray, columns: Dict[str, Optional[np.ndarray]]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Sum columns per distinct key; a None column counts rows"""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, {
+        name: np.bincount(inverse, weights=values, minlength=len(unique))
+        for name, values in columns.items()
+    }
+
+def _parent_tiles(tiles: np.ndarray, z: int) -> np.ndarray:
+    """Keys of the zoom z - 1 tiles containing the given zoom z tile keys"""
+    x, y = tiles & ((1 << z) - 1), tiles >> z
+    return ((y >> 1) << (z - 1)) | (x >> 1)
+
+def _tile_lookup(tile_keys: np.ndarray) -> Dict[str, np.ndarray]:
+    """Sort order and sorted keys for finding every row of one tile with searchsorted"""
+    order = np.argsort(tile_keys, kind='stable')
+    return {'order': order, 'keys': tile_keys[order]}
+
+def build_tile_pyramid(df: pd.DataFrame, min_zoom: int = TILE_MIN_ZOOM, max_zoom: int = TILE_MAX_ZOOM) -> Dict[int, Dict]:
+    """Destination density cells and OD routes aggregated for every zoom level"""
+    finest = max_zoom + TILE_BIN_BITS
+    dest_x, dest_y = _mercator_cells(df['dest_lat'], df['dest_lon'], finest)
+    origin_x, origin_y = _mercator_cells(df['origin_lat'], df['origin_lon'], max_zoom)
+    altitude = np.nan_to_num(_column_values(df['altitude_ft']).astype('float64'))
+    coords = {col: df[col].to_numpy(dtype='float64') for col in COORD_COLUMNS}
+    
+    # The raw rows are aggregated once at the finest level; coarser levels merge those sums
+    cells, cell_sums = _aggregate((dest_y << finest) | dest_x, {
+        'count': None, 'weight': altitude, 'lat': coords['dest_lat'], 'lon': coords['dest_lon'],
+    })
+    dest_tile = ((dest_y >> TILE_BIN_BITS) << max_zoom) | (dest_x >> TILE_BIN_BITS)
+    routes, route_sums = _aggregate((((origin_y << max_zoom) | origin_x) << 2 * max_zoom) | dest_tile, {
+        'count': None, **{col: values for col, values in coords.items()},
+    })
+    
+    pyramid = {}
+    for z in range(max_zoom, min_zoom - 1, -1):
+        if z < max_zoom:
+            # Halve the grid: drop the lowest bit of every coordinate and merge
+            bits = z + 1 + TILE_BIN_BITS
+            cell_x, cell_y = cells & ((1 << bits) - 1), cells >> bits
+            cells, cell_sums = _aggregate(((cell_y >> 1) << (bits - 1)) | (cell_x >> 1), cell_sums)
+            
+            origin, dest = routes >> 2 * (z + 1), routes & ((1 << 2 * (z + 1)) - 1)
+            routes, route_sums = _aggregate(
+                (_parent_tiles(origin, z + 1) << 2 * z) | _parent_tiles(dest, z + 1), route_sums
+            )
+        
+        bits = z + TILE_BIN_BITS
+        cell_x, cell_y = cells & ((1 << bits) - 1), cells >> bits
+        pyramid[z] = {
+            'cells': cells,
+            'cell_sums': cell_sums,
+            'cell_tiles': _tile_lookup(((cell_y >> TILE_BIN_BITS) << z) | (cell_x >> TILE_BIN_BITS)),
+            'routes': routes,
+            'route_sums': route_sums,
+            'origin_tiles': _tile_lookup(routes >> 2 * z),
+            'dest_tiles': _tile_lookup(routes & ((1 << 2 * z) - 1)),
+        }
+    return pyramid
+
+def _rows_in_tile(lookup: Dict[str, np.ndarray], tile: int) -> np.ndarray:
+    """Positions of the rows that fall in one tile"""
+    keys = lookup['keys']
+    return lookup['order'][np.searchsorted(keys, tile, 'left'):np.searchsorted(keys, tile, 'right')]
+
+def pyramid_tile(pyramid: Dict[int, Dict], z: int, x: int, y: int) -> Dict:
+    """JSON payload of one tile: density cells and the routes starting or ending in it"""
+    level = pyramid.get(z)
+    if level is None or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        return {'cells': [], 'routes': []}
+    tile = (y << z) | x
+    
+    rows = _rows_in_tile(level['cell_tiles'], tile)
+    sums = {name: values[rows] for name, values in level['cell_sums'].items()}
+    cells = np.column_stack([
+        np.round(sums['lat'] / sums['count'], MAP_COORD_DECIMALS),
+        np.round(sums['lon'] / sums['count'], MAP_COORD_DECIMALS),
+        sums['count'],
+        np.round(sums['weight']),
+    ])
+    
+    # A route is in both its end tiles; the browser de-duplicates by route id
+    rows = np.union1d(_rows_in_tile(level['origin_tiles'], tile), _rows_in_tile(level['dest_tiles'], tile))
+    sums = {name: values[rows] for name, values in level['route_sums'].items()}
+    ends = np.column_stack([sums[col] / sums['count'] for col in COORD_COLUMNS])
+    return {
+        'cells': cells.tolist(),
+        'routes': [
+            [route_id, *end, count]
+            for route_id, end, count in zip(
+                level['routes'][rows].tolist(),
+                np.round(ends, MAP_COORD_DECIMALS).tolist(),
+                sums['count'].astype(int).tolist()
+            )
+        ],
+    }
+
+class _TileRequestHandler(BaseHTTPRequestHandler):
+    """GET /tiles/<pyramid>/<z>/<x>/<y>.json"""
+    
+    def do_GET(self):
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        try:
+            if len(parts) != 5 or parts[0] != 'tiles' or not parts[4].endswith('.json'):
+                raise ValueError(self.path)
+            pyramid = self.server.tile_server.pyramid(parts[1])
+            z, x, y = int(parts[2]), int(parts[3]), int(parts[4][:-len('.json')])
+        except (ValueError, KeyError):
+            self.send_error(404)
+            return
+        
+        body = json.dumps(pyramid_tile(pyramid, z, x, y), separators=(',', ':')).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        # The map page is served from Streamlit's origin
+        self.send_header('Access-Control-Allow-Origin', '*')
+        # Pyramid ids are derived from dataset and filters, so a tile never changes
+        self.send_header('Cache-Control', 'public, max-age=86400, immutable')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class TileServer:
+    """In-process HTTP endpoint serving the most recently used tile pyramids"""
+    
+    def __init__(self, host: str = TILE_SERVER_HOST, port: int = TILE_SERVER_PORT, url: str = TILE_SERVER_URL):
+        self.pyramids = OrderedDict()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _TileRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.tile_server = self
+        threading.Thread(target=self.httpd.serve_forever, name='tile-server', daemon=True).start()
+        self.url = (url or f"http://{host}:{self.httpd.server_port}").rstrip('/')
+    
+    def pyramid(self, pyramid_id: str) -> Dict[int, Dict]:
+        """A registered pyramid, marked as recently used"""
+        with self.lock:
+            self.pyramids.move_to_end(pyramid_id)
+            return self.pyramids[pyramid_id]
+    
+    def register(self, pyramid_id: str, build: Callable[[], Dict[int, Dict]]) -> str:
+        """Build a pyramid unless already served; returns its {z}/{x}/{y} URL template"""
+        with self.lock:
+            known = pyramid_id in self.pyramids
+            if known:
+                self.pyramids.move_to_end(pyramid_id)
+        if not known:
+            pyramid = build()
+            with self.lock:
+                self.pyramids[pyramid_id] = pyramid
+                while len(self.pyramids) > TILE_PYRAMIDS:
+                    self.pyramids.popitem(last=False)
+        return f"{self.url}/tiles/{pyramid_id}/{{z}}/{{x}}/{{y}}.json"
+
+@st.cache_resource
+def get_tile_server() -> TileServer:
+    """One tile server per Streamlit process, shared by all sessions"""
+    return TileServer()
+
+class TiledFlightLayer(JSCSSMixin, Layer):
+    """Heatmap, density markers or routes drawn from the pyramid tiles in view"""
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var kind = {{ this.kind|tojson }};
+                var template = {{ this.tile_url|tojson }};
+                var options = {{ this.options }};
+                var tiles = window.flightTiles = window.flightTiles || {};
+                var group = L.featureGroup();
+                var renderer = L.canvas();
+                var generation = 0;
+                """ + POPUP_ESCAPE_JS + """
+                
+                function fetchTile(z, x, y) {
+                    var url = template.replace('{z}', z).replace('{x}', x).replace('{y}', y);
+                    if (!tiles[url]) {
+                        tiles[url] = fetch(url)
+                            .then(function(response) { return response.ok ? response.json() : {cells: [], routes: []}; })
+                            .catch(function() { delete tiles[url]; return {cells: [], routes: []}; });
+                    }
+                    return tiles[url];
+                }
+                
+                function visibleTiles(map) {
+                    // Outside the pyramid's zoom range the nearest level is reused
+                    var z = Math.max({{ this.min_zoom }}, Math.min({{ this.max_zoom }}, map.getZoom()));
+                    var bounds = map.getBounds();
+                    var nw = map.project(bounds.getNorthWest(), z).divideBy(256).floor();
+                    var se = map.project(bounds.getSouthEast(), z).divideBy(256).floor();
+                    var last = Math.pow(2, z) - 1, requests = [];
+                    for (var x = Math.max(nw.x, 0); x <= Math.min(se.x, last); x++) {
+                        for (var y = Math.max(nw.y, 0); y <= Math.min(se.y, last); y++) {
+                            requests.push(fetchTile(z, x, y));
+                        }
+                    }
+                    return Promise.all(requests);
+                }
+                
+                function draw(loaded) {
+                    group.clearLayers();
+                    if (kind === 'heat') {
+                        var points = [];
+                        loaded.forEach(function(tile) {
+                            tile.cells.forEach(function(c) { points.push([c[0], c[1], c[3]]); });
+                        });
+                        L.heatLayer(points, options).addTo(group);
+                    } else if (kind === 'markers') {
+                        loaded.forEach(function(tile) {
+                            tile.cells.forEach(function(c) {
+                                L.circleMarker([c[0], c[1]], Object.assign({}, options, {
+                                    radius: 3 + 2 * Math.log2(c[2]), renderer: renderer
+                                })).bindPopup(c[2].toLocaleString() + ' flights landed here').addTo(group);
+                            });
+                        });
+                    } else {
+                        var routes = {}, busiest = 1;
+                        loaded.forEach(function(tile) {
+                            tile.routes.forEach(function(r) {
+                                routes[r[0]] = r;
+                                busiest = Math.max(busiest, r[5]);
+                            });
+                        });
+                        Object.keys(routes).forEach(function(id) {
+                            var r = routes[id];
+                            L.polyline([[r[1], r[2]], [r[3], r[4]]], Object.assign({}, options, {
+                                weight: 1 + 11 * Math.sqrt(r[5] / busiest), renderer: renderer
+                            })).bindPopup(escape(r[5].toLocaleString()) + ' flights').addTo(group);
+                        });
+                    }
+                }
+                
+                function refresh() {
+                    var map = group._map, current = ++generation;
+                    if (!map) { return; }
+                    visibleTiles(map).then(function(loaded) {
+                        // Only the latest pan or zoom gets drawn
+                        if (current === generation) { draw(loaded); }
+                    });
+                }
+                
+                group.on('add', function() { group._map.on('moveend', refresh); refresh(); });
+                group.on('remove', function() { group._map.off('moveend', refresh); });
+                return group;
+            })();
+        {% endmacro %}
+    """)
+    
+    default_js = HeatMap.default_js
+    
+    def __init__(self, tile_url: str, kind: str, name: Optional[str] = None, options: Optional[Dict] = None,
+                 min_zoom: int = TILE_MIN_ZOOM, max_zoom: int = TILE_MAX_ZOOM,
+                 overlay: bool = True, control: bool = True, show: bool = True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'TiledFlights'
+        self.tile_url = tile_url
+        self.kind = kind
+        self.options = json.dumps(options or {})
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+
+class FlightMarkersLayer(InlinePayloadMixin, JSCSSMixin, Layer):
+    """Origin and destination markers clustered in the browser from one packed coordinate array"""
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var bytes = atob({{ this.coords|tojson }});
+                var buffer = new Uint8Array(bytes.length);
+                for (var b = 0; b < bytes.length; b++) { buffer[b] = bytes.charCodeAt(b); }
+                var coords = new Float32Array(buffer.buffer);
+                
+                // The attribute table stays a string until the first popup opens
+                var tableText = {{ this.table|tojson }}, table = null;
+                function row(i) {
+                    table = table || JSON.parse(tableText);
+                    return {
+                        flight: escape(table.flight_id[i]),
+                        origin: escape(table.origin[i] < 0 ? null : table.origin_cities[table.origin[i]]),
+                        dest: escape(table.dest[i] < 0 ? null : table.dest_cities[table.dest[i]]),
+                        time: table.minute[i] === null ? 'n/a'
+                            : new Date(table.minute[i] * 60000).toISOString().slice(0, 16).replace('T', ' '),
+                        altitude: escape(table.altitude[i]),
+                        speed: escape(table.speed[i])
+                    };
+                }
+                """ + POPUP_ESCAPE_JS + """
+                
+                var originIcon = L.AwesomeMarkers.icon({markerColor: 'green', icon: 'plane', prefix: 'glyphicon'});
+                var destIcon = L.AwesomeMarkers.icon({markerColor: 'red', icon: 'flag', prefix: 'glyphicon'});
+                var markers = [];
+                for (var i = 0; i < coords.length / 4; i++) {
+                    markers.push(L.marker([coords[4 * i], coords[4 * i + 1]], {icon: originIcon}).bindPopup(function(i) {
+                        return function() {
+                            var r = row(i);
+                            return '<b>Origin</b><br>City: ' + r.origin + '<br>Flight: ' + r.flight + '<br>Time: ' + r.time;
+                        };
+                    }(i)));
+                    markers.push(L.marker([coords[4 * i + 2], coords[4 * i + 3]], {icon: destIcon}).bindPopup(function(i) {
+                        return function() {
+                            var r = row(i);
+                            return '<b>Destination</b><br>City: ' + r.dest + '<br>Flight: ' + r.flight + '<br>' +
+                                   'Altitude: ' + r.altitude + ' ft<br>Speed: ' + r.speed + ' kts';
+                        };
+                    }(i)));
+                }
+                
+                var layer = L.markerClusterGroup({chunkedLoading: true});
+                layer.addLayers(markers);
+                return layer;
+            })();
+        {% endmacro %}
+    """)
+    
+    default_js = MarkerCluster.default_js
+    default_css = MarkerCluster.default_css
+    
+    def __init__(self, df: pd.DataFrame, name: Optional[str] = None, overlay: bool = True,
+                 control: bool = True, show: bool = True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'FlightMarkers'
+        
+        coords = np.column_stack([df[col].to_numpy(dtype='float32') for col in COORD_COLUMNS])
+        self.coords = base64.b64encode(coords.astype('<f4').tobytes()).decode('ascii')
+        
+        origin_cities, origin = _city_table(df['origin_city'])
+        dest_cities, dest = _city_table(df['dest_city'])
+        timestamps = df['timestamp'].to_numpy().astype('datetime64[m]')
+        minutes = timestamps.astype(np.int64).astype(object)
+        minutes[np.isnat(timestamps)] = None
+        self.table = json.dumps({
+            'flight_id': df['flight_id'].astype(object).where(df['flight_id'].notna(), None).tolist(),
+            'origin_cities': origin_cities,
+            'origin': origin,
+            'dest_cities': dest_cities,
+            'dest': dest,
+            'minute': minutes.tolist(),
+            'altitude': _json_column(df['altitude_ft']),
+            'speed': _json_column(df['speed_kts']),
+        }, separators=(',', ':'))
+
+class DestinationHeatLayer(InlinePayloadMixin, JSCSSMixin, Layer):
+    """Heatmap of pre-binned destination cells, sent as one flat (lat, lon, weight) array"""
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var cells = {{ this.cells }};
+                var points = new Array(cells.length / 3);
+                for (var i = 0; i < points.length; i++) {
+                    points[i] = [cells[3 * i], cells[3 * i + 1], cells[3 * i + 2]];
+                }
+                return L.heatLayer(points, {{ this.options }});
+            })();
+        {% endmacro %}
+    """)
+    
+    default_js = HeatMap.default_js
+    
+    def __init__(self, cells: np.ndarray, name: Optional[str] = None, radius: int = 20, blur: int = 15,
+                 max_zoom: int = 13, min_opacity: float = 0.5, overlay: bool = True,
+                 control: bool = True, show: bool = True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'DestinationHeat'
+        self.cells = json.dumps(np.round(cells, MAP_COORD_DECIMALS).ravel().tolist(), separators=(',', ':'))
+        self.options = json.dumps({'radius': radius, 'blur': blur, 'maxZoom': max_zoom, 'minOpacity': min_opacity})
+
+class FlightLayerAssets(JSCSSMixin, MacroElement):
+    """Loads every plugin the flight layers use, so layers swapped in later find them"""
+    
+    _template = Template("")
+    
+    default_js = HeatMap.default_js + MarkerCluster.default_js
+    default_css = MarkerCluster.default_css
+
+# Layer cache
+# Rendered flight layers kept per process; heatmap and marker scripts are a few hundred KB each
+LAYER_CACHE_ENTRIES = 64
+
+class RenderedLayer(InlinePayloadMixin, JSCSSMixin, Layer):
+    """A flight layer replayed from the script an earlier build rendered"""
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}{{ this.script }}{% endmacro %}
+    """)
+    
+    def __init__(self, build: Dict):
+        super().__init__(name=build['layer_name'])
+        # Same variable name as the original layer, which the script defines
+        self._name = build['name']
+        self._id = build['id']
+        self.script = build['script']
+        self.default_js = build['js']
+        self.default_css = build['css']
+
+def render_layer(layer: Layer) -> Dict:
+    """The parts of a built layer needed to replay it without rebuilding"""
+    return {
+        'name': layer._name,
+        'id': layer._id,
+        'layer_name': layer.layer_name,
+        'script': layer._template.module.script(layer, {}),
+        'js': list(getattr(layer, 'default_js', [])),
+        'css': list(getattr(layer, 'default_css', []))
+    }
+
+class LayerCache:
+    """Most recently used rendered layers, keyed by selection, layer type and options"""
+    
+    def __init__(self, entries: int = LAYER_CACHE_ENTRIES):
+        self.entries = entries
+        self.layers = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def layer(self, key: Tuple, build: Callable[[], Layer]) -> RenderedLayer:
+        """A cached layer, built and rendered on a miss"""
+        with self.lock:
+            rendered = self.layers.get(key)
+            if rendered is not None:
+                self.layers.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if rendered is None:
+            rendered = render_layer(build())
+            with self.lock:
+                self.layers[key] = rendered
+                while len(self.layers) > self.entries:
+                    self.layers.popitem(last=False)
+        return RenderedLayer(rendered)
     
-    return filtered_df
+    def stats(self) -> Dict:
+        """Hit and miss counts since the process started"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'layers': len(self.layers), 'entries': self.entries}
 
-def create_map(df: pd.DataFrame, show_flows: bool = True, show_markers: bool = True) -> folium.Map:
-    """Create the main map with layers"""
-    # Calculate center
-    center_lat = (df['origin_lat'].mean() + df['dest_lat'].mean()) / 2
-    center_lon = (df['origin_lon'].mean() + df['dest_lon'].mean()) / 2
-    
-    # Create base map
+@st.cache_resource
+def get_layer_cache() -> LayerCache:
+    """One layer cache per Streamlit process, shared by all sessions"""
+    return LayerCache()
+
+def map_center(df: pd.DataFrame) -> Tuple[float, float]:
+    """Midpoint between the mean origin and the mean destination"""
+    return (
+        (df['origin_lat'].mean() + df['dest_lat'].mean()) / 2,
+        (df['origin_lon'].mean() + df['dest_lon'].mean()) / 2
+    )
+
+def map_viewport(map_state: Optional[Dict]) -> Optional[List[float]]:
+    """The [south, west, north, east] box of the map view st_folium last reported"""
+    bounds = (map_state or {}).get('bounds') or {}
+    south_west, north_east = bounds.get('_southWest') or {}, bounds.get('_northEast') or {}
+    if None in (south_west.get('lat'), south_west.get('lng'), north_east.get('lat'), north_east.get('lng')):
+        return None
+    # Leaflet reports longitudes past ±180 once the world wraps
+    return [
+        round(max(float(south_west['lat']), -90.0), 4), round(max(float(south_west['lng']), -180.0), 4),
+        round(min(float(north_east['lat']), 90.0), 4), round(min(float(north_east['lng']), 180.0), 4)
+    ]
+
+def create_base_map(center: Tuple[float, float]) -> folium.Map:
+    """Base map with tile layers, independent of the filtered flights"""
     m = folium.Map(
-        location=[center_lat, center_lon],
+        location=list(center),
         zoom_start=6,
         tiles='CartoDB positron'
     )
@@ -622,73 +2460,73 @@ def create_map(df: pd.DataFrame, show_flows: bool = True, show_markers: bool = T
     folium.TileLayer('CartoDB positron', name='Light').add_to(m)
     folium.TileLayer('CartoDB dark_matter', name='Dark').add_to(m)
     folium.TileLayer('OpenStreetMap', name='Street').add_to(m)
+    FlightLayerAssets().add_to(m)
     
-    # Layer A: Destination Heatmap
-    if not df.empty:
-        heatmap_data = df[['dest_lat', 'dest_lon', 'altitude_ft']].values.tolist()
-        HeatMap(
-            heatmap_data,
-            name='Destination Heatmap',
-            radius=20,
-            blur=15,
-            max_zoom=13
-        ).add_to(m)
-    
-    # Layer B: Flow Lines (sampled for performance)
-    if show_flows and not df.empty:
-        # Sample data for performance
-        sample_size = min(1000, len(df))
-        sample_df = df.sample(n=sample_size, random_state=42)
-        
-        for _, row in sample_df.iterrows():
-            # Create curved line
-            points = [
-                [row['origin_lat'], row['origin_lon']],
-                [row['dest_lat'], row['dest_lon']]
-            ]
-            
-            folium.PolyLine(
-                points,
-                color='red',
-                weight=2,
-                opacity=0.6,
-                popup=f"Flight: {row['flight_id']}<br>"
-                      f"From: {row['origin_city']}<br>"
-                      f"To: {row['dest_city']}<br>"
-                      f"Altitude: {row['altitude_ft']:.0f} ft<br>"
-                      f"Speed: {row['speed_kts']:.0f} kts"
-            ).add_to(m)
-    
-    # Layer C: Markers (clustered)
-    if show_markers and not df.empty:
-        marker_cluster = MarkerCluster(name='Flight Markers')
-        
-        # Sample markers for performance
-        marker_sample = df.sample(n=min(500, len(df)), random_state=42)
-        
-        for _, row in marker_sample.iterrows():
-            # Origin marker
-            folium.Marker(
-                [row['origin_lat'], row['origin_lon']],
-                popup=f"<b>Origin</b><br>"
-                      f"City: {row['origin_city']}<br>"
-                      f"Flight: {row['flight_id']}<br>"
-                      f"Time: {row['timestamp'].strftime('%Y-%m-%d %H:%M')}",
-                icon=folium.Icon(color='green', icon='plane')
-            ).add_to(marker_cluster)
-            
-            # Destination marker
-            folium.Marker(
-                [row['dest_lat'], row['dest_lon']],
-                popup=f"<b>Destination</b><br>"
-                      f"City: {row['dest_city']}<br>"
-                      f"Flight: {row['flight_id']}<br>"
-                      f"Altitude: {row['altitude_ft']:.0f} ft<br>"
-                      f"Speed: {row['speed_kts']:.0f} kts",
-                icon=folium.Icon(color='red', icon='flag')
-            ).add_to(marker_cluster)
-        
-        marker_cluster.add_to(m)
+    return m
+
+def create_map_layers(df: pd.DataFrame, show_flows: bool = True, show_markers: bool = True,
+                      flow_style: str = 'routes', route_key: str = 'city',
+                      tile_url: Optional[str] = None, selection: Optional[str] = None) -> List[folium.FeatureGroup]:
+    """Flight layers for a selection, one feature group each; with a selection_key they come from the layer cache"""
+    if df.empty:
+        return []
+    groups = []
+    
+    def add_group(name: str, layer: Layer):
+        group = folium.FeatureGroup(name=name)
+        layer.add_to(group)
+        groups.append(group)
+    
+    # With a tile pyramid every layer fetches per-zoom aggregates for the tiles in view
+    if tile_url:
+        add_group('Destination Heatmap', TiledFlightLayer(
+            tile_url, 'heat', options={'radius': 20, 'blur': 15, 'maxZoom': 13}
+        ))
+        if show_flows:
+            add_group('Flow Lines', TiledFlightLayer(tile_url, 'routes', options={'color': 'red', 'opacity': 0.6}))
+        if show_markers:
+            add_group('Flight Markers', TiledFlightLayer(
+                tile_url, 'markers', options={'color': 'green', 'weight': 1, 'fillOpacity': 0.5}
+            ))
+        return groups
+    
+    # Each layer is cached on its own, so toggling one layer reuses the others
+    def cached(key: Tuple, build: Callable[[], Layer]) -> Layer:
+        return get_layer_cache().layer((selection,) + key, build) if selection else build()
+    
+    def sampled(n: int = MAP_SAMPLE_ROWS) -> pd.DataFrame:
+        return df.iloc[map_sample(df, selection)[:n]]
+    
+    # Layer A: Destination Heatmap, one weighted point per non-empty grid cell
+    add_group('Destination Heatmap', cached(('heat',), lambda: DestinationHeatLayer(
+        bin_destinations(df),
+        radius=20,
+        blur=15,
+        max_zoom=13
+    )))
+    
+    # Layer B: Flow Lines, one weighted edge per route or one line per sampled flight
+    if show_flows:
+        if flow_style == 'routes':
+            add_group('Flow Lines', cached(
+                ('routes', route_key), lambda: RouteEdgesLayer(aggregate_routes(df, by=route_key))
+            ))
+        else:
+            add_group('Flow Lines', cached(('flights', MAP_SAMPLE_ROWS), lambda: FlowLinesLayer(sampled())))
+    
+    # Layer C: Markers, clustered in the browser from the stratified head of the sample
+    if show_markers:
+        add_group('Flight Markers', cached(
+            ('markers', MARKER_SAMPLE_ROWS), lambda: FlightMarkersLayer(sampled(MARKER_SAMPLE_ROWS))
+        ))
+    
+    return groups
+
+def create_map(df: pd.DataFrame, center: Optional[Tuple[float, float]] = None, **layer_options) -> folium.Map:
+    """Create the main map with layers as one standalone document"""
+    m = create_base_map(center or map_center(df))
+    for group in create_map_layers(df, **layer_options):
+        group.add_to(m)
     
     # Add layer control
     folium.LayerControl().add_to(m)
@@ -707,19 +2545,520 @@ def calculate_kpis(df: pd.DataFrame) -> Dict:
             'avg_speed': 0
         }
     
+    # On categorical columns value_counts is a bincount over the codes, but it
+    # also lists categories that no longer occur after filtering
+    dest_counts = df['dest_city'].value_counts()
+    dest_counts = dest_counts[dest_counts > 0]
+    
     return {
         'total_flights': len(df),
         'unique_origins': df['origin_city'].nunique(),
-        'unique_destinations': df['dest_city'].nunique(),
-        'top_destinations': df['dest_city'].value_counts().head(5).to_dict(),
+        'unique_destinations': len(dest_counts),
+        'top_destinations': dest_counts.head(5).to_dict(),
         'avg_altitude': df['altitude_ft'].mean(),
         'avg_speed': df['speed_kts'].mean()
     }
 
-def chat_with_data(user_query: str, df: pd.DataFrame, client) -> Tuple[Dict, str]:
-    """Process user query through Anthropic Claude and return structured filters"""
+# KPI cubes
+# Flight counts and measurement sums per (day, origin, destination, destination country,
+# altitude band, speed band), built once per dataset. Each level is (altitude band ft,
+# speed band kts); None keeps one band for the whole column. Finer levels answer more
+# range filters, but are only kept while they stay much smaller than the data.
+KPI_CUBE_LEVELS = [(None, None), (100, 5)]
+KPI_CUBE_MIN_ROWS_PER_CELL = 4
+KPI_CACHE_ENTRIES = 256
+# Filters the cubes can answer; any other active filter falls back to scanning rows
+CUBE_FILTERS = {'time_range', 'altitude_range', 'speed_range', 'destinations', 'origin_cities', 'dest_cities'}
+
+def _band_bounds(values: np.ndarray, bands: np.ndarray, n_bands: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Lowest and highest value seen in each band, and which bands hold no rows"""
+    limits = np.finfo(values.dtype) if values.dtype.kind == 'f' else np.iinfo(values.dtype)
+    low = np.full(n_bands, limits.max, dtype=values.dtype)
+    high = np.full(n_bands, limits.min, dtype=values.dtype)
+    np.minimum.at(low, bands, values)
+    np.maximum.at(high, bands, values)
+    return low, high, np.bincount(bands, minlength=n_bands) == 0
+
+def _value_bands(values: np.ndarray, width: Optional[int]) -> Tuple[np.ndarray, Dict]:
+    """Band number per row, with missing values in the last band, and the bounds of each band"""
+    present = ~np.isnan(values)
+    if not present.any():
+        return np.zeros(len(values), dtype=np.int64), {'low': values[:1], 'high': values[:1], 'empty': np.ones(1, bool)}
+    if width is None:
+        bands = np.zeros(len(values), dtype=np.int64)
+    else:
+        # Bands sit on multiples of the width, so round slider and chat values line up with them
+        bands = np.floor(np.where(present, values, 0) / width).astype(np.int64)
+        bands -= bands[present].min()
+    n_bands = int(bands[present].max()) + 2
+    bands[~present] = n_bands - 1
+    low, high, empty = _band_bounds(values[present], bands[present], n_bands)
+    return bands, {'low': low, 'high': high, 'empty': empty}
+
+def _day_bands(timestamps: np.ndarray) -> Tuple[np.ndarray, Dict]:
+    """Day number per row, with missing timestamps in the last band, and the first and last time in each day"""
+    present = ~np.isnat(timestamps)
+    days = timestamps.astype('datetime64[D]').astype(np.int64)
+    if not present.any():
+        return np.zeros(len(days), dtype=np.int64), {'low': timestamps[:1], 'high': timestamps[:1], 'empty': np.ones(1, bool)}
+    days -= days[present].min()
+    n_bands = int(days[present].max()) + 2
+    days[~present] = n_bands - 1
+    low, high, empty = _band_bounds(timestamps[present].view(np.int64), days[present], n_bands)
+    return days, {'low': low.view(timestamps.dtype), 'high': high.view(timestamps.dtype), 'empty': empty}
+
+def build_kpi_cube(df: pd.DataFrame, altitude_band: Optional[int], speed_band: Optional[int]) -> Optional[Dict]:
+    """One level of the KPI cube, or None when it would have too many cells"""
+    timestamps = df['timestamp'].to_numpy()
+    if timestamps.dtype.kind != 'M':
+        return None
+    altitude = df['altitude_ft'].to_numpy(dtype='float64', na_value=np.nan)
+    speed = df['speed_kts'].to_numpy(dtype='float64', na_value=np.nan)
+    
+    dims = {
+        'time': _day_bands(timestamps),
+        'altitude_ft': _value_bands(altitude, altitude_band),
+        'speed_kts': _value_bands(speed, speed_band)
+    }
+    origin, dest = _city_codes(df['origin_city']), _city_codes(df['dest_city'])
+    lat, lon = _column_values(df['dest_lat']), _column_values(df['dest_lon'])
+    country = _bounds_test(MEXICO_BOUNDS)(lat, lon) + 2 * _bounds_test(US_BOUNDS)(lat, lon).astype(np.int64)
+    
+    # One mixed-radix key per cell
+    columns = [dims['time'][0], origin, dest, country, dims['altitude_ft'][0], dims['speed_kts'][0]]
+    radixes = [len(dims['time'][1]['low']), int(origin.max()) + 1, int(dest.max()) + 1, 4,
+               len(dims['altitude_ft'][1]['low']), len(dims['speed_kts'][1]['low'])]
+    if np.prod(np.array(radixes, dtype=np.float64)) >= 2 ** 62:
+        return None
+    keys = np.zeros(len(df), dtype=np.int64)
+    for column, radix in zip(columns, radixes):
+        keys = keys * radix + column
+    unique, cells = _group_keys(keys)
+    if len(unique) * KPI_CUBE_MIN_ROWS_PER_CELL > len(df) and (altitude_band or speed_band):
+        return None
+    
+    decoded = []
+    for radix in reversed(radixes):
+        unique, digit = np.divmod(unique, radix)
+        decoded.append(digit)
+    day, origin_code, dest_code, dest_country, altitude_band_id, speed_band_id = reversed(decoded)
+    
+    def sums(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        present = ~np.isnan(values)
+        return (np.bincount(cells[present], weights=values[present], minlength=len(day)),
+                np.bincount(cells[present], minlength=len(day)))
+    altitude_sum, altitude_count = sums(altitude)
+    speed_sum, speed_count = sums(speed)
+    
+    return {
+        'bands': {'time': day, 'altitude_ft': altitude_band_id, 'speed_kts': speed_band_id},
+        'band_bounds': {name: bounds for name, (_, bounds) in dims.items()},
+        'origin': origin_code - 1,
+        'dest': dest_code - 1,
+        'country': dest_country,
+        'flights': np.bincount(cells, minlength=len(day)),
+        'altitude_sum': altitude_sum,
+        'altitude_count': altitude_count,
+        'speed_sum': speed_sum,
+        'speed_count': speed_count,
+        'origin_categories': _city_categories(df['origin_city']),
+        'dest_categories': _city_categories(df['dest_city'])
+    }
+
+def _city_categories(cities: pd.Series) -> pd.Index:
+    """Category names matching the codes _city_codes assigns"""
+    cities = cities if isinstance(cities.dtype, pd.CategoricalDtype) else cities.astype('category')
+    return cities.cat.categories
+
+def build_kpi_cubes(df: pd.DataFrame) -> List[Dict]:
+    """KPI cube levels from coarsest to finest"""
+    if df.empty:
+        return []
+    cubes = (build_kpi_cube(df, altitude_band, speed_band) for altitude_band, speed_band in KPI_CUBE_LEVELS)
+    return [cube for cube in cubes if cube is not None]
+
+def _bands_in_range(bounds: Dict, low, high) -> Optional[np.ndarray]:
+    """Which bands lie wholly inside [low, high], or None if a band straddles either end"""
+    inside = (bounds['low'] >= low) & (bounds['high'] <= high)
+    outside = (bounds['high'] < low) | (bounds['low'] > high)
+    # The last band holds missing values, which a range never matches
+    if not np.all((inside | outside | bounds['empty'])[:-1]):
+        return None
+    inside[-1] = False
+    return inside
+
+def cube_kpis(cube: Dict, filters: Dict) -> Optional[Dict]:
+    """KPIs summed from cube cells, or None when the filters don't line up with the cube"""
+    if any(filters.get(key) for key in filters if key not in CUBE_FILTERS):
+        return None
+    
+    ranges = []
+    if filters.get('time_range'):
+        start_time, end_time = filters['time_range']
+        dtype = cube['band_bounds']['time']['low'].dtype
+        ranges.append(('time', _datetime_bound(start_time, dtype), _datetime_bound(end_time, dtype)))
+    for key, column in (('altitude_range', 'altitude_ft'), ('speed_range', 'speed_kts')):
+        if filters.get(key):
+            ranges.append((column, *filters[key]))
+    
+    cells = np.ones(len(cube['flights']), dtype=bool)
+    for dim, low, high in ranges:
+        inside = _bands_in_range(cube['band_bounds'][dim], low, high)
+        if inside is None:
+            return None
+        cells &= inside[cube['bands'][dim]]
+    
+    if filters.get('destinations'):
+        if 'mexico' in filters['destinations']:
+            cells &= (cube['country'] & 1) > 0
+        if 'us' in filters['destinations']:
+            cells &= (cube['country'] & 2) > 0
+    for key, col in (('origin_cities', 'origin'), ('dest_cities', 'dest')):
+        if filters.get(key):
+            lookup = np.append(cube[f'{col}_categories'].isin(filters[key]), False)
+            cells &= lookup[cube[col]]
+    
+    flights = cube['flights'][cells]
+    if not flights.sum():
+        return calculate_kpis(pd.DataFrame())
+    
+    origin, dest = cube['origin'][cells], cube['dest'][cells]
+    origin_counts = np.bincount(origin[origin >= 0], weights=flights[origin >= 0], minlength=len(cube['origin_categories']))
+    dest_counts = np.bincount(dest[dest >= 0], weights=flights[dest >= 0], minlength=len(cube['dest_categories']))
+    # Same order as value_counts: by count, ties in category order
+    top = np.argsort(-dest_counts, kind='stable')[:5]
+    top = top[dest_counts[top] > 0]
+    
+    def mean(column: str) -> float:
+        count = cube[f'{column}_count'][cells].sum()
+        return cube[f'{column}_sum'][cells].sum() / count if count else np.nan
+    
+    return {
+        'total_flights': int(flights.sum()),
+        'unique_origins': int(np.count_nonzero(origin_counts)),
+        'unique_destinations': int(np.count_nonzero(dest_counts)),
+        'top_destinations': {cube['dest_categories'][i]: int(dest_counts[i]) for i in top},
+        'avg_altitude': mean('altitude'),
+        'avg_speed': mean('speed')
+    }
+
+# KPI sketches
+# Mergeable per-day summaries for feeds too large to count exactly: HyperLogLog
+# registers for unique origins and destinations, and Misra-Gries heavy hitters
+# for top destinations. Partitions are (day, destination country), like the cubes.
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+# Relative standard error of a HyperLogLog estimate
+HLL_ERROR = 1.04 / np.sqrt(HLL_REGISTERS)
+HEAVY_HITTERS = 64
+
+def _city_hashes(categories: pd.Index) -> np.ndarray:
+    """Stable 64-bit hash of each city name"""
+    return np.array([
+        int.from_bytes(hashlib.blake2b(str(city).encode(), digest_size=8).digest(), 'little')
+        for city in categories
+    ], dtype=np.uint64)
+
+def _hll_slots(hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Register index and rank (position of the first set bit after the index bits) of each hash"""
+    register = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.int64)
+    rest = hashes << np.uint64(HLL_PRECISION)
+    rank = np.full(len(hashes), 64 - HLL_PRECISION + 1, dtype=np.uint8)
+    for bit in range(64 - HLL_PRECISION - 1, -1, -1):
+        rank[(rest >> np.uint64(63 - bit)) & np.uint64(1) == 1] = bit + 1
+    return register, rank
+
+def hll_estimate(registers: np.ndarray) -> float:
+    """Distinct count estimated from HyperLogLog registers"""
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.exp2(-registers.astype(np.float64)))
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zeros:
+        # Small range correction: linear counting over the empty registers
+        estimate = m * np.log(m / zeros)
+    return float(estimate)
+
+def _reduce_heavy_hitters(partitions: np.ndarray, codes: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """Keep the top HEAVY_HITTERS counters per partition, less the next largest count (Misra-Gries)"""
+    order = np.lexsort((-counts, partitions))
+    partitions, codes, counts = partitions[order], codes[order], counts[order]
+    first = np.flatnonzero(np.r_[True, partitions[1:] != partitions[:-1]])
+    rank = np.arange(len(partitions)) - np.repeat(first, np.diff(np.r_[first, len(partitions)]))
+    cut = np.zeros(int(partitions.max()) + 1 if len(partitions) else 0, dtype=counts.dtype)
+    cut[partitions[rank == HEAVY_HITTERS]] = counts[rank == HEAVY_HITTERS]
+    counts = counts - cut[partitions]
+    keep = (rank < HEAVY_HITTERS) & (counts > 0)
+    return partitions[keep], codes[keep], counts[keep]
+
+def build_kpi_sketches(df: pd.DataFrame) -> Optional[Dict]:
+    """Per-partition HyperLogLog registers, heavy hitters and sums for approximate KPIs"""
+    timestamps = df['timestamp'].to_numpy()
+    if df.empty or timestamps.dtype.kind != 'M':
+        return None
+    days, day_bounds = _day_bands(timestamps)
+    lat, lon = _column_values(df['dest_lat']), _column_values(df['dest_lon'])
+    country = _bounds_test(MEXICO_BOUNDS)(lat, lon) + 2 * _bounds_test(US_BOUNDS)(lat, lon).astype(np.int64)
+    unique, partitions = _group_keys(days * 4 + country)
+    n_partitions = len(unique)
+    
+    sketches = {
+        'day': unique // 4,
+        'country': unique % 4,
+        'day_bounds': day_bounds,
+        'flights': np.bincount(partitions, minlength=n_partitions),
+        'dest_categories': _city_categories(df['dest_city'])
+    }
+    for column in ('altitude_ft', 'speed_kts'):
+        values = df[column].to_numpy(dtype='float64', na_value=np.nan)
+        present = ~np.isnan(values)
+        sketches[f'{column}_bounds'] = _value_bands(values, None)[1]
+        sketches[f'{column}_sum'] = np.bincount(partitions[present], weights=values[present], minlength=n_partitions)
+        sketches[f'{column}_count'] = np.bincount(partitions[present], minlength=n_partitions)
+    
+    for column in CITY_COLUMNS:
+        codes = _city_codes(df[column]) - 1
+        present = codes >= 0
+        # Hashes depend only on the city, so slots are computed per category and looked up by code
+        register, rank = _hll_slots(_city_hashes(_city_categories(df[column])))
+        registers = np.zeros(n_partitions * HLL_REGISTERS, dtype=np.uint8)
+        np.maximum.at(registers, partitions[present] * HLL_REGISTERS + register[codes[present]], rank[codes[present]])
+        sketches[f'{column}_registers'] = registers.reshape(n_partitions, HLL_REGISTERS)
+    
+    codes = _city_codes(df['dest_city']) - 1
+    present = codes >= 0
+    n_codes = len(sketches['dest_categories'])
+    unique, groups = _group_keys(partitions[present] * n_codes + codes[present])
+    top = _reduce_heavy_hitters(unique // n_codes, unique % n_codes, np.bincount(groups))
+    sketches['top_partition'], sketches['top_dest'], sketches['top_count'] = top
+    sketches['dest_flights'] = np.bincount(partitions[present], minlength=n_partitions)
+    return sketches
+
+def sketch_kpis(sketches: Dict, filters: Dict) -> Optional[Dict]:
+    """Approximate KPIs merged from the partitions the filters select, or None when they can't be answered"""
+    # Only whole days and destination countries map onto partitions; ranges must keep every row
+    if any(filters.get(key) for key in filters if key not in {'time_range', 'altitude_range', 'speed_range', 'destinations'}):
+        return None
+    for key, column in (('altitude_range', 'altitude_ft'), ('speed_range', 'speed_kts')):
+        if filters.get(key):
+            bounds = sketches[f'{column}_bounds']
+            inside = _bands_in_range(bounds, *filters[key])
+            if inside is None or not (inside[0] or bounds['empty'][0]) or not bounds['empty'][-1]:
+                return None
+    
+    partitions = np.ones(len(sketches['flights']), dtype=bool)
+    if filters.get('time_range'):
+        start_time, end_time = filters['time_range']
+        dtype = sketches['day_bounds']['low'].dtype
+        inside = _bands_in_range(sketches['day_bounds'], _datetime_bound(start_time, dtype), _datetime_bound(end_time, dtype))
+        if inside is None:
+            return None
+        partitions &= inside[sketches['day']]
+    if filters.get('destinations'):
+        if 'mexico' in filters['destinations']:
+            partitions &= (sketches['country'] & 1) > 0
+        if 'us' in filters['destinations']:
+            partitions &= (sketches['country'] & 2) > 0
+    
+    flights = int(sketches['flights'][partitions].sum())
+    if not flights:
+        return calculate_kpis(pd.DataFrame())
+    
+    # Merging HyperLogLog sketches is a register-wise max
+    unique = {
+        column: int(round(hll_estimate(sketches[f'{column}_registers'][partitions].max(axis=0))))
+        for column in CITY_COLUMNS
+    }
+    
+    # Merging heavy hitters: sum the counters, then reduce back to HEAVY_HITTERS of them
+    selected = partitions[sketches['top_partition']]
+    counts = np.bincount(sketches['top_dest'][selected], weights=sketches['top_count'][selected],
+                         minlength=len(sketches['dest_categories'])).astype(np.int64)
+    codes = np.flatnonzero(counts)
+    _, codes, counts = _reduce_heavy_hitters(np.zeros(len(codes), dtype=np.int64), codes, counts[codes])
+    top = np.argsort(-counts, kind='stable')[:5]
+    
+    def mean(column: str) -> float:
+        count = sketches[f'{column}_count'][partitions].sum()
+        return sketches[f'{column}_sum'][partitions].sum() / count if count else np.nan
+    
+    return {
+        'total_flights': flights,
+        'unique_origins': unique['origin_city'],
+        'unique_destinations': unique['dest_city'],
+        'top_destinations': {sketches['dest_categories'][codes[i]]: int(counts[i]) for i in top},
+        'avg_altitude': mean('altitude_ft'),
+        'avg_speed': mean('speed_kts'),
+        # Unique counts are within HLL_ERROR relative standard error; top counts are low by at most top_error
+        'approximate': {
+            'unique_error': HLL_ERROR,
+            'top_error': int(sketches['dest_flights'][partitions].sum() // (HEAVY_HITTERS + 1))
+        }
+    }
+
+def _selection_kpis(df: pd.DataFrame, filters: Dict, index: Dict, approximate: bool = False) -> Dict:
+    """KPIs from the sketches when approximate, else the coarsest cube that can answer the filters, else the filtered rows"""
+    if approximate and index.get('kpi_sketches'):
+        kpis = sketch_kpis(index['kpi_sketches'], filters)
+        if kpis is not None:
+            return kpis
+    if not df.empty:
+        for cube in index.get('kpi_cubes', []):
+            kpis = cube_kpis(cube, filters)
+            if kpis is not None:
+                return kpis
+    return calculate_kpis(df)
+
+@st.cache_data(max_entries=KPI_CACHE_ENTRIES, show_spinner=False)
+def _memo_kpis(key: str, approximate: bool, _df: pd.DataFrame, _filters: Dict, _index: Dict) -> Dict:
+    """KPIs of a selection, computed once per selection key"""
+    return _selection_kpis(_df, _filters, _index, approximate)
+
+def selection_kpis(df: pd.DataFrame, filters: Dict, index: Optional[Dict] = None, key: Optional[str] = None,
+                   approximate: bool = False) -> Dict:
+    """KPIs of the filtered frame df, memoized under its selection_key and answered from the KPI cubes when possible;
+    approximate answers from the KPI sketches, marking the result with an 'approximate' entry"""
+    if key:
+        return _memo_kpis(key, approximate, df, filters, index or {})
+    return _selection_kpis(df, filters, index or {}, approximate)
+
+# Chat aggregations
+# The aggregation block of a chat answer is run here over the filtered flights. Every grouping
+# is a small non-negative integer key per row (category codes, days, hours), so an aggregation
+# is a handful of bincount passes instead of a pandas groupby over strings.
+AGGREGATION_TYPES = ['count', 'average', 'sum', 'min', 'max']
+AGGREGATION_COLUMNS = ['altitude_ft', 'speed_kts', 'origin_lat', 'origin_lon', 'dest_lat', 'dest_lon']
+AGGREGATION_GROUPS = ['origin_city', 'dest_city', 'route', 'dest_country', 'day', 'hour', 'weekday']
+# Names the model uses for the same operation or column
+AGGREGATION_ALIASES = {
+    'avg': 'average', 'mean': 'average', 'total': 'sum', 'minimum': 'min', 'maximum': 'max',
+    'altitude': 'altitude_ft', 'speed': 'speed_kts', 'origin': 'origin_city', 'destination': 'dest_city',
+    'destination_city': 'dest_city', 'country': 'dest_country', 'destinations': 'dest_country',
+    'date': 'day', 'timestamp': 'day', 'hour_of_day': 'hour', 'day_of_week': 'weekday'
+}
+AGGREGATION_CACHE_ENTRIES = 256
+# Grouped results with more rows than this are shown as a table only
+AGGREGATION_CHART_GROUPS = 40
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def validate_aggregation(spec: Dict) -> Dict:
+    """Normalize a chat aggregation block to {'type', 'column', 'group_by'}, raising ValueError for unknown names"""
+    if not isinstance(spec, dict):
+        raise ValueError("Aggregation must be an object")
+    
+    def name(field: str) -> Optional[str]:
+        value = spec.get(field)
+        if value is None or value == '':
+            return None
+        if not isinstance(value, str):
+            raise ValueError(f"Aggregation {field} must be a name, got {value!r}")
+        value = value.strip().lower().replace(' ', '_')
+        return AGGREGATION_ALIASES.get(value, value)
+    
+    how, column, group_by = name('type') or 'count', name('column'), name('group_by')
+    if how == 'group_by':
+        # The schema's "group_by" type: average of the column per group, or flights per group
+        how = 'average' if column else 'count'
+    if how not in AGGREGATION_TYPES:
+        raise ValueError(f"Unknown aggregation type: {spec.get('type')}")
+    if how == 'count':
+        # Counting flights does not depend on a column
+        column = None
+    elif column not in AGGREGATION_COLUMNS:
+        raise ValueError(f"Cannot {how} column: {spec.get('column')}")
+    if group_by is not None and group_by not in AGGREGATION_GROUPS:
+        raise ValueError(f"Cannot group by: {spec.get('group_by')}")
+    return {'type': how, 'column': column, 'group_by': group_by}
+
+def _aggregation_keys(df: pd.DataFrame, group_by: str) -> Tuple[np.ndarray, Callable[[np.ndarray], List]]:
+    """Non-negative integer key per row for a grouping, 0 for missing values, and a function naming keys"""
+    if group_by in CITY_COLUMNS or group_by == 'route':
+        origin, dest = _city_codes(df['origin_city']), _city_codes(df['dest_city'])
+        origin_names = np.append('Unknown', np.asarray(_city_categories(df['origin_city']), dtype=object))
+        dest_names = np.append('Unknown', np.asarray(_city_categories(df['dest_city']), dtype=object))
+        if group_by == 'origin_city':
+            return origin, lambda keys: list(origin_names[keys])
+        if group_by == 'dest_city':
+            return dest, lambda keys: list(dest_names[keys])
+        radix = len(dest_names)
+        return origin * radix + dest, lambda keys: [
+            f"{origin_names[key // radix]} → {dest_names[key % radix]}" for key in keys
+        ]
+    if group_by == 'dest_country':
+        lat, lon = _column_values(df['dest_lat']), _column_values(df['dest_lon'])
+        country = _bounds_test(MEXICO_BOUNDS)(lat, lon) + 2 * _bounds_test(US_BOUNDS)(lat, lon).astype(np.int64)
+        names = np.array(['Other', 'Mexico', 'US', 'Mexico/US border'], dtype=object)
+        return country, lambda keys: list(names[keys])
+    
+    timestamps = df['timestamp'].to_numpy()
+    missing = np.isnat(timestamps)
+    if group_by == 'day':
+        days = timestamps.astype('datetime64[D]').astype(np.int64)
+        first = days[~missing].min() if (~missing).any() else 0
+        days -= first - 1
+        keys = np.where(missing, 0, days) if missing.any() else days
+        return keys, lambda keys: [
+            str(np.datetime64(int(key + first - 1), 'D')) if key else 'Unknown' for key in keys
+        ]
+    hours = timestamps.astype('datetime64[h]').astype(np.int64)
+    if group_by == 'hour':
+        keys = np.where(missing, 0, hours % 24 + 1)
+        return keys, lambda keys: [f"{key - 1:02d}:00" if key else 'Unknown' for key in keys]
+    # 1970-01-01 was a Thursday
+    keys = np.where(missing, 0, (hours // 24 + 3) % 7 + 1)
+    return keys, lambda keys: [WEEKDAYS[key - 1] if key else 'Unknown' for key in keys]
+
+def run_aggregation(df: pd.DataFrame, spec: Dict) -> pd.DataFrame:
+    """Flights and the aggregated value per group of a validated spec; one row when it has no grouping"""
+    how, column, group_by = spec['type'], spec['column'], spec['group_by']
+    metric = 'flights' if how == 'count' else f"{how} {column}"
+    if group_by and df.empty:
+        return pd.DataFrame(columns=list(dict.fromkeys([group_by, 'flights', metric])))
+    if group_by:
+        keys, names = _aggregation_keys(df, group_by)
+        unique, groups = _group_keys(keys)
+    else:
+        unique, groups = np.zeros(1, dtype=np.int64), np.zeros(len(df), dtype=np.int64)
+    n_groups = len(unique)
+    
+    result = {group_by: names(unique)} if group_by else {}
+    result['flights'] = np.bincount(groups, minlength=n_groups)
+    if column:
+        values = np.asarray(_column_values(df[column]), dtype=np.float64)
+        present = ~np.isnan(values)
+        present_groups = groups
+        if not present.all():
+            values, present_groups = values[present], groups[present]
+        counts = np.bincount(present_groups, minlength=n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if how in ('average', 'sum'):
+                totals = np.bincount(present_groups, weights=values, minlength=n_groups)
+                result[metric] = totals / counts if how == 'average' else totals
+            else:
+                low, high, empty = _band_bounds(values, present_groups, n_groups)
+                result[metric] = np.where(empty, np.nan, low if how == 'min' else high)
+        if how != 'sum':
+            result[metric] = np.where(counts == 0, np.nan, result[metric])
     
-    system_prompt = """You are a data-query planner for drone flight data. The user will ask questions about drone flights.
+    frame = pd.DataFrame(result)
+    if group_by in CITY_COLUMNS or group_by in ('route', 'dest_country'):
+        # Categories read best ranked; days, hours and weekdays keep their own order
+        frame = frame.sort_values(metric, ascending=False, kind='stable', na_position='last')
+    return frame.reset_index(drop=True)
+
+@st.cache_data(max_entries=AGGREGATION_CACHE_ENTRIES, show_spinner=False)
+def _memo_aggregation(key: str, how: str, column: Optional[str], group_by: Optional[str], _df: pd.DataFrame) -> pd.DataFrame:
+    """Aggregation of a selection, computed once per selection key and spec"""
+    return run_aggregation(_df, {'type': how, 'column': column, 'group_by': group_by})
+
+def aggregate_selection(df: pd.DataFrame, spec: Dict, key: Optional[str] = None) -> pd.DataFrame:
+    """Run a validated aggregation over the filtered frame df, memoized under its selection_key"""
+    if key:
+        return _memo_aggregation(key, spec['type'], spec['column'], spec['group_by'], df)
+    return run_aggregation(df, spec)
+
+# Chat
+CHAT_MODEL = "claude-3-5-haiku-20241022"
+CHAT_SYSTEM_PROMPT = """You are a data-query planner for drone flight data. The user will ask questions about drone flights.
 Only return a JSON object matching the schema below. Do not include prose.
 You must translate the user's intent into filters over the columns and optional aggregations.
 Never execute code or return SQL. Never access external tools.
@@ -735,49 +3074,620 @@ Schema:
         "speed_range": [min_speed, max_speed] (optional),
         "destinations": ["mexico", "us"] (optional),
         "origin_cities": ["city1", "city2"] (optional),
-        "dest_cities": ["city1", "city2"] (optional)
+        "dest_cities": ["city1", "city2"] (optional),
+        "origin_bbox": [south_lat, west_lon, north_lat, east_lon] (optional),
+        "dest_bbox": [south_lat, west_lon, north_lat, east_lon] (optional),
+        "origin_radius": [lat, lon, radius_km] (optional),
+        "dest_radius": [lat, lon, radius_km] (optional)
     },
     "aggregation": {
-        "type": "count" | "average" | "group_by",
-        "column": "column_name" (optional),
-        "group_by": "column_name" (optional)
+        "type": "count" | "average" | "sum" | "min" | "max",
+        "column": "altitude_ft" | "speed_kts" | "origin_lat" | "origin_lon" | "dest_lat" | "dest_lon" (not for count),
+        "group_by": "origin_city" | "dest_city" | "route" | "dest_country" | "day" | "hour" | "weekday" (optional)
     }
 }
 
 Examples:
 - "Show flights to Laredo in the last 24 hours above 500 ft" → filters with dest_cities: ["Laredo"], time_range, altitude_range
 - "Only destinations in Mexico, altitude < 1000 ft" → filters with destinations: ["mexico"], altitude_range
-- "Compare McAllen vs Brownsville by average altitude" → aggregation with group_by: "dest_city" and dest_cities filter"""
+- "Flights landing within 20 km of the San Ysidro crossing" → filters with dest_radius: [32.5422, -117.0296, 20]
+- "Compare McAllen vs Brownsville by average altitude" → aggregation with type: "average", column: "altitude_ft", group_by: "dest_city" and dest_cities filter"""
+
+# Chat response cache: parsed filters per normalized question, kept on disk across restarts
+CHAT_CACHE_PATH = os.getenv('CHAT_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'drone_flight_chat_cache.sqlite3'))
+CHAT_CACHE_ENTRIES = 2000
+CHAT_CACHE_TTL = 30 * 24 * 3600
+# Answers to relative-time questions ("last 24 hours") embed the time they were asked
+CHAT_CACHE_RELATIVE_TTL = 15 * 60
+# Token-set (Jaccard) similarity at which a different wording reuses an answer; 0, the default, disables it
+CHAT_CACHE_SIMILARITY = float(os.getenv('CHAT_CACHE_SIMILARITY', '0'))
+# Words that change what a question means; a different wording never reuses an answer when
+# the two questions differ in one of these (or in a city name)
+CHAT_MEANING_WORDS = {
+    'not', 'no', 'never', 'without', 'except', 'excluding', 'exclude', 'non', 'nor', 'neither', 'only', 'or',
+    'to', 'from', 'into', 'towards', 'toward', 'in', 'out', 'at', 'via', 'origin', 'origins', 'destination',
+    'destinations', 'arriving', 'landing', 'leaving', 'departing', 'launched',
+    'above', 'below', 'over', 'under', 'more', 'less', 'fewer', 'greater', 'higher', 'lower', 'least', 'most',
+    'max', 'min', 'maximum', 'minimum', 'than', 'between', 'before', 'after', 'since', 'until',
+}
+RELATIVE_TIME_PATTERN = re.compile(
+    r'\b(last|past|previous|recent|recently|today|tonight|yesterday|ago|now|this (morning|afternoon|week|month|year))\b'
+)
+# Words that don't change what a question asks for
+CHAT_FILLER_WORDS = {'a', 'all', 'an', 'any', 'can', 'display', 'find', 'get', 'give', 'list', 'me', 'please',
+                     'show', 'the', 'what', 'which', 'you'}
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-folded question, without trailing punctuation"""
+    query = unicodedata.normalize('NFKC', query).casefold()
+    return ' '.join(query.split()).rstrip('?!. ')
+
+def query_tokens(normalized: str) -> frozenset:
+    """Words and numbers of a normalized question, minus filler words"""
+    return frozenset(re.findall(r'\d+(?:\.\d+)?|[^\W\d_]+', normalized)) - CHAT_FILLER_WORDS
+
+def _query_numbers(tokens: frozenset) -> str:
+    """The numbers in a question, which must match exactly for a similar question to reuse an answer"""
+    return ' '.join(sorted(token for token in tokens if token[0].isdigit()))
+
+def token_similarity(a: frozenset, b: frozenset) -> float:
+    """Jaccard similarity of two token sets"""
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def chat_scope(*parts: str) -> str:
+    """Identifies what a cached answer depends on besides the question: the model, the prompt and any extra context"""
+    return hashlib.sha256('\0'.join((CHAT_MODEL, CHAT_SYSTEM_PROMPT) + parts).encode()).hexdigest()[:16]
+
+# Dataset profile sent with every question, so the model knows the real city names and value ranges.
+# It is generated once per dataset and sent after the system prompt as one cached prefix.
+CHAT_PROFILE_MAX_CITIES = 500
+CHAT_USAGE_ENTRIES = 200
+
+def dataset_profile(df: pd.DataFrame) -> str:
+    """Compact description of a dataset: row count, value ranges and city vocabulary"""
+    lines = ["Dataset profile (use these exact city names; ranges are inclusive):", f"rows: {len(df)}"]
+    timestamps = df['timestamp'].dropna()
+    if len(timestamps):
+        lines.append(f"timestamp: {timestamps.min():%Y-%m-%dT%H:%M:%S} to {timestamps.max():%Y-%m-%dT%H:%M:%S}")
+    for col in MEASURE_COLUMNS[::-1]:
+        values = df[col].dropna()
+        if len(values):
+            lines.append(f"{col}: {values.min():g} to {values.max():g}")
+    
+    def vocabulary(cities: pd.Series) -> str:
+        # The most frequent cities when there are too many to list
+        counts = cities.value_counts()
+        names = counts[counts > 0].index[:CHAT_PROFILE_MAX_CITIES]
+        more = (counts > 0).sum() - len(names)
+        return ', '.join(sorted(map(str, names))) + (f" (+{more} more)" if more else '')
+    
+    origins, destinations = vocabulary(df['origin_city']), vocabulary(df['dest_city'])
+    if origins == destinations:
+        lines.append(f"origin_city and dest_city: {origins}")
+    else:
+        lines.extend([f"origin_city: {origins}", f"dest_city: {destinations}"])
+    return '\n'.join(lines)
 
+@st.cache_data(max_entries=MAP_SAMPLES, show_spinner=False)
+def _shared_profile(key: str, _df: pd.DataFrame) -> str:
+    """Profile of a loaded dataset, generated once per dataset key"""
+    return dataset_profile(_df)
+
+def chat_profile(df: pd.DataFrame) -> str:
+    """Dataset profile for chat prompts, cached under the dataset key when there is one"""
+    key = df.attrs.get('dataset_key')
+    return _shared_profile(key, df) if key else dataset_profile(df)
+
+def chat_system(profile: str = '') -> List[Dict]:
+    """System prompt blocks; the last one marks the end of the prefix the API may cache"""
+    blocks = [{"type": "text", "text": CHAT_SYSTEM_PROMPT}]
+    if profile:
+        blocks.append({"type": "text", "text": profile})
+    blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    return blocks
+
+class ChatUsageLog:
+    """Tokens and latency of recent chat questions, including those answered without the model"""
+    
+    def __init__(self, entries: int = CHAT_USAGE_ENTRIES):
+        self.entries = deque(maxlen=entries)
+        self.lock = threading.Lock()
+    
+    def record(self, query: str, source: str, latency: float, first_token: Optional[float] = None, usage=None):
+        """Add one answered question; usage is the API's token usage, if the model was called"""
+        entry = {
+            'time': datetime.now(),
+            'question': query,
+            'source': source,
+            'latency_ms': round(latency * 1000, 1),
+            'first_token_ms': round(first_token * 1000, 1) if first_token is not None else None,
+        }
+        for field in ('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'output_tokens'):
+            entry[field] = (getattr(usage, field, None) or 0) if usage is not None else 0
+        with self.lock:
+            self.entries.append(entry)
+    
+    def frame(self) -> pd.DataFrame:
+        """Most recent questions first"""
+        with self.lock:
+            return pd.DataFrame(list(self.entries)[::-1])
+
+# Local chat parser: common filter questions are answered without the model
+CHAT_ANSWERED = ("success", "cached", "local")
+# Open ends of "above N" / "below N" ranges, as the model writes them
+OPEN_RANGE = (0, 100_000)
+_NUMBER = r'(\d+(?:,\d{3})*(?:\.\d+)?)'
+_UNIT = r'(?:(ft|feet|foot|kts|kt|knots|knot|kn)\b)?'
+_QUANTITY = r'(?:(altitude|speed)\s*(?:of\s*|is\s*)?)?'
+RANGE_BETWEEN = re.compile(
+    _QUANTITY + r'\bbetween\s+' + _NUMBER + r'\s*' + _UNIT + r'\s*and\s*' + _NUMBER + r'\s*' + _UNIT
+)
+RANGE_SPAN = re.compile(
+    _QUANTITY + _NUMBER + r'\s*' + _UNIT + r'\s*(?:-|–|—|to)\s*' + _NUMBER + r'\s*' + _UNIT
+)
+RANGE_BOUND = re.compile(
+    _QUANTITY + r'(above|over|higher than|faster than|more than|greater than|at least|>=|>|'
+    r'below|under|lower than|slower than|less than|at most|<=|<)\s*' + _NUMBER + r'\s*' + _UNIT
+)
+RELATIVE_WINDOW = re.compile(r'\b(?:in\s+)?(?:the\s+)?(?:last|past|previous)\s+(?:(\d+)\s+)?(minute|hour|day|week|month)s?\b')
+CALENDAR_DAY = re.compile(r'\b(today|yesterday)\b')
+COUNTRY_NAMES = re.compile(r'\b(mexico|usa|united states|america)\b|(?<!\w)u\.s\.(?:a\.)?')
+DEST_WORDS = {'to', 'into', 'towards', 'toward', 'arriving', 'landing', 'destination', 'destinations'}
+ORIGIN_WORDS = {'from', 'leaving', 'departing', 'origin', 'origins', 'launched', 'out'}
+# "in"/"at" take the role of the direction word before them in the same clause; alone they mark a destination
+PLACE_WORDS = {'in', 'at'}
+WINDOW_UNITS = {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1), 'day': timedelta(days=1),
+                'week': timedelta(weeks=1), 'month': timedelta(days=30)}
+# Words a question may contain besides what the parser understands
+CHAT_PARSER_WORDS = CHAT_FILLER_WORDS | DEST_WORDS | ORIGIN_WORDS | PLACE_WORDS | {
+    'and', 'of', 'for', 'with', 'only', 'just', 'that', 'are', 'were', 'is', 'flights', 'flight', 'drone',
+    'drones', 'trips', 'going', 'heading', 'headed', 'flying', 'fly', 'flown', 'cities', 'city', 'altitude', 'speed',
+    'filter', 'by', 'whose', 'within', 'than', 'there'
+}
+
+def _range_value(text: str) -> float:
+    """A number as written in a question, thousands separators allowed"""
+    value = float(text.replace(',', ''))
+    return int(value) if value.is_integer() else value
+
+def _range_column(quantity: Optional[str], *units: Optional[str], comparator: str = '') -> Optional[str]:
+    """Which range filter a number belongs to, from its units, a leading keyword or the comparator"""
+    columns = {'altitude_range' if unit in ('ft', 'feet', 'foot') else 'speed_range' for unit in units if unit}
+    if quantity:
+        columns.add(f'{quantity}_range')
+    if not columns and comparator:
+        if comparator.startswith(('higher', 'lower')):
+            columns.add('altitude_range')
+        elif comparator.startswith(('faster', 'slower')):
+            columns.add('speed_range')
+    return columns.pop() if len(columns) == 1 else None
+
+def parse_chat_query(query: str, cities: List[str], now: Optional[datetime] = None) -> Optional[Dict]:
+    """Filters for a question built only from known cities, countries, ranges and recent time windows,
+    or None when any part of it needs the model"""
+    # Upper-case "US" is the country; lower-case "us" is usually the pronoun
+    text = re.sub(r'\bUS\b', 'u.s.', ' '.join(unicodedata.normalize('NFKC', query).split())).casefold()
+    filters = {}
+    now = now or datetime.now()
+    
+    def consume(match: re.Match) -> str:
+        return ' ' * len(match.group(0))
+    
+    # Numeric ranges; several bounds on one column narrow it
+    ranges = {}
+    def add_range(column: Optional[str], low, high) -> bool:
+        if column is None or low > high:
+            return False
+        current = ranges.get(column, OPEN_RANGE)
+        low, high = max(current[0], low), min(current[1], high)
+        # "above 500 ft and below 200 ft" matches nothing; let the model answer it
+        if low > high:
+            return False
+        ranges[column] = (low, high)
+        return True
+    
+    for pattern in (RANGE_BETWEEN, RANGE_SPAN):
+        for match in pattern.finditer(text):
+            quantity, low, low_unit, high, high_unit = match.groups()
+            if not add_range(_range_column(quantity, low_unit, high_unit), _range_value(low), _range_value(high)):
+                return None
+        text = pattern.sub(consume, text)
+    for match in RANGE_BOUND.finditer(text):
+        quantity, comparator, value, unit = match.groups()
+        value = _range_value(value)
+        upper = comparator.startswith(('below', 'under', 'lower', 'slower', 'less', 'at most', '<'))
+        if not add_range(_range_column(quantity, unit, comparator=comparator),
+                         OPEN_RANGE[0] if upper else value, value if upper else OPEN_RANGE[1]):
+            return None
+    text = RANGE_BOUND.sub(consume, text)
+    filters.update({column: list(bounds) for column, bounds in ranges.items()})
+    
+    # Recent time windows end now; calendar days are whole days
+    windows = RELATIVE_WINDOW.findall(text) + [(day, None) for day in CALENDAR_DAY.findall(text)]
+    if len(windows) > 1:
+        return None
+    if windows:
+        count, unit = windows[0]
+        if unit is None:
+            start = datetime.combine(now.date(), datetime.min.time()) - timedelta(days=count == 'yesterday')
+            end = now if count == 'today' else datetime.combine(start.date(), datetime.max.time())
+        else:
+            start, end = now - int(count or 1) * WINDOW_UNITS[unit], now
+        filters['time_range'] = [start.isoformat(), end.isoformat()]
+        text = CALENDAR_DAY.sub(consume, RELATIVE_WINDOW.sub(consume, text))
+    
+    # Cities and countries take the role of the nearest direction word before them
+    names = sorted((city for city in cities if isinstance(city, str) and city.strip()), key=len, reverse=True)
+    by_name = {' '.join(city.casefold().split()): city for city in names}
+    places = []
+    if by_name:
+        city_pattern = re.compile(r'\b(' + '|'.join(re.escape(name) for name in by_name) + r')\b')
+        places += [(match, by_name[match.group(1)]) for match in city_pattern.finditer(text)]
+        text = city_pattern.sub(consume, text)
+    places += [(match, 'mexico' if match.group(0) == 'mexico' else 'us') for match in COUNTRY_NAMES.finditer(text)]
+    text = COUNTRY_NAMES.sub(consume, text)
+    
+    for match, place in sorted(places, key=lambda item: item[0].start()):
+        before = re.findall(r'[^\W\d_]+', text[:match.start()])
+        role = next((word for word in reversed(before) if word in DEST_WORDS | ORIGIN_WORDS | PLACE_WORDS), None)
+        if role is None:
+            return None
+        if role in PLACE_WORDS:
+            # "origin in Mexico", "from cities in Mexico": the place narrows the earlier direction
+            clause = re.findall(r'[^\W\d_]+', re.split(r'[,;.!?]', text[:match.start()])[-1])
+            role = next((word for word in reversed(clause) if word in DEST_WORDS | ORIGIN_WORDS), role)
+        if place in ('mexico', 'us'):
+            if role in ORIGIN_WORDS:
+                return None  # origin countries aren't in the filters schema
+            filters.setdefault('destinations', []).append(place)
+        else:
+            key = 'origin_cities' if role in ORIGIN_WORDS else 'dest_cities'
+            filters.setdefault(key, []).append(place)
+    
+    # Confident only if nothing is left over but connecting words
+    leftover = re.findall(r'[^\W_]+', text)
+    if not filters or any(word not in CHAT_PARSER_WORDS for word in leftover):
+        return None
+    for key in ('destinations', 'origin_cities', 'dest_cities'):
+        if key in filters:
+            filters[key] = list(dict.fromkeys(filters[key]))
+    return {'filters': filters}
+
+class ChatCache:
+    """Parsed chat responses in SQLite, looked up by normalized question, least recently used evicted first"""
+    
+    def __init__(self, path: str = CHAT_CACHE_PATH, entries: int = CHAT_CACHE_ENTRIES, ttl: float = CHAT_CACHE_TTL,
+                 relative_ttl: float = CHAT_CACHE_RELATIVE_TTL, similarity: float = CHAT_CACHE_SIMILARITY):
+        self.path = path
+        self.entries = entries
+        self.ttl = ttl
+        self.relative_ttl = relative_ttl
+        self.similarity = similarity
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS chat_cache (
+                    scope TEXT, query TEXT, tokens TEXT, numbers TEXT, response TEXT,
+                    expires REAL, used REAL, PRIMARY KEY (scope, query)
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS chat_cache_numbers ON chat_cache (scope, numbers)")
+    
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call, so sessions on different threads never share one
+        db = sqlite3.connect(self.path, timeout=5)
+        db.row_factory = sqlite3.Row
+        return db
+    
+    def get(self, query: str, scope: str = '', names: frozenset = frozenset()) -> Optional[Dict]:
+        """Cached response for a question, or for a similar enough one with the same numbers that differs
+        in no meaning word and none of the name tokens in names"""
+        normalized = normalize_query(query)
+        tokens = query_tokens(normalized)
+        now = time.time()
+        db = self._connect()
+        try:
+            with db:
+                row = db.execute(
+                    "SELECT query, response FROM chat_cache WHERE scope = ? AND query = ? AND expires > ?",
+                    (scope, normalized, now)
+                ).fetchone()
+                if row is None and self.similarity > 0:
+                    candidates = db.execute(
+                        "SELECT query, tokens, response FROM chat_cache WHERE scope = ? AND numbers = ? AND expires > ?",
+                        (scope, _query_numbers(tokens), now)
+                    ).fetchall()
+                    protected = CHAT_MEANING_WORDS | names
+                    scored = []
+                    for candidate in candidates:
+                        other = frozenset(json.loads(candidate['tokens']))
+                        if not (tokens ^ other) & protected:
+                            scored.append((token_similarity(tokens, other), candidate))
+                    scored = [(score, c) for score, c in scored if score >= self.similarity]
+                    row = max(scored, key=lambda pair: pair[0])[1] if scored else None
+                if row is not None:
+                    db.execute("UPDATE chat_cache SET used = ? WHERE scope = ? AND query = ?", (now, scope, row['query']))
+        finally:
+            db.close()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return json.loads(row['response']) if row is not None else None
+    
+    def put(self, query: str, response: Dict, scope: str = ''):
+        """Store a parsed response, then drop expired and least recently used entries"""
+        normalized = normalize_query(query)
+        tokens = query_tokens(normalized)
+        now = time.time()
+        ttl = self.relative_ttl if RELATIVE_TIME_PATTERN.search(normalized) else self.ttl
+        db = self._connect()
+        try:
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO chat_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (scope, normalized, json.dumps(sorted(tokens)), _query_numbers(tokens),
+                     json.dumps(response, default=str), now + ttl, now)
+                )
+                db.execute("DELETE FROM chat_cache WHERE expires <= ?", (now,))
+                db.execute(
+                    "DELETE FROM chat_cache WHERE rowid IN "
+                    "(SELECT rowid FROM chat_cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.entries,)
+                )
+        finally:
+            db.close()
+    
+    def stats(self) -> Dict:
+        """Hit and miss counts since the process started"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+@st.cache_resource
+def get_chat_cache() -> ChatCache:
+    """One chat cache per Streamlit process, backed by the file at CHAT_CACHE_PATH"""
+    return ChatCache()
+
+# Model requests run on a background thread within this latency budget, so a slow API never blocks a rerun
+CHAT_TIMEOUT_S = float(os.getenv('CHAT_TIMEOUT_S', '20'))
+# How often the page checks on a running request
+CHAT_POLL_S = 0.5
+
+def answer_without_model(user_query: str, df: pd.DataFrame, cache: Optional[ChatCache] = None,
+                         profile: str = '', usage_log: Optional[ChatUsageLog] = None) -> Optional[Tuple[Dict, str]]:
+    """Filters for a question parsed locally ("local") or from the chat cache ("cached"), or None if it needs the model"""
+    start = time.perf_counter()
+    cities = [city for col in CITY_COLUMNS for city in _city_categories(df[col])]
+    answer = parse_chat_query(user_query, cities)
+    if answer is not None:
+        answer = answer, "local"
+    elif cache is not None:
+        names = query_tokens(normalize_query(' '.join(map(str, cities))))
+        cached = cache.get(user_query, chat_scope(profile), names)
+        answer = (cached, "cached") if cached is not None else None
+    if answer is not None and usage_log is not None:
+        usage_log.record(user_query, answer[1], time.perf_counter() - start)
+    return answer
+
+def _parse_filters_response(content: str) -> Tuple[Dict, str]:
+    """The JSON object in a model reply"""
     try:
-        response = client.messages.create(
-            model="claude-3-5-haiku-20241022",
-            max_tokens=1000,
-            system=system_prompt,
-            messages=[{"role": "user", "content": user_query}]
-        )
-        
-        # Extract JSON from response
-        content = response.content[0].text
+        # Try to parse the JSON response
+        return json.loads(content), "success"
+    except json.JSONDecodeError:
+        # If JSON parsing fails, try to extract JSON from the response
+        json_match = re.search(r'\{.*\}', content, re.DOTALL)
+        if json_match:
+            try:
+                return json.loads(json_match.group()), "success"
+            except json.JSONDecodeError:
+                pass
+        return {}, f"Failed to parse LLM response: {content}"
+
+def check_chat_response(response: Dict, index: Dict):
+    """Raise ValueError unless the filters and aggregation of a chat answer apply to the dataset behind index"""
+    if 'aggregation' in response:
+        validate_aggregation(response['aggregation'])
+    if 'filters' in response:
+        compile_filter_plan(response['filters'], index)
+
+class ChatJob:
+    """One model request streaming on a background thread, given up once its latency budget runs out"""
+    
+    def __init__(self, user_query: str, client, cache: Optional[ChatCache] = None, budget: float = CHAT_TIMEOUT_S,
+                 profile: str = '', usage_log: Optional[ChatUsageLog] = None, index: Optional[Dict] = None):
+        self.query = user_query
+        self.cache = cache
+        # Answers are cached only once they check out against this data index
+        self.index = index if index is not None else {}
+        self.budget = budget
+        self.profile = profile
+        self.usage_log = usage_log
+        self.text = ''
+        self.first_token = None
+        self.usage = None
+        self.state = 'running'
+        self.error = ''
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stream = None
+        self.done = threading.Event()
+        threading.Thread(target=self._run, args=(client,), name='chat-request', daemon=True).start()
+    
+    def _run(self, client):
         try:
-            # Try to parse the JSON response
-            parsed_response = json.loads(content)
-            return parsed_response, "success"
-        except json.JSONDecodeError:
-            # If JSON parsing fails, try to extract JSON from the response
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
+            # The current time goes with the question, keeping the cached system prefix stable
+            with client.messages.stream(
+                model=CHAT_MODEL,
+                max_tokens=1000,
+                system=chat_system(self.profile),
+                messages=[{"role": "user", "content": f"Current time: {datetime.now():%Y-%m-%dT%H:%M}\n\n{self.query}"}],
+                timeout=self.budget
+            ) as stream:
+                self.stream = stream
+                for text in stream.text_stream:
+                    if self.state != 'running':
+                        return
+                    if self.first_token is None:
+                        self.first_token = self.elapsed()
+                    self.text += text
+                self.usage = stream.get_final_message().usage
+            response, status = _parse_filters_response(self.text)
+            cacheable = self.cache is not None and status == "success" and bool(response)
+            if cacheable:
                 try:
-                    parsed_response = json.loads(json_match.group())
-                    return parsed_response, "success"
-                except:
-                    pass
-            
-            return {}, f"Failed to parse LLM response: {content}"
-            
-    except Exception as e:
-        return {}, f"Error communicating with Anthropic: {str(e)}"
+                    check_chat_response(response, self.index)
+                except ValueError:
+                    cacheable = False
+            # A reply that lands after the job timed out or was cancelled is dropped, not cached
+            if not self._finish('done'):
+                return
+            if cacheable:
+                self.cache.put(self.query, response, chat_scope(self.profile))
+            if self.usage_log is not None:
+                self.usage_log.record(self.query, 'model', self.elapsed(), self.first_token, self.usage)
+        except Exception as e:
+            # The client's own timeout can fire just before the budget check does
+            self._finish('timeout' if isinstance(e, anthropic.APITimeoutError) else 'error', str(e))
+        finally:
+            self.done.set()
+    
+    def _finish(self, state: str, error: str = '') -> bool:
+        """Leave the running state, unless another thread already settled the job"""
+        with self.lock:
+            if self.state != 'running':
+                return False
+            self.state = state
+            self.error = error
+            return True
+    
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+    
+    def poll(self) -> str:
+        """Current state: running, done, error, timeout or cancelled"""
+        if self.state == 'running' and self.elapsed() > self.budget:
+            self.cancel('timeout')
+        return self.state
+    
+    def cancel(self, state: str = 'cancelled'):
+        """Stop waiting for the reply and close its connection"""
+        if not self._finish(state):
+            return
+        try:
+            if self.stream is not None:
+                self.stream.close()
+        except Exception:
+            pass
+    
+    def wait(self) -> Tuple[Dict, str]:
+        """Block until the reply arrives or the budget runs out"""
+        self.done.wait(max(0.0, self.budget - self.elapsed()))
+        self.poll()
+        return self.result()
+    
+    def result(self) -> Tuple[Dict, str]:
+        """(response, status) in the form chat_with_data returns"""
+        if self.state == 'done':
+            return _parse_filters_response(self.text)
+        if self.state == 'error':
+            return {}, f"Error communicating with Anthropic: {self.error}"
+        if self.state == 'timeout':
+            return {}, f"No answer from Anthropic within {self.budget:.0f} s"
+        if self.state == 'cancelled':
+            return {}, "Request cancelled"
+        return {}, "Still waiting for Anthropic"
+
+def chat_with_data(user_query: str, df: pd.DataFrame, client, cache: Optional[ChatCache] = None,
+                   budget: float = CHAT_TIMEOUT_S, index: Optional[Dict] = None) -> Tuple[Dict, str]:
+    """Return structured filters for a question about the dataset df: parsed locally when possible ("local"),
+    else from the chat cache ("cached"), else from Anthropic Claude ("success") within the latency budget"""
+    profile = chat_profile(df)
+    answer = answer_without_model(user_query, df, cache, profile)
+    if answer is not None:
+        return answer
+    if client is None:
+        return {}, "Anthropic client not available. Please set ANTHROPIC_API_KEY environment variable."
+    return ChatJob(user_query, client, cache, budget, profile, index=index).wait()
+
+def apply_chat_response(user_query: str, response: Dict):
+    """Apply the filters and aggregation of a chat answer, or record it in the chat history"""
+    if 'aggregation' in response:
+        # Checked here, so a bad spec is reported once instead of failing on every rerun
+        try:
+            spec = validate_aggregation(response['aggregation'])
+            st.session_state.chat_aggregation = {'question': user_query, 'spec': spec}
+        except ValueError as e:
+            st.session_state.chat_error = f"Can't compute this aggregation: {e}"
+    if 'filters' in response:
+        # A plan that doesn't fit the schema or the dataset is rejected before it reaches the filters
+        try:
+            plan = compile_filter_plan(response['filters'], st.session_state.data_index)
+        except ValueError as e:
+            st.session_state.chat_error = f"Can't apply these filters: {e}"
+        else:
+            st.session_state.filters.update(plan.filters())
+            st.session_state.applied_filters = plan.filters()
+            st.success("✅ Applied filters from chat!")
+            st.rerun()
+    
+    # Show response
+    st.json(response)
+    
+    # Add to chat history
+    st.session_state.chat_history.append({
+        'user': user_query,
+        'assistant': response,
+        'timestamp': datetime.now()
+    })
+
+def show_aggregation(result: pd.DataFrame, spec: Dict):
+    """Show an aggregation result as a metric, or as a chart and table per group"""
+    metric = result.columns[-1]
+    group_by = spec['group_by']
+    if group_by is None:
+        value = result[metric].iloc[0]
+        st.metric(metric.capitalize(), "n/a" if pd.isna(value) else f"{value:,.0f}" if metric == 'flights' else f"{value:,.1f}")
+        return
+    if result.empty:
+        st.info("No flights match the current filters")
+        return
+    if len(result) <= AGGREGATION_CHART_GROUPS:
+        chart = px.line if group_by == 'day' else px.bar
+        figure = chart(result, x=group_by, y=metric, hover_data=['flights'] if metric != 'flights' else None)
+        figure.update_layout(height=350, margin=dict(l=10, r=10, t=10, b=10))
+        st.plotly_chart(figure, use_container_width=True)
+    st.dataframe(result, use_container_width=True, hide_index=True)
+
+@st.fragment(run_every=CHAT_POLL_S)
+def chat_job_panel():
+    """Streams the running chat request; reruns on its own, so the rest of the page stays interactive"""
+    job = st.session_state.get('chat_job')
+    if job is None:
+        return
+    if job.poll() == 'running':
+        col1, col2 = st.columns([4, 1])
+        with col1:
+            st.caption(f"⏳ Asking Claude... {job.elapsed():.1f} s of {job.budget:.0f} s")
+        with col2:
+            if st.button("Cancel", key="cancel_chat"):
+                job.cancel()
+        if job.state == 'running':
+            if job.text:
+                st.code(job.text, language='json')
+            return
+    
+    # Finished: hand the answer to a full rerun so the map and KPIs pick up the new filters
+    st.session_state.chat_job = None
+    response, status = job.result()
+    if status == "success" and response:
+        apply_chat_response(job.query, response)
+    else:
+        st.session_state.chat_error = status
+    st.rerun()
 
 def reset_all_filters():
     """Reset all filters and chat history"""
@@ -792,136 +3702,292 @@ def main():
     # Initialize session state
     if 'data' not in st.session_state:
         st.session_state.data = None
+    if 'data_index' not in st.session_state:
+        st.session_state.data_index = {}
+    if 'upload_id' not in st.session_state:
+        st.session_state.upload_id = None
     if 'filters' not in st.session_state:
         st.session_state.filters = {}
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
     if 'applied_filters' not in st.session_state:
         st.session_state.applied_filters = {}
+    if 'chat_usage' not in st.session_state:
+        # Per session: the log holds the questions themselves
+        st.session_state.chat_usage = ChatUsageLog()
     
     # Sidebar
     with st.sidebar:
         st.header("📁 Data Upload")
-        uploaded_file = st.file_uploader(
-            "Upload CSV file",
-            type=['csv'],
-            help="Upload a CSV with columns: flight_id, origin_city, origin_lat, origin_lon, dest_city, dest_lat, dest_lon, timestamp, speed_kts, altitude_ft"
-        )
+        data_source = st.radio("Data source", ["CSV upload", "Parquet dataset"], horizontal=True)
         
-        if uploaded_file is not None:
-            if st.session_state.data is None:
+        if data_source == "CSV upload":
+            uploaded_file = st.file_uploader(
+                "Upload CSV file",
+                type=['csv'],
+                help="Upload a CSV with columns: flight_id, origin_city, origin_lat, origin_lon, dest_city, dest_lat, dest_lon, timestamp, speed_kts, altitude_ft"
+            )
+            
+            # Each new upload replaces the current data; reruns with the same upload skip hashing
+            if uploaded_file is not None and uploaded_file.file_id != st.session_state.upload_id:
                 with st.spinner("Processing CSV..."):
-                    st.session_state.data = load_and_process_csv(uploaded_file)
+                    progress_bar = st.progress(0.0, text="Processing CSV...")
+                    data = load_and_process_csv(uploaded_file, _progress=progress_bar.progress)
+                    progress_bar.empty()
+                    if data is not None:
+                        st.session_state.data = data
+                        st.session_state.data_index = get_data_index(data)
+                        st.session_state.upload_id = uploaded_file.file_id
+        else:
+            dataset_path = st.text_input(
+                "Parquet dataset path",
+                value=os.getenv('PARQUET_DATASET_DIR', ''),
+                help="A Parquet file, or a directory of Parquet files optionally partitioned as date=YYYY-MM-DD. "
+                     "Convert CSV exports with: python convert_to_parquet.py flights.csv <directory>"
+            )
             
-            if st.session_state.data is not None:
-                st.success(f"✅ Loaded {len(st.session_state.data)} flights")
+            if dataset_path and os.path.exists(dataset_path):
+                fingerprint = parquet_fingerprint(dataset_path)
+                bounds = parquet_time_bounds(dataset_path, fingerprint)
                 
-                # Manual filters
-                st.header("🔍 Manual Filters")
+                # Only partitions and row groups inside the window are read
+                load_window = None
+                if bounds:
+                    load_window = st.date_input(
+                        "Load window",
+                        value=(bounds[0].date(), bounds[1].date()),
+                        min_value=bounds[0].date(),
+                        max_value=bounds[1].date()
+                    )
+                push_filters = st.checkbox(
+                    "Only read flights matching current filters",
+                    value=False,
+                    help="Push the active altitude, speed, destination and city filters down to the reader"
+                )
                 
-                # Time range filter
-                if st.session_state.data is not None:
+                if st.button("📂 Load dataset", use_container_width=True):
+                    pushdown = dict(st.session_state.filters) if push_filters else {}
+                    if load_window and len(load_window) == 2:
+                        pushdown['time_range'] = [
+                            datetime.combine(load_window[0], datetime.min.time()),
+                            datetime.combine(load_window[1], datetime.max.time())
+                        ]
+                    with st.spinner("Reading Parquet dataset..."):
+                        data = load_parquet_dataset(dataset_path, pushdown, fingerprint)
+                    if data is not None and data.empty:
+                        st.warning("No flights in the dataset match the load window and filters")
+                    elif data is not None:
+                        st.session_state.data = data
+                        st.session_state.data_index = get_data_index(data)
+            elif dataset_path:
+                st.warning(f"Path not found: {dataset_path}")
+        
+        if st.session_state.data is not None:
+            st.success(f"✅ Loaded {len(st.session_state.data)} flights")
+            ingest = st.session_state.data.attrs.get('ingest', {})
+            st.caption(
+                f"{st.session_state.data_index.get('bytes_per_row', 0):.0f} bytes per flight in memory, "
+                f"loaded at {ingest.get('rows_per_sec', 0):,.0f} rows/s"
+            )
+            
+            # Manual filters
+            st.header("🔍 Manual Filters")
+            
+            # Time range filter
+            if st.session_state.data is not None:
+                # Bounds come from the data index instead of scanning the column each rerun
+                data_index = st.session_state.data_index
+                if 'time_min' in data_index:
+                    min_time, max_time = data_index['time_min'], data_index['time_max']
+                else:
                     min_time = st.session_state.data['timestamp'].min()
                     max_time = st.session_state.data['timestamp'].max()
-                    
-                    time_range = st.date_input(
-                        "Time Range",
-                        value=(min_time.date(), max_time.date()),
-                        min_value=min_time.date(),
-                        max_value=max_time.date()
-                    )
-                    
-                    if len(time_range) == 2:
-                        start_time = datetime.combine(time_range[0], datetime.min.time())
-                        end_time = datetime.combine(time_range[1], datetime.max.time())
-                        st.session_state.filters['time_range'] = [start_time, end_time]
                 
-                # Altitude range
-                if st.session_state.data is not None:
-                    min_alt = float(st.session_state.data['altitude_ft'].min())
-                    max_alt = float(st.session_state.data['altitude_ft'].max())
-                    
-                    altitude_range = st.slider(
-                        "Altitude Range (ft)",
-                        min_value=min_alt,
-                        max_value=max_alt,
-                        value=(min_alt, max_alt)
-                    )
-                    st.session_state.filters['altitude_range'] = altitude_range
+                time_range = st.date_input(
+                    "Time Range",
+                    value=(min_time.date(), max_time.date()),
+                    min_value=min_time.date(),
+                    max_value=max_time.date()
+                )
                 
-                # Speed range
-                if st.session_state.data is not None:
-                    min_speed = float(st.session_state.data['speed_kts'].min())
-                    max_speed = float(st.session_state.data['speed_kts'].max())
-                    
-                    speed_range = st.slider(
-                        "Speed Range (kts)",
-                        min_value=min_speed,
-                        max_value=max_speed,
-                        value=(min_speed, max_speed)
-                    )
-                    st.session_state.filters['speed_range'] = speed_range
+                if len(time_range) == 2:
+                    start_time = datetime.combine(time_range[0], datetime.min.time())
+                    end_time = datetime.combine(time_range[1], datetime.max.time())
+                    st.session_state.filters['time_range'] = [start_time, end_time]
+            
+            # Altitude range
+            if st.session_state.data is not None:
+                min_alt = float(st.session_state.data['altitude_ft'].min())
+                max_alt = float(st.session_state.data['altitude_ft'].max())
                 
-                # Destination filter
-                destinations = st.multiselect(
-                    "Destinations",
-                    options=["mexico", "us"],
-                    default=["mexico", "us"]
+                altitude_range = st.slider(
+                    "Altitude Range (ft)",
+                    min_value=min_alt,
+                    max_value=max_alt,
+                    value=(min_alt, max_alt)
                 )
-                if destinations:
-                    st.session_state.filters['destinations'] = destinations
-                
-                # City filters
-                if st.session_state.data is not None:
-                    origin_cities = st.multiselect(
-                        "Origin Cities",
-                        options=sorted(st.session_state.data['origin_city'].unique())
-                    )
-                    if origin_cities:
-                        st.session_state.filters['origin_cities'] = origin_cities
-                    
-                    dest_cities = st.multiselect(
-                        "Destination Cities",
-                        options=sorted(st.session_state.data['dest_city'].unique())
-                    )
-                    if dest_cities:
-                        st.session_state.filters['dest_cities'] = dest_cities
+                st.session_state.filters['altitude_range'] = altitude_range
+            
+            # Speed range
+            if st.session_state.data is not None:
+                min_speed = float(st.session_state.data['speed_kts'].min())
+                max_speed = float(st.session_state.data['speed_kts'].max())
                 
-                # Map display options
-                st.header("🗺️ Map Options")
-                show_flows = st.checkbox("Show Flow Lines", value=True)
-                show_markers = st.checkbox("Show Markers", value=True)
+                speed_range = st.slider(
+                    "Speed Range (kts)",
+                    min_value=min_speed,
+                    max_value=max_speed,
+                    value=(min_speed, max_speed)
+                )
+                st.session_state.filters['speed_range'] = speed_range
+            
+            # Destination filter
+            destinations = st.multiselect(
+                "Destinations",
+                options=["mexico", "us"],
+                default=["mexico", "us"]
+            )
+            if destinations:
+                st.session_state.filters['destinations'] = destinations
+            
+            # City filters
+            if st.session_state.data is not None:
+                origin_cities = st.multiselect(
+                    "Origin Cities",
+                    options=st.session_state.data_index['origin_city_options']
+                )
+                if origin_cities:
+                    st.session_state.filters['origin_cities'] = origin_cities
                 
-                # Reset and Quick preset chips
-                st.header("🔄 Reset & Quick Presets")
+                dest_cities = st.multiselect(
+                    "Destination Cities",
+                    options=st.session_state.data_index['dest_city_options']
+                )
+                if dest_cities:
+                    st.session_state.filters['dest_cities'] = dest_cities
                 
-                # Reset button - prominent placement
-                if st.button("🔄 Reset All Filters", type="primary", use_container_width=True):
-                    reset_all_filters()
-                    st.rerun()
+                # Area filters, answered from the spatial grids
+                in_view = st.checkbox(
+                    "Only flights in map view",
+                    value=False,
+                    help="Keep flights whose origin or destination is inside the visible map area"
+                )
+                viewport = map_viewport(st.session_state.get('flight_map')) if in_view else None
+                if viewport:
+                    st.session_state.filters['viewport'] = viewport
+                else:
+                    st.session_state.filters.pop('viewport', None)
                 
+                crossing = st.selectbox("Near border crossing", ["Anywhere"] + list(BORDER_CROSSINGS))
+                for key in ('origin_radius', 'dest_radius'):
+                    st.session_state.filters.pop(key, None)
+                if crossing != "Anywhere":
+                    radius_km = st.slider("Within (km)", min_value=5, max_value=200, value=50, step=5)
+                    end = st.radio("Flight end", ["Destination", "Origin"], horizontal=True)
+                    key = 'dest_radius' if end == "Destination" else 'origin_radius'
+                    st.session_state.filters[key] = [*BORDER_CROSSINGS[crossing], float(radius_km)]
+            
+            # Map display options
+            st.header("🗺️ Map Options")
+            show_flows = st.checkbox("Show Flow Lines", value=True)
+            flow_style = st.radio(
+                "Flow Lines",
+                ["Routes", "Individual flights"],
+                horizontal=True,
+                help="Routes draw one line per origin-destination pair, weighted by flight count"
+            )
+            route_key = st.radio(
+                "Group routes by",
+                ["City pair", "Snapped coordinates"],
+                horizontal=True,
+                disabled=flow_style != "Routes",
+                help="Snapped coordinates split city pairs into ~1 km launch and landing sites"
+            )
+            show_markers = st.checkbox("Show Markers", value=True)
+            use_tiles = st.checkbox(
+                "Zoom-aware tiles",
+                value=False,
+                help="Serve per-zoom aggregates from a local tile server so the browser only loads the tiles in view. "
+                     "Set TILE_SERVER_URL if the browser can't reach this machine on localhost."
+            )
+            approximate_kpis = st.checkbox(
+                "Approximate KPIs",
+                value=False,
+                help="Merge per-day HyperLogLog and heavy-hitter sketches for unique counts and top destinations. "
+                     "Used for time window and country filters; other filters fall back to exact counts."
+            )
+            
+            # Reset and Quick preset chips
+            st.header("🔄 Reset & Quick Presets")
+            
+            # Reset button - prominent placement
+            if st.button("🔄 Reset All Filters", type="primary", use_container_width=True):
+                reset_all_filters()
+                st.rerun()
+            
     # Main content
     if st.session_state.data is not None:
         
         
         # Map
         st.subheader("🗺️ Flight Map")
+        # Chat filters win over the sidebar widgets, which rewrite their keys on every rerun
+        st.session_state.filters.update(st.session_state.applied_filters)
+        
        # Apply filters
-        filtered_data = apply_filters(st.session_state.data, st.session_state.filters)
+        filtered_data = apply_filters(
+            st.session_state.data, st.session_state.filters, st.session_state.data_index
+        )
          
-        # Create map
-        map_obj = create_map(
-            filtered_data,
+        # Tile pyramids, samples and layers are built once per dataset and filter combination
+        selection = selection_key(st.session_state.data, st.session_state.filters)
+        tile_url = None
+        if locals().get('use_tiles') and selection and not filtered_data.empty:
+            tile_url = get_tile_server().register(
+                hashlib.sha256(selection.encode()).hexdigest()[:16],
+                lambda: build_tile_pyramid(filtered_data)
+            )
+        
+        layer_options = dict(
             show_flows=show_flows if 'show_flows' in locals() else True,
-            show_markers=show_markers if 'show_markers' in locals() else True
+            show_markers=show_markers if 'show_markers' in locals() else True,
+            flow_style='routes' if locals().get('flow_style', "Routes") == "Routes" else 'flights',
+            route_key='city' if locals().get('route_key', "City pair") == "City pair" else 'coords',
+            tile_url=tile_url,
+            selection=selection
         )
         
         # Display map
-        folium_static(map_obj, width=1200, height=600)
+        center = st.session_state.data_index.get('center') or map_center(st.session_state.data)
+        if st_folium is not None:
+            # The base map stays mounted in the browser; reruns only swap the flight layers
+            st_folium(
+                create_base_map(center),
+                key="flight_map",
+                feature_group_to_add=create_map_layers(filtered_data, **layer_options),
+                layer_control=folium.LayerControl(),
+                width=1200,
+                height=600,
+                # Panning only reruns the app when the viewport filter needs the new bounds
+                returned_objects=['bounds'] if locals().get('in_view') else []
+            )
+        else:
+            folium_static(create_map(filtered_data, center, **layer_options), width=1200, height=600)
+        layer_cache = get_layer_cache().stats()
+        st.caption(
+            f"Layer cache: {layer_cache['hits']:,} hits, {layer_cache['misses']:,} misses, "
+            f"{layer_cache['layers']} of {layer_cache['entries']} layers kept"
+        )
         
         
         # Calculate KPIs
-        kpis = calculate_kpis(filtered_data)
+        kpis = selection_kpis(
+            filtered_data, st.session_state.filters, st.session_state.data_index, selection,
+            approximate=locals().get('approximate_kpis', False)
+        )
+        approximate = kpis.get('approximate')
+        if locals().get('approximate_kpis') and not approximate:
+            st.caption("Approximate KPIs only cover time window and country filters; showing exact values")
         
         # KPI Cards with Reset Button
         col1, col2, col3, col4, col5 = st.columns([1, 1, 1, 1, 1])
@@ -929,11 +3995,14 @@ def main():
         with col1:
             st.metric("Total Flights", f"{kpis['total_flights']:,}")
         
+        # Estimated unique counts are marked with ≈ and their standard error
+        unique_prefix = "≈" if approximate else ""
+        unique_help = f"HyperLogLog estimate, ±{approximate['unique_error']:.1%} standard error" if approximate else None
         with col2:
-            st.metric("Unique Origins", f"{kpis['unique_origins']:,}")
+            st.metric("Unique Origins", f"{unique_prefix}{kpis['unique_origins']:,}", help=unique_help)
         
         with col3:
-            st.metric("Unique Destinations", f"{kpis['unique_destinations']:,}")
+            st.metric("Unique Destinations", f"{unique_prefix}{kpis['unique_destinations']:,}", help=unique_help)
         
         with col4:
             st.metric("Avg Altitude", f"{kpis['avg_altitude']:.0f} ft")
@@ -947,6 +4016,8 @@ def main():
         # Top destinations
         if kpis['top_destinations']:
             st.subheader("Top 5 Destination Cities")
+            if approximate:
+                st.caption(f"Approximate: each count may be low by up to {approximate['top_error']:,} flights")
             dest_cols = st.columns(len(kpis['top_destinations']))
             for i, (city, count) in enumerate(kpis['top_destinations'].items()):
                 with dest_cols[i]:
@@ -968,32 +4039,57 @@ def main():
             ask_clicked = st.button("Ask", type="primary", disabled=not user_query.strip())
         
         if ask_clicked and user_query.strip():
-            client = get_anthropic_client()
-            if client:
-                with st.spinner("Processing your question..."):
-                    response, status = chat_with_data(user_query, filtered_data, client)
-                    
-                    if status == "success" and response:
-                        # Apply filters from chat
-                        if 'filters' in response:
-                            st.session_state.filters.update(response['filters'])
-                            st.session_state.applied_filters = response['filters']
-                            st.success("✅ Applied filters from chat!")
-                            st.rerun()
-                        
-                        # Show response
-                        st.json(response)
-                        
-                        # Add to chat history
-                        st.session_state.chat_history.append({
-                            'user': user_query,
-                            'assistant': response,
-                            'timestamp': datetime.now()
-                        })
-                    else:
-                        st.error(f"❌ {status}")
+            # Common filter questions and questions answered before don't call the API
+            # The model sees a profile of the whole dataset, not just the current selection
+            profile = chat_profile(st.session_state.data)
+            answer = answer_without_model(user_query, st.session_state.data, get_chat_cache(), profile,
+                                          st.session_state.chat_usage)
+            if answer is not None:
+                apply_chat_response(user_query, answer[0])
             else:
-                st.error("Anthropic client not available. Please set ANTHROPIC_API_KEY environment variable.")
+                client = get_anthropic_client()
+                if client:
+                    # The request runs in the background; the panel below streams it in
+                    if st.session_state.get('chat_job') is not None:
+                        st.session_state.chat_job.cancel()
+                    st.session_state.chat_job = ChatJob(user_query, client, get_chat_cache(), profile=profile,
+                                                        usage_log=st.session_state.chat_usage,
+                                                        index=st.session_state.data_index)
+                else:
+                    st.error("Anthropic client not available. Please set ANTHROPIC_API_KEY environment variable.")
+        
+        if st.session_state.get('chat_job') is not None:
+            chat_job_panel()
+        if st.session_state.get('chat_error'):
+            st.error(f"❌ {st.session_state.pop('chat_error')}")
+        
+        # The latest chat aggregation, recomputed over the current selection as filters change
+        aggregation = st.session_state.get('chat_aggregation')
+        if aggregation:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.markdown(f"**📊 {aggregation['question']}**")
+            with col2:
+                if st.button("Clear", key="clear_chat_aggregation"):
+                    st.session_state.pop('chat_aggregation')
+                    st.rerun()
+            show_aggregation(aggregate_selection(filtered_data, aggregation['spec'], selection), aggregation['spec'])
+        
+        chat_cache = get_chat_cache().stats()
+        if chat_cache['hits'] or chat_cache['misses']:
+            st.caption(f"Chat cache: {chat_cache['hits']:,} hits, {chat_cache['misses']:,} misses")
+        
+        # Tokens and latency per question, to compare model calls with local and cached answers
+        chat_usage = st.session_state.chat_usage.frame()
+        if not chat_usage.empty:
+            with st.expander("📈 Chat usage"):
+                model_calls = chat_usage[chat_usage['source'] == 'model']
+                st.caption(
+                    f"{len(chat_usage) - len(model_calls)} of {len(chat_usage)} questions answered without the model; "
+                    f"{model_calls['input_tokens'].sum():,} input tokens sent, "
+                    f"{model_calls['cache_read_input_tokens'].sum():,} read from the prompt cache"
+                )
+                st.dataframe(chat_usage, use_container_width=True, hide_index=True)
         
         # Chat history
         if st.session_state.chat_history:
@@ -1012,6 +4108,9 @@ def main():
                 st.info("🎯 **Applied via chat:** " + ", ".join([f"{k}: {v}" for k, v in st.session_state.applied_filters.items()]))
             with col2:
                 if st.button("Clear Chat Filters", key="clear_chat_filters"):
+                    # The sidebar sets its own values again on the rerun
+                    for key in st.session_state.applied_filters:
+                        st.session_state.filters.pop(key, None)
                     st.session_state.applied_filters = {}
                     st.rerun()
         
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+"""
+Benchmark script for the Drone Flight Mapper data pipeline
+Compares the current implementations against the previous ones on synthetic data.
+Timing only; test_app.py checks the results.
+
+Usage:
+    python benchmark.py                          # every benchmark at its default sizes
+    python benchmark.py filters --rows 200000    # one benchmark, custom row counts
+    python benchmark.py ingest --rows 5000000
+    python benchmark.py flows --rows 1000 10000
+    python benchmark.py heatmap
+    python benchmark.py tiles
+    python benchmark.py markers
+    python benchmark.py update
+    python benchmark.py kpis
+    python benchmark.py sketches
+    python benchmark.py aggregations
+    python benchmark.py chat
+    python benchmark.py chat-stream
+    python benchmark.py chat-profile
+    python benchmark.py plans
+    python benchmark.py spatial
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import folium
+from folium.plugins import HeatMap, MarkerCluster
+import numpy as np
+import pandas as pd
+
+import app
+from testkit import (AGGREGATION_CASES, CACHE_MIN_TOKENS, FILTER_CASES, PLAN_CASES, SPATIAL_CASES, FakeAnthropicServer,
+                     legacy_apply_filters, make_flights, make_wide_flights, pandas_aggregation)
+
+def best_of(func, repeats: int = 3) -> float:
+    """Return the best wall-clock time of several runs in seconds"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def bench_filters(n_rows: int):
+    """Time legacy vs fused apply_filters"""
+    print(f"\n🔍 apply_filters @ {n_rows:,} rows")
+    # The legacy path ran on plain string columns, unsorted by ingest
+    raw = make_flights(n_rows).sort_values('timestamp', kind='stable')
+    # Same encoding and row order as load_and_process_csv produces
+    df = raw.astype({col: 'category' for col in app.CITY_COLUMNS})
+    index = app.build_data_index(df)
+
+    for name, filters in FILTER_CASES.items():
+        actual = app.apply_filters(df, filters, index)
+        legacy = best_of(lambda: legacy_apply_filters(raw, filters))
+        fused = best_of(lambda: app.apply_filters(df, filters, index))
+        print(f"  {name:<18} {len(actual):>10,} rows  "
+              f"legacy {legacy * 1000:8.1f} ms  fused {fused * 1000:8.1f} ms  "
+              f"({legacy / fused:4.1f}x)")
+
+def bench_spatial(n_rows: int):
+    """Time area filters through the spatial grids against a column scan"""
+    print(f"\n📍 area filters @ {n_rows:,} rows")
+    # Spread the city coordinates over launch sites ~30 km around each city
+    rng = np.random.default_rng(5)
+    df = make_flights(n_rows).sort_values('timestamp', kind='stable').reset_index(drop=True)
+    for col in app.COORD_COLUMNS:
+        df[col] = (df[col] + rng.normal(0, 0.3, n_rows)).astype('float32')
+    df = df.astype({col: 'category' for col in app.CITY_COLUMNS})
+    start = time.perf_counter()
+    grids = [app.build_spatial_grid(df[f'{end}_lat'].to_numpy(), df[f'{end}_lon'].to_numpy()) for end in app.SPATIAL_ENDPOINTS]
+    print(f"  grid build {(time.perf_counter() - start) * 1000:7.1f} ms  occupied cells {[len(grid['cells']) for grid in grids]}")
+    index = app.build_data_index(df)
+    scan_index = {key: value for key, value in index.items() if not key.endswith('_grid')}
+    
+    for name, filters in SPATIAL_CASES.items():
+        rows = app.filter_positions(df, filters, index)
+        scan = best_of(lambda: app.filter_positions(df, filters, scan_index))
+        grid = best_of(lambda: app.filter_positions(df, filters, index))
+        print(f"  {name:<18} {len(rows):>10,} rows  scan {scan * 1000:7.1f} ms  grid {grid * 1000:7.1f} ms  "
+              f"({scan / grid:4.1f}x)")
+
+def legacy_load_csv(path: str) -> pd.DataFrame:
+    """load_and_process_csv before the compact schema: untyped read, then a numeric pass"""
+    df = pd.read_csv(path)
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    for col in app.COORD_COLUMNS + app.MEASURE_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df.dropna(subset=app.COORD_COLUMNS)
+
+def _proc_status_mb(field: str) -> float:
+    """Read a memory field of this process from /proc/self/status in MB"""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (reset on exec, unlike ru_maxrss)"""
+    return _proc_status_mb('VmHWM')
+
+def current_rss_mb() -> float:
+    """Current resident set size of this process in MB"""
+    return _proc_status_mb('VmRSS')
+
+def ingest_worker(loader: str, path: str):
+    """Load one CSV in a fresh process and print its memory footprint as JSON"""
+    # The uncached readers, so st.cache_data's pickled copy of the result is not measured
+    load = {
+        'legacy': legacy_load_csv,
+        'compact': app.read_flights_csv,
+        'parquet': app.read_parquet_dataset,
+    }[loader]
+    baseline = current_rss_mb()
+    start = time.perf_counter()
+    df = load(path)
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        'rows': len(df),
+        'seconds': seconds,
+        'bytes_per_row': df.memory_usage(deep=True).sum() / len(df),
+        'peak_rss_mb': peak_rss_mb() - baseline,
+    }))
+
+def bench_ingest(n_rows: int):
+    """Compare bytes per row and peak RSS of the legacy, compact CSV and Parquet loaders"""
+    print(f"\n📥 load_and_process_csv @ {n_rows:,} rows")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'flights.csv')
+        make_flights(n_rows).to_csv(path, index=False)
+        print(f"  CSV size {os.path.getsize(path) / 1e6:,.0f} MB")
+        parquet_dir = os.path.join(tmp, 'parquet')
+        app.write_parquet_dataset(app.read_flights_csv(path), parquet_dir)
+
+        for loader, source in (('legacy', path), ('compact', path), ('parquet', parquet_dir)):
+            # Each loader runs in its own interpreter so peak RSS is not shared
+            result = subprocess.run(
+                [sys.executable, __file__, '--ingest-worker', loader, source],
+                capture_output=True, text=True, check=True
+            )
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"  {loader:<8} {stats['bytes_per_row']:6.1f} bytes/row  "
+                  f"peak RSS +{stats['peak_rss_mb']:7.0f} MB  "
+                  f"{stats['seconds']:6.1f} s")
+
+def legacy_flow_layer(m: folium.Map, df: pd.DataFrame):
+    """The flow layer create_map built before FlowLinesLayer: one PolyLine and popup per row"""
+    for _, row in df.iterrows():
+        points = [
+            [row['origin_lat'], row['origin_lon']],
+            [row['dest_lat'], row['dest_lon']]
+        ]
+        folium.PolyLine(
+            points,
+            color='red',
+            weight=2,
+            opacity=0.6,
+            popup=f"Flight: {row['flight_id']}<br>"
+                  f"From: {row['origin_city']}<br>"
+                  f"To: {row['dest_city']}<br>"
+                  f"Altitude: {row['altitude_ft']:.0f} ft<br>"
+                  f"Speed: {row['speed_kts']:.0f} kts"
+        ).add_to(m)
+
+def vectorized_flow_layer(m: folium.Map, df: pd.DataFrame):
+    """The flow layer create_map builds now"""
+    app.FlowLinesLayer(df, name='Flow Lines').add_to(m)
+
+def route_flow_layer(m: folium.Map, df: pd.DataFrame):
+    """The default flow layer: one weighted edge per city pair"""
+    app.RouteEdgesLayer(app.aggregate_routes(df), name='Flow Lines').add_to(m)
+
+def build_layer_map(add_layer, df: pd.DataFrame) -> str:
+    """Build a map holding only the given layer and render it to HTML"""
+    m = folium.Map(location=[28.0, -102.0], zoom_start=6)
+    add_layer(m, df)
+    return m.get_root().render()
+
+def bench_flows(n_rows: int):
+    """Compare build time and HTML size of the per-row, vectorized and route flow layers"""
+    print(f"\n🗺️  flow layer @ {n_rows:,} flows")
+    df = make_flights(n_rows).astype({col: 'category' for col in app.CITY_COLUMNS})
+    for name, add_layer in (('legacy', legacy_flow_layer), ('vectorized', vectorized_flow_layer),
+                            ('routes', route_flow_layer)):
+        start = time.perf_counter()
+        html = build_layer_map(add_layer, df)
+        seconds = time.perf_counter() - start
+        print(f"  {name:<10} build {seconds * 1000:9.1f} ms  "
+              f"HTML {len(html.encode()) / 1e6:8.2f} MB  "
+              f"({len(html.encode()) / n_rows:6.0f} bytes/flow)")
+
+def legacy_heatmap_layer(m: folium.Map, df: pd.DataFrame):
+    """The heatmap create_map built before pre-binning: one weighted point per row"""
+    heatmap_data = df[['dest_lat', 'dest_lon', 'altitude_ft']].astype('float64').values.tolist()
+    HeatMap(heatmap_data, name='Destination Heatmap', radius=20, blur=15, max_zoom=13).add_to(m)
+
+def binned_heatmap_layer(m: folium.Map, df: pd.DataFrame):
+    """The heatmap create_map builds now, from non-empty grid cells"""
+    app.DestinationHeatLayer(app.bin_destinations(df), name='Destination Heatmap').add_to(m)
+
+def bench_heatmap(n_rows: int):
+    """Compare build time and HTML size of the per-row and pre-binned heatmaps"""
+    print(f"\n🔥 heatmap layer @ {n_rows:,} rows")
+    df = make_flights(n_rows)
+    for name, add_layer in (('legacy', legacy_heatmap_layer), ('binned', binned_heatmap_layer)):
+        start = time.perf_counter()
+        html = build_layer_map(add_layer, df)
+        seconds = time.perf_counter() - start
+        print(f"  {name:<10} build {seconds * 1000:9.1f} ms  HTML {len(html.encode()) / 1e6:8.2f} MB")
+
+def legacy_marker_layer(m: folium.Map, df: pd.DataFrame):
+    """The marker layer create_map built before FlightMarkersLayer: two Markers and popups per row"""
+    marker_cluster = MarkerCluster(name='Flight Markers')
+    for _, row in df.iterrows():
+        folium.Marker(
+            [row['origin_lat'], row['origin_lon']],
+            popup=f"<b>Origin</b><br>"
+                  f"City: {row['origin_city']}<br>"
+                  f"Flight: {row['flight_id']}<br>"
+                  f"Time: {row['timestamp'].strftime('%Y-%m-%d %H:%M')}",
+            icon=folium.Icon(color='green', icon='plane')
+        ).add_to(marker_cluster)
+        folium.Marker(
+            [row['dest_lat'], row['dest_lon']],
+            popup=f"<b>Destination</b><br>"
+                  f"City: {row['dest_city']}<br>"
+                  f"Flight: {row['flight_id']}<br>"
+                  f"Altitude: {row['altitude_ft']:.0f} ft<br>"
+                  f"Speed: {row['speed_kts']:.0f} kts",
+            icon=folium.Icon(color='red', icon='flag')
+        ).add_to(marker_cluster)
+    marker_cluster.add_to(m)
+
+def bulk_marker_layer(m: folium.Map, df: pd.DataFrame):
+    """The marker layer create_map builds now"""
+    app.FlightMarkersLayer(df, name='Flight Markers').add_to(m)
+
+def bench_markers(n_rows: int):
+    """Compare build time and HTML size of per-row folium Markers and the packed marker layer"""
+    print(f"\n📍 marker layer @ {n_rows:,} flights ({2 * n_rows:,} markers)")
+    df = make_flights(n_rows).astype({col: 'category' for col in app.CITY_COLUMNS})
+    layers = [('bulk', bulk_marker_layer)]
+    # The per-row layer was capped at 500 flights; past that it takes minutes
+    if n_rows <= 10_000:
+        layers.insert(0, ('legacy', legacy_marker_layer))
+    for name, add_layer in layers:
+        start = time.perf_counter()
+        html = build_layer_map(add_layer, df)
+        seconds = time.perf_counter() - start
+        print(f"  {name:<10} build {seconds * 1000:9.1f} ms  HTML {len(html.encode()) / 1e6:8.2f} MB")
+
+def bench_kpis(n_rows: int):
+    """Time KPIs from a row scan, from the KPI cubes and from the memo"""
+    print(f"\n📊 KPIs @ {n_rows:,} rows")
+    df = make_flights(n_rows).sort_values('timestamp', kind='stable')
+    df = df.astype({col: 'category' for col in app.CITY_COLUMNS}).reset_index(drop=True)
+    start = time.perf_counter()
+    cubes = app.build_kpi_cubes(df)
+    print(f"  cube build {(time.perf_counter() - start) * 1000:7.1f} ms  cells per level {[len(cube['flights']) for cube in cubes]}")
+    index = app.build_data_index(df)
+
+    for name, filters in FILTER_CASES.items():
+        selection = app.apply_filters(df, filters, index)
+        scan = best_of(lambda: app.calculate_kpis(app.apply_filters(df, filters, index)))
+        key = app.selection_key(df, filters)
+        app.selection_kpis(selection, filters, index, key)
+        memo = best_of(lambda: app.selection_kpis(selection, filters, index, key))
+        answered = next((kpis for kpis in (app.cube_kpis(cube, filters) for cube in index['kpi_cubes']) if kpis), None)
+        if answered is None:
+            print(f"  {name:<18} scan {scan * 1000:8.1f} ms  cube      n/a      memo {memo * 1000:6.2f} ms")
+            continue
+        cube = best_of(lambda: app._selection_kpis(selection, filters, index))
+        print(f"  {name:<18} scan {scan * 1000:8.1f} ms  cube {cube * 1000:8.1f} ms  memo {memo * 1000:6.2f} ms")
+
+def bench_aggregations(n_rows: int):
+    """Time chat aggregations on category codes against a pandas groupby and from the memo"""
+    print(f"\n🧾 chat aggregations @ {n_rows:,} rows")
+    df = make_flights(n_rows).astype({col: 'category' for col in app.CITY_COLUMNS})
+    df.attrs['dataset_key'] = 'bench-aggregations'
+    key = app.selection_key(df, {})
+    for name, raw in AGGREGATION_CASES.items():
+        spec = app.validate_aggregation(raw)
+        result = app.run_aggregation(df, spec)
+        groupby = best_of(lambda: pandas_aggregation(df, spec))
+        codes = best_of(lambda: app.run_aggregation(df, spec))
+        app.aggregate_selection(df, spec, key)
+        memo = best_of(lambda: app.aggregate_selection(df, spec, key))
+        print(f"  {name:<22} groupby {groupby * 1000:7.1f} ms  codes {codes * 1000:7.1f} ms  "
+              f"memo {memo * 1000:5.2f} ms  ({len(result)} groups)")
+
+def bench_sketches(n_rows: int):
+    """Time approximate KPIs from the sketches against the exact scan, and how far off they are"""
+    print(f"\n🧮 KPI sketches @ {n_rows:,} rows")
+    df = make_wide_flights(n_rows)
+    start = time.perf_counter()
+    sketches = app.build_kpi_sketches(df)
+    print(f"  sketch build {(time.perf_counter() - start) * 1000:7.1f} ms  partitions {len(sketches['flights']):,}")
+    index = app.build_data_index(df)
+    
+    for name in ('sidebar defaults', 'time window only'):
+        filters = FILTER_CASES[name]
+        exact = app.calculate_kpis(app.apply_filters(df, filters, index))
+        approx = app.sketch_kpis(sketches, filters)
+        scan = best_of(lambda: app.calculate_kpis(app.apply_filters(df, filters, index)))
+        sketch = best_of(lambda: app.sketch_kpis(sketches, filters))
+        bound = approx['approximate']
+
+        errors = [abs(approx[key] / exact[key] - 1) for key in ('unique_origins', 'unique_destinations')]
+        print(f"  {name:<18} scan {scan * 1000:8.1f} ms  sketch {sketch * 1000:6.1f} ms  "
+              f"unique error {max(errors):6.2%} (±{bound['unique_error']:.1%} s.e.)  top error bound {bound['top_error']:,}")
+
+def bench_plans(n_rows: int):
+    """Time compiling chat filter blocks into plans, and rejecting bad ones, against the scan they stand in front of"""
+    print(f"\n🧭 chat filter plans @ {n_rows:,} rows")
+    df = make_flights(n_rows).sort_values('timestamp', kind='stable')
+    df = df.astype({col: 'category' for col in app.CITY_COLUMNS}).reset_index(drop=True)
+    index = app.build_data_index(df)
+    for case, (filters, _) in PLAN_CASES.items():
+        compile_time = best_of(lambda: _compile_or_reject(filters, index))
+        plan = _compile_or_reject(filters, index)
+        scan = best_of(lambda: app.apply_filters(df, plan, index)) if plan else None
+        outcome = f"scan {scan * 1000:7.1f} ms" if plan else "rejected before any scan"
+        print(f"  {case:<15} compile {compile_time * 1000:7.2f} ms  {outcome}")
+    
+    # Fuzzy matching compares against every known name, so it is timed on a large vocabulary too
+    sites = {'dest_city_options': [f'Site {i:05d}' for i in range(50_000)]}
+    sites['dest_city_folded'] = app.fold_cities(sites['dest_city_options'])
+    for name in ('site 00042', 'Siet 00042'):
+        snap = best_of(lambda: app.compile_filter_plan({'dest_cities': [name]}, sites))
+        plan = app.compile_filter_plan({'dest_cities': [name]}, sites)
+        print(f"  {name!r:<15} compile {snap * 1000:7.2f} ms  among 50,000 sites -> {plan.dest_cities[0]}")
+
+def _compile_or_reject(filters: dict, index: dict):
+    """The compiled plan, or None if it is rejected"""
+    try:
+        return app.compile_filter_plan(filters, index)
+    except ValueError:
+        return None
+
+# Questions the local parser answers
+CHAT_LOCAL_QUESTIONS = [
+    "Flights to Laredo above 500 ft",
+    "Only destinations in Mexico, altitude < 1000 ft",
+    "speed 20–60 kts",
+    "Flights from San Diego to Tijuana and Nuevo Laredo",
+    "Flights to the US between 1,000 and 2,000 feet",
+]
+
+# Questions for the model; the rewordings of the first one are fuzzy cache hits
+CHAT_QUESTIONS = [
+    "Compare McAllen vs Brownsville by average altitude",
+    "compare mcallen vs brownsville  by average altitude?",
+    "Please compare McAllen vs Brownsville by average altitude",
+    "By average altitude, compare Brownsville vs McAllen",
+    "Compare McAllen vs Laredo by average altitude",
+    "Top 3 routes by flight count",
+    "Top 5 routes by flight count",
+    "Average speed of flights to Laredo over the last 24 hours",
+]
+
+def bench_chat(n_rows: int):
+    """Latency and API calls per question for the local parser and the chat cache, against a fake API server"""
+    server = FakeAnthropicServer()
+    client = server.client()
+    print(f"\n💬 chat questions over {n_rows:,} flights (fake API, {server.first_token_delay * 1000:.0f} ms to first token)")
+    df = make_flights(n_rows).astype({col: 'category' for col in app.CITY_COLUMNS})
+    index = app.build_data_index(df)
+    with tempfile.TemporaryDirectory() as directory:
+        # Relative-time answers expire immediately here, so they never come back from the cache;
+        # fuzzy matching is opt-in
+        cache = app.ChatCache(os.path.join(directory, 'chat.sqlite3'), relative_ttl=0, similarity=0.85)
+
+        timings = []
+        for question in CHAT_LOCAL_QUESTIONS:
+            start = time.perf_counter()
+            app.chat_with_data(question, df, client, cache)
+            timings.append(time.perf_counter() - start)
+        print(f"  {'parsed':<12} median {np.median(timings) * 1000:7.1f} ms  API calls {server.calls}/{len(timings)}")
+
+        for label in ('first ask', 'asked again'):
+            timings, calls = [], server.calls
+            for question in CHAT_QUESTIONS:
+                start = time.perf_counter()
+                app.chat_with_data(question, df, client, cache, index=index)
+                timings.append(time.perf_counter() - start)
+            print(f"  {label:<12} median {np.median(timings) * 1000:7.1f} ms  "
+                  f"API calls {server.calls - calls}/{len(CHAT_QUESTIONS)}")
+        print(f"  cache hits {cache.hits}, misses {cache.misses}")
+    server.shutdown()
+
+def bench_chat_stream(n_rows: int):
+    """A model request in the background: reruns keep going, partial JSON streams in, slow replies time out"""
+    server = FakeAnthropicServer(first_token_delay=0.5, chunk_delay=0.05)
+    client = server.client()
+    print(f"\n⏳ background chat request over {n_rows:,} flights "
+          f"(fake API, {server.first_token_delay * 1000:.0f} ms to first token, {server.chunk_delay * 1000:.0f} ms per chunk)")
+    df = make_flights(n_rows).sort_values('timestamp', kind='stable')
+    df = df.astype({col: 'category' for col in app.CITY_COLUMNS}).reset_index(drop=True)
+    index = app.build_data_index(df)
+    question = CHAT_QUESTIONS[0]
+
+    # The script thread keeps filtering and computing KPIs while the reply streams in
+    job = app.ChatJob(question, client)
+    reruns, partials = [], set()
+    while job.poll() == 'running':
+        start = time.perf_counter()
+        app.calculate_kpis(app.apply_filters(df, FILTER_CASES['narrow window'], index))
+        reruns.append(time.perf_counter() - start)
+        partials.add(job.text)
+    print(f"  answered in {job.elapsed() * 1000:6.0f} ms; meanwhile {len(reruns)} reruns "
+          f"(median {np.median(reruns) * 1000:.1f} ms), {len(partials - {''})} partial replies seen")
+
+    # Past the budget the request is abandoned and its connection closed
+    server.first_token_delay = 3.0
+    start = time.perf_counter()
+    status = app.chat_with_data(question, df, client, budget=1.0)[1]
+    print(f"  slow API   gave up after {(time.perf_counter() - start) * 1000:6.0f} ms (budget 1000 ms): {status}")
+
+    server.first_token_delay = 0.1
+    job = app.ChatJob(question, client)
+    while not job.text:
+        time.sleep(0.01)
+    job.cancel()
+    job.done.wait(5)
+    print(f"  cancelled  after {len(job.text)} streamed characters")
+    server.shutdown()
+
+def bench_chat_profile(n_rows: int):
+    """Prompt tokens per model call with the dataset profile, and how much of them the prompt cache serves"""
+    server = FakeAnthropicServer(first_token_delay=0.05, chunk_delay=0.0)
+    client = server.client()
+    print(f"\n🧾 chat prompt tokens over {n_rows:,} flights (fake API)")
+    for name, df in (('10 cities', make_flights(n_rows)), ('50k sites', make_wide_flights(n_rows))):
+        df = df.astype({col: 'category' for col in app.CITY_COLUMNS})
+        df.attrs['dataset_key'] = f"bench-{name}"
+        start = time.perf_counter()
+        profile = app.chat_profile(df)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        app.chat_profile(df)
+        again = time.perf_counter() - start
+        print(f"  {name:<10} profile {len(profile):6,} chars  built in {build * 1000:6.1f} ms, "
+              f"then {again * 1000:5.2f} ms from cache")
+
+        usage = []
+        for question in CHAT_QUESTIONS:
+            job = app.ChatJob(question, client, profile=profile)
+            job.wait()
+            usage.append(job.usage)
+        # Every question sends the same system prefix, so only the first one pays for it
+        for label, calls in (('first call', usage[:1]), ('later calls', usage[1:])):
+            print(f"  {'':<10} {label:<12} uncached {np.mean([u.input_tokens for u in calls]):7.0f}  "
+                  f"cache write {np.mean([u.cache_creation_input_tokens for u in calls]):6.0f}  "
+                  f"cache read {np.mean([u.cache_read_input_tokens for u in calls]):6.0f} tokens per call")
+    print(f"  prefixes under {CACHE_MIN_TOKENS} tokens are not cached by the API")
+    server.shutdown()
+
+TILE_VIEWPORTS = {
+    'whole border @ z5': (5, (33.0, -118.0), (25.0, -97.0)),
+    'McAllen @ z12': (12, (26.3, -98.4), (26.1, -98.1)),
+}
+
+def viewport_bytes(pyramid: dict, z: int, north_west: tuple, south_east: tuple) -> tuple:
+    """Tile count and JSON bytes the browser fetches to show one viewport"""
+    (x0, x1), (y0, y1) = app._mercator_cells(
+        np.array([north_west[0], south_east[0]]), np.array([north_west[1], south_east[1]]), z
+    )
+    sizes = [
+        len(json.dumps(app.pyramid_tile(pyramid, z, x, y), separators=(',', ':')))
+        for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+    ]
+    return len(sizes), sum(sizes)
+
+def bench_tiles(n_rows: int):
+    """Pyramid build time, and page plus viewport payload against the static map"""
+    print(f"\n🧱 tile pyramid @ {n_rows:,} rows")
+    df = make_flights(n_rows).astype({col: 'category' for col in app.CITY_COLUMNS})
+    start = time.perf_counter()
+    pyramid = app.build_tile_pyramid(df)
+    print(f"  build {time.perf_counter() - start:6.2f} s")
+    
+    static = app.create_map(df).get_root().render()
+    tiled = app.create_map(df, tile_url='http://localhost/tiles/bench/{z}/{x}/{y}.json').get_root().render()
+    print(f"  page HTML  static {len(static.encode()) / 1e6:8.2f} MB  tiled {len(tiled.encode()) / 1e6:8.2f} MB")
+    for name, (z, north_west, south_east) in TILE_VIEWPORTS.items():
+        tiles, size = viewport_bytes(pyramid, z, north_west, south_east)
+        print(f"  {name:<18} {tiles:4d} tiles  {size / 1e3:8.1f} KB")
+
+# Successive altitude slider positions, as a user drags it
+SLIDER_STEPS = [(100.0, 2999.0), (300.0, 2999.0), (500.0, 2800.0), (700.0, 2500.0)]
+
+def layer_update_payload(df: pd.DataFrame, filters: dict, index: dict, center: tuple, cached: bool = False) -> int:
+    """Work of one incremental rerun: filter, rebuild the flight layers and serialize only them"""
+    selection = app.apply_filters(df, filters, index)
+    base = app.create_base_map(center)
+    key = app.selection_key(df, filters) if cached else None
+    # The layers' own Leaflet script, which st_folium sends for feature_group_to_add
+    for group in app.create_map_layers(selection, selection=key):
+        group.add_to(base)
+        group.render()
+    return len(base.get_root().script.render())
+
+def cached_update_payload(df: pd.DataFrame, filters: dict, index: dict, center: tuple) -> int:
+    """Incremental rerun going through the layer cache"""
+    return layer_update_payload(df, filters, index, center, cached=True)
+
+def full_page_payload(df: pd.DataFrame, filters: dict, index: dict, center: tuple) -> int:
+    """Work of one full rerun: filter, rebuild the whole map and render the page"""
+    selection = app.apply_filters(df, filters, index)
+    return len(app.create_map(selection, center).get_root().render())
+
+def bench_update(n_rows: int):
+    """Server-side latency and bytes sent per slider step, full page vs layer-only update"""
+    print(f"\n🎚️  map update per slider step @ {n_rows:,} rows")
+    df = make_flights(n_rows).sort_values('timestamp', kind='stable')
+    df = df.astype({col: 'category' for col in app.CITY_COLUMNS}).reset_index(drop=True)
+    index = app.build_data_index(df)
+    # The cached update runs twice: first filling the layer cache, then revisiting the same slider values
+    updates = (
+        ('full page', full_page_payload),
+        ('layers', layer_update_payload),
+        ('cache miss', cached_update_payload),
+        ('cache hit', cached_update_payload),
+    )
+    for name, update in updates:
+        timings, sizes = [], []
+        for altitude_range in SLIDER_STEPS:
+            start = time.perf_counter()
+            sizes.append(update(df, {'altitude_range': altitude_range}, index, index['center']))
+            timings.append(time.perf_counter() - start)
+        print(f"  {name:<10} median {np.median(timings) * 1000:7.1f} ms  "
+              f"max {max(timings) * 1000:7.1f} ms  sent {np.mean(sizes) / 1e6:6.2f} MB")
+
+BENCHMARKS = {
+    'filters': (bench_filters, [1_000_000, 10_000_000]),
+    'ingest': (bench_ingest, [5_000_000]),
+    'flows': (bench_flows, [1_000, 10_000, 100_000]),
+    'heatmap': (bench_heatmap, [100_000, 1_000_000]),
+    'tiles': (bench_tiles, [1_000_000]),
+    'markers': (bench_markers, [500, 100_000]),
+    'update': (bench_update, [1_000_000]),
+    'kpis': (bench_kpis, [1_000_000, 5_000_000]),
+    'sketches': (bench_sketches, [1_000_000]),
+    'aggregations': (bench_aggregations, [1_000_000, 5_000_000]),
+    'chat': (bench_chat, [100_000]),
+    'chat-stream': (bench_chat_stream, [1_000_000]),
+    'chat-profile': (bench_chat_profile, [200_000]),
+    'plans': (bench_plans, [1_000_000]),
+    'spatial': (bench_spatial, [1_000_000, 5_000_000]),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f"one of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--rows', type=int, nargs='+', help="row counts to run at")
+    parser.add_argument('--ingest-worker', nargs=2, metavar=('LOADER', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.ingest_worker:
+        ingest_worker(*args.ingest_worker)
+        return
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    print("🚁 Drone Flight Mapper - Benchmarks")
+    print("=" * 50)
+
+    for name in args.benchmarks or BENCHMARKS:
+        bench, default_sizes = BENCHMARKS[name]
+        for n_rows in args.rows or default_sizes:
+            bench(n_rows)
+
+if __name__ == "__main__":
+    main()
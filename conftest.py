@@ -0,0 +1,52 @@
+"""Fixtures for test_app.py: small synthetic datasets and a local stand-in for the Anthropic API"""
+
+import pytest
+
+import app
+from testkit import CITIES, FakeAnthropicServer, make_flights
+
+@pytest.fixture(scope='module')
+def raw():
+    """5,000 synthetic flights with plain string city columns, in ingest order"""
+    return make_flights(5_000).sort_values('timestamp', kind='stable')
+
+@pytest.fixture(scope='module')
+def flights(raw):
+    """The same flights encoded as load_and_process_csv does"""
+    return raw.astype({col: 'category' for col in app.CITY_COLUMNS})
+
+@pytest.fixture(scope='module')
+def keyed(flights):
+    """The same flights under a dataset key, as the shared store hands them out"""
+    df = flights.copy(deep=False)
+    df.attrs['dataset_key'] = 'flights'
+    return df
+
+@pytest.fixture(scope='module')
+def index(flights):
+    return app.build_data_index(flights)
+
+@pytest.fixture(scope='module')
+def cities():
+    """The city names in the synthetic flights"""
+    return [name for name, _, _ in CITIES]
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """An empty shared dataset store in a temporary directory"""
+    monkeypatch.setattr(app, 'STORE_DIR', str(tmp_path / 'store'))
+    app.attach_shared_dataset.clear()
+    yield tmp_path / 'store'
+    app.attach_shared_dataset.clear()
+
+@pytest.fixture
+def server():
+    """Fake API answering after 50 ms, streaming an 8-character chunk every 5 ms"""
+    server = FakeAnthropicServer(first_token_delay=0.05, chunk_delay=0.005)
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def cache(tmp_path):
+    """An empty chat cache in a temporary file"""
+    return app.ChatCache(str(tmp_path / 'chat.sqlite3'))
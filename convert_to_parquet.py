@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Convert flight CSV exports into a date-partitioned Parquet dataset
+The result loads in the app via "Parquet dataset" in the sidebar.
+
+Usage:
+    python convert_to_parquet.py flights.csv output_dir
+    python convert_to_parquet.py exports/*.csv output_dir              # adds to the days already there
+    python convert_to_parquet.py --replace exports/*.csv output_dir    # replaces the days the CSVs cover
+"""
+
+import os
+import sys
+import time
+from typing import Optional
+
+import app
+
+def convert(csv_path: str, out_dir: str, replace: bool = False, written: Optional[set] = None) -> bool:
+    """Convert one CSV file into the dataset; with replace, days not yet written in this run are replaced"""
+    print(f"📄 {csv_path}")
+    started = time.perf_counter()
+    try:
+        df = app.read_flights_csv(csv_path)
+    except Exception as e:
+        print(f"❌ Error loading CSV: {e}")
+        return False
+
+    days = df['timestamp'].dt.normalize()
+    if replace:
+        # Several CSVs can cover the same day: only the first one replaces its partition
+        written = set() if written is None else written
+        fresh = ~days.isin(written).to_numpy()
+        if fresh.any():
+            app.write_parquet_dataset(df[fresh], out_dir, replace=True)
+        if not fresh.all():
+            app.write_parquet_dataset(df[~fresh], out_dir)
+        written.update(days.unique())
+    else:
+        app.write_parquet_dataset(df, out_dir)
+    print(f"✅ {len(df):,} flights over {days.nunique()} day(s) written in {time.perf_counter() - started:.1f} s")
+    return True
+
+def main():
+    args = sys.argv[1:]
+    replace = '--replace' in args
+    args = [arg for arg in args if arg != '--replace']
+    if len(args) < 2:
+        print(__doc__.strip())
+        sys.exit(1)
+
+    *csv_paths, out_dir = args
+    os.makedirs(out_dir, exist_ok=True)
+
+    print("🚁 Drone Flight Mapper - CSV to Parquet")
+    print("=" * 50)
+
+    written = set()
+    results = [convert(path, out_dir, replace, written) for path in csv_paths]
+    if not all(results):
+        sys.exit(1)
+    print(f"\n🎉 Dataset ready: {out_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,664 @@
+#!/usr/bin/env python3
+"""
+Correctness tests for the Drone Flight Mapper on small synthetic datasets
+
+Usage:
+    python -m pytest -q test_app.py
+"""
+
+import base64
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import folium
+import numpy as np
+import pandas as pd
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import app
+from testkit import (AGGREGATION_CASES, FILTER_CASES, PLAN_CASES, SPATIAL_CASES, legacy_apply_filters, make_flights,
+                     make_wide_flights, pandas_aggregation)
+
+# CSV ingest
+
+def write_csv(tmp_path, df: pd.DataFrame) -> str:
+    path = str(tmp_path / 'flights.csv')
+    df.to_csv(path, index=False)
+    return path
+
+def test_ingest_reads_chunks_into_the_compact_schema(tmp_path, raw, monkeypatch):
+    """Chunks parsed separately come back as one time-ordered frame with shared city categories"""
+    monkeypatch.setattr(app, 'INGEST_CHUNK_ROWS', 700)
+    shuffled = raw.sample(frac=1, random_state=1)
+    df = app.read_flights_csv(write_csv(tmp_path, shuffled))
+    expected = shuffled.sort_values('timestamp', kind='stable')
+
+    assert list(df.columns) == app.REQUIRED_COLUMNS and df.attrs['ingest']['rows'] == len(raw)
+    assert df['timestamp'].is_monotonic_increasing
+    assert np.array_equal(df['flight_id'], expected['flight_id'])
+    for col in app.CITY_COLUMNS:
+        assert list(df[col].cat.categories) == sorted(raw[col].unique())
+        assert np.array_equal(df[col].astype(str), expected[col])
+    for col in app.COORD_COLUMNS:
+        assert df[col].dtype == 'float32' and np.allclose(df[col], expected[col], atol=1e-4)
+    for col in app.MEASURE_COLUMNS:
+        assert df[col].dtype == 'int16' and np.array_equal(df[col], expected[col])
+
+def test_ingest_retries_leniently_on_non_numeric_values(tmp_path, raw):
+    """A non-numeric altitude becomes a gap; whole numbers with gaps are nullable Int16, speeds stay int16"""
+    df = raw.head(100).astype({'altitude_ft': object})
+    df.loc[df.index[10], 'altitude_ft'] = 'unknown'
+    df = app.read_flights_csv(write_csv(tmp_path, df))
+    assert len(df) == 100
+    assert df['altitude_ft'].dtype == 'Int16' and df['altitude_ft'].isna().sum() == 1
+    assert df['speed_kts'].dtype == 'int16'
+
+def test_ingest_keeps_fractional_measures_float32(tmp_path, raw):
+    df = raw.head(100).astype({'altitude_ft': object})
+    df.loc[df.index[5], 'altitude_ft'] = 1234.5
+    df.loc[df.index[10], 'altitude_ft'] = 'unknown'
+    df = app.read_flights_csv(write_csv(tmp_path, df))
+    assert df['altitude_ft'].dtype == 'float32' and df['altitude_ft'].isna().sum() == 1
+    assert (df['altitude_ft'] == 1234.5).sum() == 1 and df['speed_kts'].dtype == 'int16'
+
+def test_ingest_rounds_measures_to_float32(tmp_path, raw):
+    """Values are parsed as float32, so integers past 2**24 lose their last bit"""
+    df = raw.head(10).copy()
+    df['altitude_ft'] = 16_777_217
+    df = app.read_flights_csv(write_csv(tmp_path, df))
+    assert df['altitude_ft'].dtype == 'float32' and (df['altitude_ft'] == 16_777_216).all()
+
+def test_ingest_drops_rows_with_bad_coordinates(tmp_path, raw):
+    df = raw.head(100).astype({'dest_lat': object})
+    df.loc[df.index[:3], 'origin_lon'] = np.nan
+    df.loc[df.index[3], 'dest_lat'] = 'north'
+    df = app.read_flights_csv(write_csv(tmp_path, df))
+    assert len(df) == 96 and not df[app.COORD_COLUMNS].isna().any().any()
+
+def test_ingest_puts_missing_timestamps_last(tmp_path, raw):
+    df = raw.head(100).copy()
+    df.loc[df.index[:2], 'timestamp'] = pd.NaT
+    df = app.read_flights_csv(write_csv(tmp_path, df))
+    assert len(df) == 100 and df['timestamp'].iloc[-2:].isna().all()
+    assert df['timestamp'].iloc[:-2].is_monotonic_increasing
+
+def test_ingest_rejects_missing_columns(tmp_path, raw):
+    with pytest.raises(ValueError, match='altitude_ft'):
+        app.read_flights_csv(write_csv(tmp_path, raw.head(10).drop(columns='altitude_ft')))
+
+# Shared dataset store
+
+def test_store_round_trips_through_a_memory_map(tmp_path, store, raw):
+    """An ingested frame comes back unchanged from the store, on read-only buffers mapped from the file"""
+    df = app.read_flights_csv(write_csv(tmp_path, raw.head(500)))
+    app.write_shared_dataset(df, 'round-trip')
+    shared = app.attach_shared_dataset('round-trip')
+    pd.testing.assert_frame_equal(shared, df)
+    assert shared.attrs['dataset_key'] == 'round-trip'
+    assert not shared['altitude_ft'].to_numpy().flags.writeable
+
+def test_store_shares_one_copy(store, flights):
+    """Later loads of a stored dataset attach to the same frame without building it again"""
+    builds = []
+    def build():
+        builds.append(1)
+        return flights
+    first = app.share_dataset('shared', build)
+    assert app.share_dataset('shared', build) is first and len(builds) == 1
+
+def test_store_evicts_least_recently_used(store, flights):
+    """Eviction goes by last use, which loads refresh, and never removes the dataset being kept"""
+    paths = {key: app._store_path(key) for key in 'abc'}
+    for stamp, (key, path) in enumerate(paths.items(), start=1_000_000):
+        app.write_shared_dataset(flights, key)
+        os.utime(path, (stamp, stamp))
+    size = os.path.getsize(paths['a'])
+    app.share_dataset('a', lambda: pytest.fail("a stored dataset is not rebuilt"))
+    assert app.evict_shared_datasets(keep=paths['c'], max_bytes=2 * size) == [paths['b']]
+    assert app.evict_shared_datasets(keep=paths['a'], max_bytes=0) == [paths['c']]
+    assert os.listdir(store) == [os.path.basename(paths['a'])]
+
+def test_new_upload_replaces_the_data(monkeypatch, tmp_path, raw):
+    """A different upload replaces the loaded flights; uploading the same content again reuses its stored copy"""
+    monkeypatch.setenv('FLIGHT_STORE_DIR', str(tmp_path / 'store'))
+    at = AppTest.from_file('app.py', default_timeout=60)
+    at.run()
+    for name, rows in (('first.csv', 300), ('second.csv', 200), ('again.csv', 300)):
+        at.sidebar.file_uploader[0].set_value((name, raw.head(rows).to_csv(index=False).encode(), 'text/csv'))
+        at.run()
+        assert not at.exception and len(at.session_state['data']) == rows
+    assert len(os.listdir(tmp_path / 'store')) == 2
+
+def test_store_writes_concurrently_without_clashing(store, flights):
+    """Concurrent writes of one dataset each use their own partial file"""
+    with ThreadPoolExecutor(8) as pool:
+        for write in [pool.submit(app.write_shared_dataset, flights, 'same') for _ in range(8)]:
+            write.result()
+    assert os.listdir(store) == [os.path.basename(app._store_path('same'))]
+    assert len(app.attach_shared_dataset('same')) == len(flights)
+
+def test_store_builds_each_dataset_once(store, flights):
+    """Sessions loading the same dataset at once wait for one build instead of each parsing it"""
+    builds = []
+    def build():
+        builds.append(threading.get_ident())
+        time.sleep(0.05)
+        return flights
+    with ThreadPoolExecutor(4) as pool:
+        loads = [pool.submit(app.share_dataset, 'upload', build) for _ in range(4)]
+    assert all(len(load.result()) == len(flights) for load in loads)
+    assert len(builds) == 1
+
+# Filters
+
+@pytest.mark.parametrize('name', FILTER_CASES)
+def test_apply_filters_matches_legacy(raw, flights, index, name):
+    """The fused filter engine returns the same frame as the copy-then-mask chain"""
+    actual = app.apply_filters(flights, FILTER_CASES[name], index)
+    expected = legacy_apply_filters(raw, FILTER_CASES[name])
+    pd.testing.assert_frame_equal(actual.astype(raw.dtypes[app.CITY_COLUMNS].to_dict()), expected)
+
+def test_selection_key_needs_a_dataset_key(flights, keyed):
+    """Only frames from the shared store get a selection key; any other frame is not cached"""
+    filters = {'dest_cities': ['Laredo']}
+    assert app.selection_key(flights, filters) is None
+    assert app.selection_key(flights.copy(), filters) is None
+    assert app.selection_key(keyed, filters) == app.selection_key(keyed.copy(deep=False), dict(filters))
+    assert app.selection_key(keyed, filters) != app.selection_key(keyed, {})
+    assert app.apply_filters(keyed, filters).attrs.get('dataset_key') is None
+
+@pytest.mark.parametrize('name', SPATIAL_CASES)
+def test_spatial_grid_matches_scan(name):
+    """Area filters select the same rows through the spatial grids as through a column scan"""
+    rng = np.random.default_rng(5)
+    df = make_flights(5_000).sort_values('timestamp', kind='stable').reset_index(drop=True)
+    for col in app.COORD_COLUMNS:
+        df[col] = (df[col] + rng.normal(0, 0.3, len(df))).astype('float32')
+    df = df.astype({col: 'category' for col in app.CITY_COLUMNS})
+    index = app.build_data_index(df)
+    scan_index = {key: value for key, value in index.items() if not key.endswith('_grid')}
+    rows = app.filter_positions(df, SPATIAL_CASES[name], index)
+    assert np.array_equal(rows, app.filter_positions(df, SPATIAL_CASES[name], scan_index))
+
+# Map sampling
+
+def sample_strata(df: pd.DataFrame, rows: np.ndarray, bucket: str = 'Y') -> pd.Series:
+    """Stratum of each sampled row: route and time bucket"""
+    sample = df.iloc[rows]
+    return (sample['origin_city'].astype(str) + '>' + sample['dest_city'].astype(str) + '@' +
+            sample['timestamp'].dt.to_period(bucket).astype(str))
+
+def test_sample_keeps_every_stratum(flights):
+    """A one-flight route survives a sample a tenth the size of the frame"""
+    df = flights.copy()
+    df.loc[df.index[0], ['origin_city', 'dest_city']] = 'Laredo', 'Tijuana'
+    df = df[(df['origin_city'] != 'Laredo') | (df['dest_city'] != 'Tijuana') | (df.index == df.index[0])]
+    rows = app.stratified_sample(df, 500, bucket='Y')
+    assert len(rows) == 500 and len(np.unique(rows)) == 500
+    strata = sample_strata(df, rows)
+    assert set(strata) == set(sample_strata(df, np.arange(len(df))))
+    assert 'Laredo>Tijuana@2024' in set(strata)
+
+def test_sample_prefixes_are_stratified(flights):
+    """The first row of every stratum comes before any stratum's second, so the marker head is stratified too"""
+    rows = app.stratified_sample(flights, 1_000, bucket='Y')
+    n_strata = sample_strata(flights, np.arange(len(flights))).nunique()
+    assert sample_strata(flights, rows[:n_strata]).is_unique
+    assert np.array_equal(app.stratified_sample(flights, 100, bucket='Y'), rows[:100])
+
+def test_sample_follows_flights_not_positions(flights):
+    """Each flight's priority comes from its row label, so reordering or filtering rows draws the same flights"""
+    selection = flights[flights['altitude_ft'] > 1500]
+    labels = selection.index[app.stratified_sample(selection, 300)]
+    shuffled = selection.sample(frac=1, random_state=7)
+    assert np.array_equal(shuffled.index[app.stratified_sample(shuffled, 300)], labels)
+    assert np.array_equal(selection.index[app.stratified_sample(selection, 300)], labels)
+
+def test_map_sample_is_shared_per_selection(keyed):
+    key = app.selection_key(keyed, {})
+    rows = app.map_sample(keyed, key, n=200)
+    assert app.map_sample(keyed, key, n=200) is rows
+    assert np.array_equal(rows, app.stratified_sample(keyed, 200))
+
+def test_sample_keeps_flights_without_a_timestamp(flights):
+    """Missing timestamps form one stratum of their own instead of overflowing the time buckets"""
+    df = flights.iloc[:200].copy()
+    df.loc[df.index[:3], 'timestamp'] = pd.NaT
+    assert np.array_equal(np.sort(app.stratified_sample(df, len(df))), np.arange(len(df)))
+    assert len(app.stratified_sample(df.iloc[:3], 2)) == 2
+
+# Map layers
+
+HOSTILE_CITY = '</script><img src=x onerror=alert(1)>'
+
+@pytest.fixture
+def hostile(flights):
+    """A few flights from a city whose name is markup"""
+    df = flights.head(50).copy()
+    df['origin_city'] = df['origin_city'].cat.rename_categories({'Laredo': HOSTILE_CITY})
+    return df
+
+def test_flow_lines_carry_every_flight(flights):
+    df = flights.head(50)
+    data = json.loads(app.FlowLinesLayer(df).payload)
+    assert len(data['coords']) == 4 * len(df) and data['flight_id'] == df['flight_id'].tolist()
+    assert np.allclose(np.reshape(data['coords'], (-1, 4)), df[app.COORD_COLUMNS], atol=1e-4)
+    assert [data['origin_cities'][code] for code in data['origin']] == df['origin_city'].astype(str).tolist()
+
+def test_flow_lines_escape_city_names(hostile):
+    """City names reach the popup's escape() as plain strings and never close the page's script block"""
+    layer = app.FlowLinesLayer(hostile)
+    assert HOSTILE_CITY in json.loads(layer.payload)['origin_cities'] and '<' not in layer.payload
+    page = app.create_map(hostile, flow_style='flights', show_markers=False).get_root().render()
+    assert HOSTILE_CITY not in page
+
+@pytest.mark.parametrize('by', ['city', 'coords'])
+def test_routes_count_every_flight(flights, by):
+    """Route counts and means match a groupby over the raw flights, including flights with a missing city"""
+    df = flights.copy()
+    df.loc[df.index[:5], 'dest_city'] = np.nan
+    routes = app.aggregate_routes(df, by=by)
+    assert routes['flights'].sum() == len(df) and routes['flights'].is_monotonic_increasing
+    if by == 'city':
+        def route(frame):
+            return frame[app.CITY_COLUMNS].astype(object).fillna('?').agg('>'.join, axis=1)
+        expected = df.groupby(route(df))['altitude_ft'].agg(['size', 'mean'])
+        actual = routes.set_index(route(routes)).loc[expected.index]
+        assert np.array_equal(actual['flights'], expected['size'])
+        assert np.allclose(actual['avg_altitude'], expected['mean'])
+        # Plain string columns take the groupby path and agree
+        plain = app.aggregate_routes(df.astype({col: object for col in app.CITY_COLUMNS}))
+        assert np.array_equal(plain.set_index(route(plain)).loc[expected.index, 'flights'], expected['size'])
+
+def test_route_edges_escape_city_names(hostile):
+    layer = app.RouteEdgesLayer(app.aggregate_routes(hostile))
+    data = json.loads(layer.payload)
+    assert HOSTILE_CITY in data['origin'] and '<' not in layer.payload
+    assert sum(data['flights']) == len(hostile)
+
+def test_heatmap_bins_keep_the_total_weight(flights):
+    """Every destination lands in one cell near it, and the cells' weights add up to the altitudes"""
+    df = flights.head(500)
+    cells = app.bin_destinations(df)
+    assert np.isclose(cells[:, 2].sum(), df['altitude_ft'].sum())
+    lat, lon = df['dest_lat'].to_numpy(), df['dest_lon'].to_numpy()
+    nearest = np.min(np.hypot(lat[:, None] - cells[:, 0], lon[:, None] - cells[:, 1]), axis=1)
+    assert nearest.max() <= app.HEATMAP_CELL_DEG
+    data = json.loads(app.DestinationHeatLayer(cells).cells)
+    assert len(data) == 3 * len(cells)
+
+def test_heatmap_grid_stays_bounded(flights):
+    """A far-off destination coarsens the grid instead of allocating billions of cells"""
+    df = flights.head(100).copy()
+    df.loc[df.index[0], ['dest_lat', 'dest_lon']] = -80.0, 170.0
+    df.loc[df.index[1], 'dest_lat'] = np.nan
+    cells = app.bin_destinations(df)
+    assert np.isclose(cells[:, 2].sum(), df['altitude_ft'].iloc[[0] + list(range(2, 100))].sum())
+    assert len(cells) <= 99 and len(app.bin_destinations(df.iloc[1:2])) == 0
+
+@pytest.fixture(scope='module')
+def pyramid(flights):
+    return app.build_tile_pyramid(flights)
+
+def test_pyramid_levels_merge_the_finest_counts(flights, pyramid):
+    """Each level's cells are the level-13 cells merged, and every level counts every flight"""
+    finest = pyramid[app.TILE_MAX_ZOOM]
+    bits = app.TILE_MAX_ZOOM + app.TILE_BIN_BITS
+    x, y = finest['cells'] & ((1 << bits) - 1), finest['cells'] >> bits
+    for z, level in pyramid.items():
+        shift = app.TILE_MAX_ZOOM - z
+        merged = pd.Series(finest['cell_sums']['count']).groupby(
+            ((y >> shift) << (bits - shift)) | (x >> shift)).sum()
+        assert np.array_equal(merged.index, level['cells'])
+        assert np.array_equal(merged.to_numpy(), level['cell_sums']['count'])
+        assert level['route_sums']['count'].sum() == len(flights)
+        assert np.isclose(level['cell_sums']['weight'].sum(), flights['altitude_ft'].sum())
+
+def test_pyramid_tiles_cover_every_flight(flights, pyramid):
+    """The tiles of one zoom level hold every density cell once and every route in its end tiles"""
+    z = app.TILE_MIN_ZOOM
+    tiles = [app.pyramid_tile(pyramid, z, x, y) for x in range(1 << z) for y in range(1 << z)]
+    assert sum(cell[2] for tile in tiles for cell in tile['cells']) == len(flights)
+    routes = {route[0]: route[-1] for tile in tiles for route in tile['routes']}
+    assert sum(routes.values()) == len(flights)
+    assert app.pyramid_tile(pyramid, z, 1 << z, 0) == {'cells': [], 'routes': []}
+
+def test_tile_server_serves_registered_pyramids(pyramid):
+    server = app.TileServer(port=0)
+    try:
+        url = server.register('test', lambda: pyramid)
+        assert url == f"{server.url}/tiles/test/{{z}}/{{x}}/{{y}}.json"
+        with urllib.request.urlopen(url.format(z=3, x=1, y=3)) as response:
+            assert response.headers['Access-Control-Allow-Origin'] == '*'
+            tile = json.loads(response.read())
+        assert tile['cells'] and tile == json.loads(json.dumps(app.pyramid_tile(pyramid, 3, 1, 3)))
+        for path in ('tiles/unknown/3/1/3.json', 'tiles/test/3/1/x.json', 'tiles/test/3/1'):
+            with pytest.raises(urllib.error.HTTPError, match='404'):
+                urllib.request.urlopen(f"{server.url}/{path}")
+    finally:
+        server.httpd.shutdown()
+
+def test_markers_pack_every_flight(flights):
+    """Coordinates travel as one little-endian float32 array; the table has one row per flight"""
+    df = flights.head(50).copy()
+    df.loc[df.index[0], 'timestamp'] = pd.NaT
+    layer = app.FlightMarkersLayer(df)
+    coords = np.frombuffer(base64.b64decode(layer.coords), dtype='<f4').reshape(-1, 4)
+    assert np.array_equal(coords, df[app.COORD_COLUMNS].to_numpy(dtype='float32'))
+    table = json.loads(layer.table)
+    assert table['flight_id'] == df['flight_id'].tolist() and table['minute'][0] is None
+    assert table['minute'][1] == df['timestamp'].iloc[1].floor('min').value // 60_000_000_000
+
+def test_markers_escape_city_names(hostile):
+    page = app.create_map(hostile, show_flows=False).get_root().render()
+    assert HOSTILE_CITY not in page
+    assert HOSTILE_CITY in json.loads(app.FlightMarkersLayer(hostile).table)['origin_cities']
+
+@pytest.mark.parametrize('options, names', [
+    ({}, ['Destination Heatmap', 'Flow Lines', 'Flight Markers']),
+    ({'show_flows': False}, ['Destination Heatmap', 'Flight Markers']),
+    ({'show_markers': False, 'flow_style': 'flights'}, ['Destination Heatmap', 'Flow Lines']),
+    ({'tile_url': 'http://localhost/tiles/t/{z}/{x}/{y}.json'}, ['Destination Heatmap', 'Flow Lines', 'Flight Markers']),
+])
+def test_map_layers_follow_the_options(flights, options, names):
+    groups = app.create_map_layers(flights, **options)
+    assert [group.layer_name for group in groups] == names
+    assert app.create_map_layers(flights.iloc[:0], **options) == []
+
+def test_layer_scripts_are_not_templates(flights):
+    """Payloads are added to the page as-is, so braces in the data are never evaluated by Jinja"""
+    df = flights.head(50).copy()
+    df['origin_city'] = df['origin_city'].cat.rename_categories({'Laredo': '{{ 7 * 7 }}'})
+    page = app.create_map(df, flow_style='flights', show_markers=False).get_root().render()
+    assert '{{ 7 * 7 }}' in page
+
+def test_layer_cache_evicts_least_recently_used(flights):
+    cache = app.LayerCache(entries=2)
+    builds = []
+    def build(name):
+        def layer():
+            builds.append(name)
+            return app.DestinationHeatLayer(app.bin_destinations(flights.head(20)), name=name).add_to(folium.FeatureGroup())
+        return layer
+    for name in ('a', 'b', 'a', 'c', 'b', 'a'):
+        cache.layer((name,), build(name))
+    # 'a' was used after 'b', so 'c' evicts 'b'; then 'b' evicts 'a'
+    assert builds == ['a', 'b', 'c', 'b', 'a']
+    assert cache.stats() == {'hits': 1, 'misses': 5, 'layers': 2, 'entries': 2}
+
+def test_cached_layers_replay_the_same_script(flights, keyed, monkeypatch):
+    """A cached layer renders the script of the layer it was built from, under the same variable"""
+    layer = app.FlowLinesLayer(flights.head(50), name='Flow Lines').add_to(folium.FeatureGroup())
+    replayed = app.RenderedLayer(app.render_layer(layer)).add_to(folium.FeatureGroup())
+    assert replayed.get_name() == layer.get_name() and replayed.layer_name == 'Flow Lines'
+    assert app.render_layer(replayed)['script'].strip() == app.render_layer(layer)['script'].strip()
+
+    cache = app.LayerCache()
+    monkeypatch.setattr(app, 'get_layer_cache', lambda: cache)
+    key = app.selection_key(keyed, {})
+    def scripts():
+        groups = app.create_map_layers(keyed, selection=key)
+        return [app.render_layer(child)['script'] for group in groups for child in group._children.values()]
+    first = scripts()
+    assert cache.stats()['misses'] == 3 and cache.stats()['hits'] == 0
+    assert scripts() == first
+    assert cache.stats()['misses'] == 3 and cache.stats()['hits'] == 3
+
+# KPIs and aggregations
+
+@pytest.mark.parametrize('name', FILTER_CASES)
+def test_cube_kpis_match_scan(flights, index, name):
+    """KPIs summed from the cubes equal KPIs computed from the selected rows"""
+    filters = FILTER_CASES[name]
+    answered = next((kpis for kpis in (app.cube_kpis(cube, filters) for cube in index['kpi_cubes']) if kpis), None)
+    if answered is None:
+        pytest.skip("not answered by the cubes")
+    expected = app.calculate_kpis(app.apply_filters(flights, filters, index))
+    for key, value in expected.items():
+        if key.startswith('avg_'):
+            assert np.isclose(value, answered[key], equal_nan=True), key
+        else:
+            assert value == answered[key], key
+
+@pytest.mark.parametrize('name', ['sidebar defaults', 'time window only'])
+def test_sketch_kpis_within_error_bounds(name):
+    """Approximate unique counts stay within 4 standard errors; top counts are low by at most the stated bound"""
+    df = make_wide_flights(20_000, n_sites=2_000)
+    index = app.build_data_index(df)
+    filters = FILTER_CASES[name]
+    selection = app.apply_filters(df, filters, index)
+    exact = app.calculate_kpis(selection)
+    approx = app.sketch_kpis(index['kpi_sketches'], filters)
+    bound = approx['approximate']
+
+    assert approx['total_flights'] == exact['total_flights']
+    for key in ('unique_origins', 'unique_destinations'):
+        assert abs(approx[key] / exact[key] - 1) <= 4 * bound['unique_error'], key
+    exact_counts = selection['dest_city'].value_counts()
+    for city, count in approx['top_destinations'].items():
+        assert exact_counts[city] - bound['top_error'] <= count <= exact_counts[city], city
+
+@pytest.mark.parametrize('name', AGGREGATION_CASES)
+def test_aggregations_match_pandas(flights, name):
+    """Aggregations on category codes agree with a pandas groupby"""
+    spec = app.validate_aggregation(AGGREGATION_CASES[name])
+    result = app.run_aggregation(flights, spec)
+    metric = result.columns[-1]
+    assert np.allclose(result[metric].sort_values(ignore_index=True), pandas_aggregation(flights, spec))
+
+def test_bad_aggregation_is_rejected():
+    with pytest.raises(ValueError):
+        app.validate_aggregation({'type': 'median', 'column': 'altitude_ft'})
+
+# Chat filter plans
+
+@pytest.mark.parametrize('name', PLAN_CASES)
+def test_filter_plans(index, name):
+    """Chat filter blocks compile to the expected plan, or are rejected with ValueError"""
+    filters, expected = PLAN_CASES[name]
+    if expected is None:
+        with pytest.raises(ValueError):
+            app.compile_filter_plan(filters, index)
+    else:
+        assert app.compile_filter_plan(filters, index).filters() == expected
+
+def test_filter_plans_leave_the_index_alone(index):
+    """Compiling a plan doesn't write into the shared data index, even one without folded city names"""
+    bare = {key: value for key, value in index.items() if not key.endswith('_folded')}
+    keys = set(bare)
+    plan = app.compile_filter_plan({'dest_cities': ['laredo'], 'origin_cities': ['san diego']}, bare)
+    assert plan.dest_cities == ('Laredo',) and set(bare) == keys
+
+# Chat cache
+
+QUESTION = "Compare McAllen vs Brownsville by average altitude"
+ANSWER = {'filters': {'dest_cities': ['McAllen', 'Brownsville']}}
+
+def test_cache_folds_case_and_whitespace(cache):
+    cache.put(QUESTION, ANSWER)
+    assert cache.get("  compare MCALLEN vs brownsville   by average altitude?") == ANSWER
+    assert cache.stats() == {'hits': 1, 'misses': 0}
+
+def test_cache_separates_scopes(cache):
+    cache.put(QUESTION, ANSWER, scope='a')
+    assert cache.get(QUESTION, scope='b') is None
+    assert cache.get(QUESTION, scope='a') == ANSWER
+
+def test_cache_fuzzy_matching_is_opt_in(tmp_path):
+    reworded = "Above 500 ft, flights to Laredo"
+    for similarity, expected in ((0, None), (0.85, ANSWER)):
+        cache = app.ChatCache(str(tmp_path / f'chat-{similarity}.sqlite3'), similarity=similarity)
+        cache.put("Show flights to Laredo above 500 ft", ANSWER)
+        assert cache.get(reworded) == expected
+        assert cache.get("Flights to Laredo above 600 ft") is None
+
+@pytest.mark.parametrize('question', [
+    "flights not to Laredo above 500 ft between 2024-01-01 and 2024-02-01",
+    "flights from Laredo above 500 ft between 2024-01-01 and 2024-02-01",
+    "flights to Laredo below 500 ft between 2024-01-01 and 2024-02-01",
+    "flights to McAllen above 500 ft between 2024-01-01 and 2024-02-01",
+    "flights to Laredo above 500 ft before 2024-01-01 and after 2024-02-01",
+])
+def test_cache_never_fuzzily_matches_a_different_meaning(tmp_path, cities, question):
+    """Negations, directions, comparisons and city names are never matched fuzzily"""
+    cache = app.ChatCache(str(tmp_path / 'chat.sqlite3'), similarity=0.5)
+    cache.put("flights to Laredo above 500 ft between 2024-01-01 and 2024-02-01", {'filters': {}})
+    assert cache.get(question, names=app.query_tokens(app.normalize_query(' '.join(cities)))) is None
+
+def test_cache_expires_entries(tmp_path):
+    """Answers to relative-time questions get their own, shorter time to live"""
+    cache = app.ChatCache(str(tmp_path / 'chat.sqlite3'), ttl=60, relative_ttl=0)
+    cache.put(QUESTION, ANSWER)
+    cache.put("Flights to Laredo in the last 24 hours", ANSWER)
+    assert cache.get(QUESTION) == ANSWER
+    assert cache.get("Flights to Laredo in the last 24 hours") is None
+
+    expired = app.ChatCache(str(tmp_path / 'expired.sqlite3'), ttl=0)
+    expired.put(QUESTION, ANSWER)
+    assert expired.get(QUESTION) is None
+
+def test_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = iter(range(1_000_000, 1_000_100))
+    monkeypatch.setattr(app.time, 'time', lambda: next(clock))
+    cache = app.ChatCache(str(tmp_path / 'chat.sqlite3'), entries=2)
+    cache.put("first question", {'n': 1})
+    cache.put("second question", {'n': 2})
+    assert cache.get("first question") == {'n': 1}
+    cache.put("third question", {'n': 3})
+    assert cache.get("second question") is None
+    assert cache.get("first question") == {'n': 1}
+    assert cache.get("third question") == {'n': 3}
+
+def test_cache_survives_a_restart(tmp_path):
+    app.ChatCache(str(tmp_path / 'chat.sqlite3')).put(QUESTION, ANSWER)
+    assert app.ChatCache(str(tmp_path / 'chat.sqlite3')).get(QUESTION) == ANSWER
+
+# Local chat parser
+
+@pytest.mark.parametrize('question, expected', [
+    ("Flights to Laredo above 500 ft", {'dest_cities': ['Laredo'], 'altitude_range': [500, 100000]}),
+    ("Only destinations in Mexico, altitude < 1000 ft", {'destinations': ['mexico'], 'altitude_range': [0, 1000]}),
+    ("speed 20–60 kts", {'speed_range': [20, 60]}),
+    ("Flights from San Diego to Tijuana and Nuevo Laredo",
+     {'origin_cities': ['San Diego'], 'dest_cities': ['Tijuana', 'Nuevo Laredo']}),
+    ("Flights to the US between 1,000 and 2,000 feet", {'destinations': ['us'], 'altitude_range': [1000, 2000]}),
+    ("flights above 200 ft and below 500 ft", {'altitude_range': [200, 500]}),
+    ("Flights from Laredo to cities in Mexico", {'origin_cities': ['Laredo'], 'destinations': ['mexico']}),
+    ("Flights from San Diego, landing at Tijuana", {'origin_cities': ['San Diego'], 'dest_cities': ['Tijuana']}),
+    ("Flights to Laredo in the last 24 hours",
+     {'dest_cities': ['Laredo'], 'time_range': ['2024-03-01T12:00:00', '2024-03-02T12:00:00']}),
+    ("flights to Nuevo Laredo yesterday",
+     {'dest_cities': ['Nuevo Laredo'], 'time_range': ['2024-03-01T00:00:00', '2024-03-01T23:59:59.999999']}),
+])
+def test_parser_answers(cities, question, expected):
+    assert app.parse_chat_query(question, cities, now=datetime(2024, 3, 2, 12))['filters'] == expected
+
+@pytest.mark.parametrize('question', [
+    "Compare McAllen vs Brownsville by average altitude",
+    "flights above 500",
+    "Flights to Laredo on 2024-03-01",
+    "Flights from Mexico",
+    "flights to the us above 500 ft",
+    "flights to Laredo or McAllen",
+    "above 500 ft or below 200 ft",
+    "flights above 500 ft and below 200 ft",
+    "flights with origin in Mexico",
+    "origins in Mexico",
+    "flights from cities in Mexico",
+    "departing from Laredo in Mexico",
+])
+def test_parser_leaves_the_rest_to_the_model(cities, question):
+    assert app.parse_chat_query(question, cities) is None
+
+def test_chat_parses_locally_without_a_client(flights):
+    response, status = app.chat_with_data("Flights to Laredo above 500 ft", flights, None)
+    assert status == 'local' and response['filters'] == {'dest_cities': ['Laredo'], 'altitude_range': [500, 100000]}
+
+# Chat against the fake API
+
+def test_chat_answers_are_cached(server, cache, flights, index):
+    """A question answered by the model is answered from the cache the second time, without an API call"""
+    client = server.client()
+    assert app.chat_with_data(QUESTION, flights, client, cache, index=index) == (server.answer, 'success')
+    assert app.chat_with_data(QUESTION, flights, client, cache, index=index) == (server.answer, 'cached')
+    assert app.chat_with_data(QUESTION, flights, None, cache) == (server.answer, 'cached')
+    assert server.calls == 1
+
+@pytest.mark.parametrize('answer', [
+    {'filters': {'dest_cities': ['Atlantis']}},
+    {'filters': {'altitude_range': [900, 100]}},
+    {'aggregation': {'type': 'median', 'column': 'altitude_ft'}},
+])
+def test_chat_rejected_answers_are_not_cached(server, cache, flights, index, answer):
+    server.answer = answer
+    client = server.client()
+    assert app.chat_with_data(QUESTION, flights, client, cache, index=index)[1] == 'success'
+    assert app.chat_with_data(QUESTION, flights, client, cache, index=index)[1] == 'success'
+    assert server.calls == 2
+
+def test_chat_streams_in_the_background(server):
+    job = app.ChatJob(QUESTION, server.client())
+    assert job.poll() == 'running'
+    assert job.wait() == (server.answer, 'success')
+    assert job.first_token is not None and job.first_token >= server.first_token_delay
+
+def test_chat_times_out(server, flights):
+    """A reply slower than the latency budget is given up on"""
+    server.first_token_delay = 2.0
+    start = time.perf_counter()
+    response, status = app.chat_with_data(QUESTION, flights, server.client(), budget=0.5)
+    assert not response and 'within' in status
+    assert time.perf_counter() - start < 1.5
+
+def test_chat_can_be_cancelled(server):
+    server.chunk_delay = 0.05
+    job = app.ChatJob(QUESTION, server.client())
+    while not job.text and job.poll() == 'running':
+        time.sleep(0.01)
+    job.cancel()
+    assert job.result() == ({}, "Request cancelled")
+    assert job.done.wait(5)
+
+def test_chat_late_reply_is_dropped(server, cache, index, monkeypatch):
+    """A reply that completes after the job timed out neither overwrites the timeout nor lands in the cache"""
+    checking, release = threading.Event(), threading.Event()
+    check_chat_response = app.check_chat_response
+    def slow_check(response, index):
+        checking.set()
+        release.wait(5)
+        return check_chat_response(response, index)
+    monkeypatch.setattr(app, 'check_chat_response', slow_check)
+    job = app.ChatJob(QUESTION, server.client(), cache, index=index)
+    assert checking.wait(5)
+    job.cancel('timeout')
+    release.set()
+    assert job.done.wait(5)
+    assert job.poll() == 'timeout' and 'within' in job.result()[1]
+    assert cache.get(QUESTION) is None
+
+def test_chat_usage_log(server, flights):
+    """Questions answered locally and by the model both land in the given usage log"""
+    log = app.ChatUsageLog()
+    app.ChatJob(QUESTION, server.client(), usage_log=log).wait()
+    app.answer_without_model("Flights to Laredo above 500 ft", flights, usage_log=log)
+    usage = log.frame()
+    assert list(usage['source']) == ['local', 'model']
+    assert usage['input_tokens'].iloc[1] > 0
+
+def test_chat_system_prefix_is_stable(server, flights):
+    """Every question sends the same system blocks, ending at the cached profile"""
+    profile = app.chat_profile(flights)
+    assert app.chat_profile(flights) == profile
+    client = server.client()
+    for question in (QUESTION, "Top 3 routes by flight count"):
+        app.ChatJob(question, client, profile=profile).wait()
+    first, second = (request['system'] for request in server.requests)
+    assert first == second
+    assert first[-1]['text'] == profile and 'cache_control' in first[-1]
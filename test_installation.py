@@ -21,6 +21,13 @@ def test_imports():
         print(f"❌ pandas: {e}")
         return False
     
+    try:
+        import pyarrow
+        print("✅ pyarrow")
+    except ImportError as e:
+        print(f"❌ pyarrow: {e}")
+        return False
+    
     try:
         import numpy as np
         print("✅ numpy")
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Synthetic flights, reference implementations and a local stand-in for the Anthropic API,
+shared by the tests and benchmark.py
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import anthropic
+import numpy as np
+import pandas as pd
+
+import app
+
+CITIES = [
+    ('McAllen', 26.2034, -98.2300),
+    ('Brownsville', 25.9018, -97.4975),
+    ('Laredo', 27.5064, -99.5075),
+    ('El Paso', 31.7619, -106.4850),
+    ('San Diego', 32.7157, -117.1611),
+    ('Monterrey', 25.6866, -100.3161),
+    ('Reynosa', 26.0419, -98.2782),
+    ('Nuevo Laredo', 27.4763, -99.5163),
+    ('Ciudad Juarez', 31.6904, -106.4244),
+    ('Tijuana', 32.5149, -117.0382),
+]
+
+def make_flights(n_rows: int, seed: int = 42) -> pd.DataFrame:
+    """Generate a synthetic flight frame with the same columns as the CSV upload"""
+    rng = np.random.default_rng(seed)
+    names = np.array([c[0] for c in CITIES], dtype=object)
+    lats = np.array([c[1] for c in CITIES])
+    lons = np.array([c[2] for c in CITIES])
+    origin = rng.integers(0, len(CITIES), n_rows)
+    dest = rng.integers(0, len(CITIES), n_rows)
+    start = np.datetime64('2024-01-01T00:00:00')
+    seconds = rng.integers(0, 365 * 24 * 3600, n_rows)
+
+    return pd.DataFrame({
+        'flight_id': pd.Series(np.arange(n_rows)).map('FL{:07d}'.format),
+        'origin_city': names[origin],
+        'origin_lat': lats[origin] + rng.normal(0, 0.05, n_rows),
+        'origin_lon': lons[origin] + rng.normal(0, 0.05, n_rows),
+        'dest_city': names[dest],
+        'dest_lat': lats[dest] + rng.normal(0, 0.05, n_rows),
+        'dest_lon': lons[dest] + rng.normal(0, 0.05, n_rows),
+        'timestamp': start + seconds.astype('timedelta64[s]'),
+        'speed_kts': rng.integers(10, 90, n_rows),
+        'altitude_ft': rng.integers(100, 3000, n_rows),
+    })
+
+def legacy_apply_filters(df: pd.DataFrame, filters: dict) -> pd.DataFrame:
+    """The copy-then-mask chain apply_filters used before the fused filter engine"""
+    filtered_df = df.copy()
+
+    if filters.get('time_range'):
+        start_time, end_time = filters['time_range']
+        filtered_df = filtered_df[
+            (filtered_df['timestamp'] >= start_time) &
+            (filtered_df['timestamp'] <= end_time)
+        ]
+
+    if filters.get('altitude_range'):
+        min_alt, max_alt = filters['altitude_range']
+        filtered_df = filtered_df[
+            (filtered_df['altitude_ft'] >= min_alt) &
+            (filtered_df['altitude_ft'] <= max_alt)
+        ]
+
+    if filters.get('speed_range'):
+        min_speed, max_speed = filters['speed_range']
+        filtered_df = filtered_df[
+            (filtered_df['speed_kts'] >= min_speed) &
+            (filtered_df['speed_kts'] <= max_speed)
+        ]
+
+    if filters.get('destinations'):
+        for name, bounds in (('mexico', app.MEXICO_BOUNDS), ('us', app.US_BOUNDS)):
+            if name in filters['destinations']:
+                filtered_df = filtered_df[
+                    (filtered_df['dest_lat'] >= bounds['south']) &
+                    (filtered_df['dest_lat'] <= bounds['north']) &
+                    (filtered_df['dest_lon'] >= bounds['west']) &
+                    (filtered_df['dest_lon'] <= bounds['east'])
+                ]
+
+    if filters.get('origin_cities'):
+        filtered_df = filtered_df[filtered_df['origin_city'].isin(filters['origin_cities'])]
+
+    if filters.get('dest_cities'):
+        filtered_df = filtered_df[filtered_df['dest_city'].isin(filters['dest_cities'])]
+
+    return filtered_df
+
+FILTER_CASES = {
+    'sidebar defaults': {
+        'time_range': [datetime(2024, 1, 1), datetime(2024, 12, 31, 23, 59, 59)],
+        'altitude_range': (100.0, 2999.0),
+        'speed_range': (10.0, 89.0),
+        'destinations': ['mexico', 'us'],
+    },
+    'narrow window': {
+        'time_range': [datetime(2024, 3, 1), datetime(2024, 3, 7, 23, 59, 59)],
+        'altitude_range': (500.0, 1500.0),
+        'speed_range': (20.0, 60.0),
+        'destinations': ['mexico'],
+        'dest_cities': ['Monterrey', 'Reynosa'],
+    },
+    'time window only': {
+        'time_range': [datetime(2024, 5, 1), datetime(2024, 5, 31, 23, 59, 59)],
+    },
+    'city lookup': {
+        'origin_cities': ['San Diego'],
+        'dest_cities': ['Tijuana', 'Nuevo Laredo'],
+    },
+    'chat query': {
+        'time_range': ['2024-06-01T00:00:00', '2024-06-02T00:00:00'],
+        'altitude_range': [500, 100000],
+        'dest_cities': ['Laredo'],
+    },
+}
+
+# Area filters, from a launch site a few km across to most of the border
+SPATIAL_CASES = {
+    'crossing 10 km': {'origin_radius': [32.5422, -117.0296, 10.0]},
+    'small box': {'dest_bbox': [27.4, -99.6, 27.6, -99.4]},
+    'viewport + window': {'viewport': [25.5, -98.5, 26.5, -97.0],
+                          'time_range': [datetime(2024, 3, 1), datetime(2024, 5, 31, 23, 59, 59)]},
+    'crossing 100 km': {'dest_radius': [31.7565, -106.4870, 100.0]},
+    'mexico': {'destinations': ['mexico']},
+}
+
+# Chat aggregation blocks, as the model returns them
+AGGREGATION_CASES = {
+    'avg altitude by dest': {'type': 'average', 'column': 'altitude_ft', 'group_by': 'dest_city'},
+    'flights by route': {'type': 'count', 'group_by': 'route'},
+    'max speed by hour': {'type': 'max', 'column': 'speed_kts', 'group_by': 'hour'},
+    'min altitude by day': {'type': 'min', 'column': 'altitude_ft', 'group_by': 'day'},
+}
+
+def pandas_aggregation(df: pd.DataFrame, spec: dict) -> pd.Series:
+    """The same aggregation with a pandas groupby, sorted by value"""
+    keys = {
+        'route': lambda: [df['origin_city'], df['dest_city']],
+        'hour': lambda: df['timestamp'].dt.hour,
+        'day': lambda: df['timestamp'].dt.floor('D'),
+    }.get(spec['group_by'], lambda: spec['group_by'])()
+    grouped = df.groupby(keys, observed=True)
+    how = {'average': 'mean'}.get(spec['type'], spec['type'])
+    result = grouped.size() if how == 'count' else grouped[spec['column']].agg(how)
+    return result.sort_values(ignore_index=True)
+
+def make_wide_flights(n_rows: int, n_sites: int = 50_000, seed: int = 7) -> pd.DataFrame:
+    """Synthetic flights between many launch sites, with Zipf-distributed destinations"""
+    rng = np.random.default_rng(seed)
+    df = make_flights(n_rows, seed).sort_values('timestamp', kind='stable').reset_index(drop=True)
+    sites = pd.Index([f'Site {i:05d}' for i in range(n_sites)])
+    dest = np.minimum(rng.zipf(1.3, n_rows), n_sites) - 1
+    df['origin_city'] = pd.Categorical.from_codes(rng.integers(0, n_sites, n_rows), categories=sites)
+    df['dest_city'] = pd.Categorical.from_codes(dest, categories=sites)
+    return df
+
+# Shortest system prefix the API caches, in tokens (the smallest models need 2048)
+CACHE_MIN_TOKENS = 2048
+
+class FakeAnthropicHandler(BaseHTTPRequestHandler):
+    """Answers POST /v1/messages like the Anthropic API, streaming when asked, after the server's delays"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server.calls += 1
+        server.requests.append(request)
+        text = json.dumps(server.answer)
+        message = {'id': 'msg_fake', 'type': 'message', 'role': 'assistant', 'model': request['model'],
+                   'content': [], 'stop_reason': None, 'stop_sequence': None,
+                   'usage': server.usage(request)}
+        try:
+            time.sleep(server.first_token_delay)
+            if not request.get('stream'):
+                body = json.dumps(dict(message, content=[{'type': 'text', 'text': text}], stop_reason='end_turn')).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            def event(data: dict):
+                self.wfile.write(f"event: {data['type']}\ndata: {json.dumps(data)}\n\n".encode())
+                self.wfile.flush()
+            event({'type': 'message_start', 'message': message})
+            event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+            for start in range(0, len(text), 8):
+                time.sleep(server.chunk_delay)
+                event({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text[start:start + 8]}})
+            event({'type': 'content_block_stop', 'index': 0})
+            event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                   'usage': {'output_tokens': len(text) // 4}})
+            event({'type': 'message_stop'})
+        except (BrokenPipeError, ConnectionResetError):
+            server.disconnects += 1
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeAnthropicServer(ThreadingHTTPServer):
+    """Local stand-in for the Anthropic API that injects a first-token delay and a delay per streamed chunk"""
+    daemon_threads = True
+
+    def __init__(self, first_token_delay: float = 0.3, chunk_delay: float = 0.02):
+        super().__init__(('127.0.0.1', 0), FakeAnthropicHandler)
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+        self.answer = {'filters': {'dest_cities': ['Laredo'], 'altitude_range': [500, 100000]}}
+        self.calls = 0
+        self.disconnects = 0
+        self.requests = []
+        self.cached_prefixes = set()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def usage(self, request: dict) -> dict:
+        """Input token usage, about 4 characters a token, with the API's prompt caching of system prefixes"""
+        system = request.get('system', '')
+        blocks = [{'type': 'text', 'text': system}] if isinstance(system, str) else system
+        marked = max((i + 1 for i, block in enumerate(blocks) if 'cache_control' in block), default=0)
+        prefix = ''.join(block['text'] for block in blocks[:marked])
+        rest = ''.join(block['text'] for block in blocks[marked:])
+        rest += ''.join(json.dumps(message['content']) for message in request['messages'])
+        usage = {'input_tokens': len(rest) // 4, 'output_tokens': 0,
+                 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
+        # Prefixes shorter than the minimum cacheable length are billed as ordinary input
+        if len(prefix) // 4 < CACHE_MIN_TOKENS:
+            usage['input_tokens'] += len(prefix) // 4
+        elif prefix in self.cached_prefixes:
+            usage['cache_read_input_tokens'] = len(prefix) // 4
+        else:
+            self.cached_prefixes.add(prefix)
+            usage['cache_creation_input_tokens'] = len(prefix) // 4
+        return usage
+
+    def client(self) -> anthropic.Anthropic:
+        return anthropic.Anthropic(api_key='fake', base_url=f"http://127.0.0.1:{self.server_port}", max_retries=0)
+
+# Chat filter blocks as a model may return them: (filters, expected plan, or None when it must be rejected)
+PLAN_CASES = {
+    'clean': ({'dest_cities': ['Laredo'], 'altitude_range': [500, 100000]},
+              {'dest_cities': ['Laredo'], 'altitude_range': [500.0, 100000.0]}),
+    'text and typos': ({'altitude_range': ['1,000 ft', None], 'dest_cities': 'monterey', 'origin_cities': ['ciudad juárez']},
+                       {'altitude_range': [1000.0, 100000.0], 'dest_cities': ['Monterrey'], 'origin_cities': ['Ciudad Juarez']}),
+    'unknown city': ({'dest_cities': ['Atlantis'], 'altitude_range': [500, 100000]}, None),
+    'bad time': ({'time_range': ['last tuesday', '2024-03-01']}, None),
+}